@@ -44,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'news.metrics.metrics_middleware',
+    'news.routers.replica_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,7 +59,9 @@ ROOT_URLCONF = 'metalnews3.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates с замером времени рендеринга для /metrics/
+        'BACKEND': 'news.metrics.TimedTemplates',
+        'NAME': 'django',
         'DIRS': [os.path.join(BASE_DIR, 'templates')]
         ,
         'APP_DIRS': True,
@@ -90,6 +94,38 @@ DATABASES = {
     }
 }
 
+# Реплики для чтения (news.routers): алиасы из DATABASES, например
+#     'replica': {..., 'HOST': 'replica.db', 'TEST': {'MIRROR': 'default'}},
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['news.routers.ReplicaRouter']
+# Сколько секунд посетитель после голоса, комментария или входа читает с основной базы
+REPLICA_PIN_SECONDS = 10
+
+if os.environ.get('METALNEWS_LOCAL_REPLICA') == '1':
+    # Проверка чтения с реплики на одной машине: основная база и реплика - два
+    # файла SQLite. Реплику догоняет до основной команда sync_replica
+    DATABASES = {
+        # Тестовая база - файл, а не память: иначе тесты параллельных голосов
+        # (VoteConcurrencyTests) пропускаются - SQLite в памяти не пускает двух писателей
+        'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db.sqlite3',
+                    'TEST': {'NAME': BASE_DIR / 'test-db.sqlite3'}},
+        'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db-replica.sqlite3',
+                    'TEST': {'MIRROR': 'default'}},
+    }
+    DATABASE_REPLICAS = ['replica']
+
+# Общий кэш всех процессов сервера: поколения фрагментов и страниц (news.fragments,
+# news.pagecache) и карта категорий сбрасываются в нем сразу для всех воркеров.
+# С кэшем в памяти процесса (по умолчанию в Django) сброс в одном воркере не
+# виден остальным, и они отдают старые фрагменты до истечения их таймаута
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('METALNEWS_CACHE_DIR', BASE_DIR / 'cache'),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -205,4 +241,39 @@ CKEDITOR_CONFIGS = {
     }
 }
 X_FRAME_OPTIONS = 'SAMEORIGIN'
-TAGGIT_CASE_INSENSITIVE = True
\ No newline at end of file
+TAGGIT_CASE_INSENSITIVE = True
+
+# Название категории, на которую ведет "Смотреть все" в свежих новостях главной
+MAIN_CATEGORY_NAME = 'Новости'
+
+# Как часто (в секундах) буферизованные просмотры новостей записываются в базу
+VIEW_COUNTER_FLUSH_INTERVAL = 10
+
+# Раз во сколько секунд рейтинги популярных новостей пересчитываются целиком
+# (в фоновом потоке веб-процесса); 0 - только командой rebuild_leaderboards --loop
+LEADERBOARD_MAX_AGE = 15 * 60
+
+# Кэш страниц для анонимов: сколько секунд страница свежая и сколько
+# еще может отдаваться устаревшей, пока один запрос ее пересобирает
+PAGE_CACHE_TIMEOUT = 60
+PAGE_CACHE_STALE = 5 * 60
+
+# Доля запросов, для которых замеряются SQL и шаблоны (news.metrics):
+# 0 - замеры выключены, 1 - каждый запрос. Метрики - по адресу /metrics/
+METRICS_SAMPLE_RATE = 0
+# Кроме сотрудников /metrics/ читает сборщик с заголовком
+# "Authorization: Bearer <METRICS_TOKEN>" (пустой токен - вход по токену выключен)
+METRICS_TOKEN = os.environ.get('METALNEWS_METRICS_TOKEN', '')
+# Адреса, с которых /metrics/ открыт без входа и токена. Сверяется REMOTE_ADDR:
+# за обратным прокси на той же машине (nginx -> gunicorn) у всех запросов
+# он 127.0.0.1, поэтому '127.0.0.1' здесь открывает метрики всему интернету
+METRICS_ALLOWED_IPS = ()
+
+# Асинхронные варианты главной, новости, альбома и голосов (news.views, *_async):
+# включаются под ASGI (metalnews3/asgi.py). Независимые запросы страницы
+# выполняются одновременно, каждый в своем соединении с базой
+NEWS_ASYNC_VIEWS = os.environ.get('NEWS_ASYNC_VIEWS') == '1'
+ASYNC_PARALLEL_QUERIES = True
+if NEWS_ASYNC_VIEWS:
+    # Потоки пула держат соединения между запросами, а не открывают новое на каждый запрос
+    DATABASES['default'].setdefault('CONN_MAX_AGE', 60)
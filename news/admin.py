@@ -16,6 +16,8 @@ class PostAdminForm(forms.ModelForm):
 
 class PostAdmin(admin.ModelAdmin):
     form = PostAdminForm
+    # Очищенный HTML и анонс считаются при сохранении (Post.save)
+    readonly_fields = ('excerpt',)
 
 
 admin.site.register(Post, PostAdmin)
@@ -27,6 +29,15 @@ admin.site.register(MusicLabel)
 # admin.site.register(Tag)
 admin.site.register(Category)
 admin.site.register(Comment)
+admin.site.register(PopularPost)
+
+
+class FeedSourceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'url', 'active', 'checked', 'error')
+    list_filter = ('active',)
+
+
+admin.site.register(FeedSource, FeedSourceAdmin)
 
 admin.site.site_title = 'Metalnews'
 admin.site.site_header = 'Metalnews'
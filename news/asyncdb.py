@@ -0,0 +1,59 @@
+"""
+Запросы к базе из асинхронных view (ASGI).
+
+ORM Django синхронный, поэтому асинхронная view не может обращаться к нему
+напрямую. run() выполняет синхронную функцию в пуле потоков, gather() -
+несколько независимых функций одновременно: у каждого потока свое
+соединение с базой, и страница ждет самый долгий из запросов, а не их
+сумму. Обычный sync_to_async (thread_sensitive=True) в Django 3.2 выполняет
+синхронный код всех запросов процесса в одном общем потоке, так что сюда
+отправляется вся тяжелая работа view, включая рендеринг шаблонов.
+
+После вызова соединение потока закрывается по тем же правилам, что и в
+конце обычного запроса (CONN_MAX_AGE), чтобы потоки пула не держали
+соединения бесконечно.
+
+ASYNC_PARALLEL_QUERIES = False выполняет те же функции по очереди в потоке
+вызывающего кода - например, в тестах внутри транзакции, которую другие
+соединения не видят.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+
+def _parallel():
+    return getattr(settings, 'ASYNC_PARALLEL_QUERIES', True)
+
+
+def _in_worker(func):
+    def call():
+        try:
+            return func()
+        finally:
+            close_old_connections()
+    return call
+
+
+async def run(func):
+    """Результат func() - функции без аргументов - из потока пула"""
+    if not _parallel():
+        return await sync_to_async(func)()
+    return await sync_to_async(_in_worker(func), thread_sensitive=False)()
+
+
+async def gather(*funcs):
+    """Результаты функций без аргументов, выполненных одновременно, в том же порядке"""
+    if not _parallel():
+        return [await run(func) for func in funcs]
+    return await asyncio.gather(*(run(func) for func in funcs))
+
+
+def resolve_user(request):
+    """
+    Загружает ленивого пользователя запроса (сессия и строка пользователя),
+    чтобы это сделал поток пула, а не шаблон; возвращает is_authenticated
+    """
+    return request.user.is_authenticated
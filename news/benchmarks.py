@@ -0,0 +1,476 @@
+"""
+Воспроизводимые замеры страниц новостей.
+
+generate() заполняет базу синтетическими данными (команда generate_dataset):
+пользователи, новости с тегами и категориями, комментарии с ответами,
+группы, альбомы, отзывы и голоса - все через bulk_create, с префиксом
+bench- в слагах и именах, чтобы clear() мог их удалить. После вставки
+пересчитываются денормализованные счетчики, рейтинги и индексы.
+
+run() прогоняет сценарии (главная, категория, новость, альбом, голоса)
+тестовым клиентом Django в одном процессе и для каждого считает
+пропускную способность, перцентили задержки и число SQL-запросов
+(команда bench_views). Отчет - JSON, который можно сравнить с отчетом
+другого коммита через compare() (команда bench_compare).
+
+serve() сравнивает обработчики WSGI и ASGI под нагрузкой: те же сценарии
+отправляются с заданным числом одновременных запросов - в WSGI пулом
+потоков, как у многопоточного сервера, в ASGI задачами asyncio в одном
+цикле событий (команда bench_servers). Какие view обслуживают ASGI, задает
+NEWS_ASYNC_VIEWS, поэтому каждый режим запускается в своем процессе.
+"""
+import asyncio
+import datetime
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from taggit.models import Tag, TaggedItem
+
+from news import leaderboards, ratings, related, richtext, search
+from news.counters import view_counter
+from news.metrics import Recorder
+from news.models import (Post, Category, Comment, Album, Band, MusicLabel, MusicStyle, Review, LikeDislike)
+from news.votes import VOTABLE_MODELS, sync_vote_counters
+
+PREFIX = 'bench'
+WORDS = (
+    'doom death black thrash heavy metal album tour riff guitar drummer vocalist release festival '
+    'группа альбом тур концерт гитарист барабанщик вокалист релиз фестиваль музыка новость клип '
+    'сингл лейбл сцена звук запись студия'
+).split()
+PERCENTILES = (50, 90, 95, 99)
+
+
+# Данные
+
+def _ids_after(model, last_id):
+    """pk объектов, вставленных bulk_create после last_id, в порядке вставки"""
+    return list(model.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True))
+
+
+def _last_id(model):
+    return model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def generate(posts=2000, comments=20, bands=300, albums=1500, users=2000, votes=1000000, seed=42,
+             batch_size=5000, progress=None):
+    """
+    Создает синтетический датасет; comments - среднее число комментариев
+    на новость (около трети из них - ответы). Возвращает число объектов по типам.
+    """
+    rng = random.Random(seed)
+    report = progress or (lambda message: None)
+    now = timezone.now()
+
+    def text(words):
+        return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+    with transaction.atomic():
+        last_user = _last_id(User)
+        User.objects.bulk_create([User(username=f'{PREFIX}-user-{number}', password='!')
+                                  for number in range(users)], batch_size=batch_size)
+        user_ids = _ids_after(User, last_user)
+
+        categories = [Category.objects.create(name=f'{PREFIX} category {number}') for number in range(8)]
+        styles = [MusicStyle.objects.create(name=f'{PREFIX} style {number}', description='') for number in range(20)]
+        labels = [MusicLabel.objects.create(name=f'{PREFIX} label {number}', description='') for number in range(50)]
+        tags = [Tag.objects.create(name=f'{PREFIX}-tag-{number}') for number in range(500)]
+        # Частоты тегов по Ципфу: несколько очень частых, длинный хвост редких
+        tag_weights = [1 / (rank + 1) for rank in range(len(tags))]
+        report(f'пользователей {users}')
+
+        last_post = _last_id(Post)
+        new_posts = [
+            Post(title=text(rng.randint(4, 9)).capitalize(), slug=f'{PREFIX}-post-{number}',
+                 content=''.join(f'<p>{text(60)}</p>' for _ in range(rng.randint(3, 8))),
+                 author_id=rng.choice(user_ids), image='posts/bench.jpg',
+                 status='draft' if rng.random() < 0.05 else 'published',
+                 publish=now - datetime.timedelta(minutes=rng.randint(0, 365 * 24 * 60)))
+            for number in range(posts)
+        ]
+        for post in new_posts:
+            richtext.prepare(post)
+        Post.objects.bulk_create(new_posts, batch_size=batch_size)
+        post_ids = _ids_after(Post, last_post)
+        post_type = ContentType.objects.get_for_model(Post)
+        TaggedItem.objects.bulk_create([
+            TaggedItem(content_type=post_type, object_id=post_id, tag=tag)
+            for post_id in post_ids for tag in set(rng.choices(tags, tag_weights, k=rng.randint(1, 5)))
+        ], batch_size=batch_size)
+        Post.category.through.objects.bulk_create([
+            Post.category.through(post_id=post_id, category_id=rng.choice(categories).pk) for post_id in post_ids
+        ], batch_size=batch_size)
+        report(f'новостей {posts}')
+
+        # Комментарии: сначала верхнего уровня, затем два слоя ответов на уже созданные
+        comment_ids = []
+        by_post = {post_id: [] for post_id in post_ids}
+        for layer, share in ((0, 0.65), (1, 0.25), (2, 0.10)):
+            last_comment = _last_id(Comment)
+            layer_comments = []
+            for post_id in post_ids:
+                count = round(rng.expovariate(1 / max(comments * share, 0.01)))
+                parents = by_post[post_id]
+                if layer and not parents:
+                    continue
+                for _ in range(count):
+                    layer_comments.append(Comment(
+                        post_id=post_id, name=f'{PREFIX} reader', email='reader@example.com', text=text(25),
+                        parent_id=rng.choice(parents) if layer else None))
+            Comment.objects.bulk_create(layer_comments, batch_size=batch_size)
+            new_ids = _ids_after(Comment, last_comment)
+            for comment, pk in zip(layer_comments, new_ids):
+                by_post[comment.post_id].append(pk)
+            comment_ids += new_ids
+        report(f'комментариев {len(comment_ids)}')
+
+        last_band = _last_id(Band)
+        Band.objects.bulk_create([
+            Band(name=f'{PREFIX} band {number}', slug=f'{PREFIX}-band-{number}', description=text(40),
+                 country=rng.choice(['UK', 'USA', 'Norway', 'Sweden', 'Russia']), image='band/bench.jpg')
+            for number in range(bands)
+        ], batch_size=batch_size)
+        band_ids = _ids_after(Band, last_band)
+        Band.styles.through.objects.bulk_create([
+            Band.styles.through(band_id=band_id, musicstyle_id=style.pk)
+            for band_id in band_ids for style in rng.sample(styles, rng.randint(1, 3))
+        ], batch_size=batch_size)
+        last_album = _last_id(Album)
+        Album.objects.bulk_create([
+            Album(name=text(3).title(), slug=f'{PREFIX}-album-{number}', description=text(80),
+                  duration=datetime.timedelta(minutes=rng.randint(25, 75)),
+                  release_date=datetime.date(rng.randint(1970, 2024), rng.randint(1, 12), 1),
+                  band_id=rng.choice(band_ids), label_id=rng.choice(labels).pk, cover='covers/bench.jpg')
+            for number in range(albums)
+        ], batch_size=batch_size)
+        album_ids = _ids_after(Album, last_album)
+        Review.objects.bulk_create([
+            Review(user_id=rng.choice(user_ids), album_id=album_id, text=text(40))
+            for album_id in album_ids for _ in range(rng.randint(0, 6))
+        ], batch_size=batch_size)
+        report(f'альбомов {albums}')
+
+        # Голоса: каждый пользователь голосует за свою выборку объектов без повторов
+        population = [(ContentType.objects.get_for_model(model).pk, pk)
+                      for model, ids in ((Post, post_ids), (Comment, comment_ids), (Album, album_ids),
+                                         (Band, band_ids))
+                      for pk in ids]
+        per_user = min(votes // max(users, 1), len(population))
+        batch = []
+        created_votes = 0
+        for user_id in user_ids:
+            for index in rng.sample(range(len(population)), per_user):
+                content_type_id, object_id = population[index]
+                batch.append(LikeDislike(user_id=user_id, content_type_id=content_type_id, object_id=object_id,
+                                         vote=LikeDislike.LIKE if rng.random() < 0.7 else LikeDislike.DISLIKE))
+            if len(batch) >= batch_size:
+                LikeDislike.objects.bulk_create(batch)
+                created_votes += len(batch)
+                batch = []
+                report(f'голосов {created_votes}')
+        LikeDislike.objects.bulk_create(batch)
+        created_votes += len(batch)
+
+    # bulk_create не отправляет сигналы - пересчитываем производные данные
+    for model in VOTABLE_MODELS:
+        sync_vote_counters(model, batch_size=batch_size)
+    ratings.rebuild()
+    leaderboards.rebuild()
+    related.rebuild()
+    search.rebuild()
+    report('счетчики и индексы пересчитаны')
+    return {
+        'users': len(user_ids), 'posts': len(post_ids), 'comments': len(comment_ids), 'bands': len(band_ids),
+        'albums': len(album_ids), 'votes': created_votes,
+    }
+
+
+def clear():
+    """Удаляет данные, созданные generate()"""
+    with transaction.atomic():
+        # Голоса набора - только за его же объекты, которые удаляются ниже, поэтому
+        # они удаляются одним запросом: без сигнала release_vote на каждый голос
+        votes = LikeDislike.objects.filter(user__username__startswith=f'{PREFIX}-user-')
+        votes._raw_delete(votes.db)
+        # Новости, комментарии и отзывы удаляются каскадом вместе с пользователями
+        User.objects.filter(username__startswith=f'{PREFIX}-user-').delete()
+        Band.objects.filter(slug__startswith=f'{PREFIX}-band-').delete()
+        MusicLabel.objects.filter(name__startswith=f'{PREFIX} label ').delete()
+        MusicStyle.objects.filter(name__startswith=f'{PREFIX} style ').delete()
+        Category.objects.filter(name__startswith=f'{PREFIX} category ').delete()
+        Tag.objects.filter(name__startswith=f'{PREFIX}-tag-').delete()
+    ratings.rebuild()
+    leaderboards.rebuild()
+    related.rebuild()
+    search.rebuild()
+
+
+def dataset_counts():
+    return {
+        'posts': Post.objects.count(), 'comments': Comment.objects.count(), 'albums': Album.objects.count(),
+        'bands': Band.objects.count(), 'votes': LikeDislike.objects.count(), 'users': User.objects.count(),
+    }
+
+
+# Сценарии
+
+class Scenario:
+    """
+    Серия одинаковых по смыслу запросов. request(rng) возвращает (метод, адрес);
+    anonymous - запросы без входа (через кэш страниц), иначе от пользователя.
+    """
+
+    def __init__(self, name, request, anonymous=False):
+        self.name = name
+        self.request = request
+        self.anonymous = anonymous
+
+
+def _scenarios():
+    posts = list(Post.published.values_list('pk', 'slug'))
+    albums = list(Album.objects.values_list('pk', 'slug'))
+    categories = list(Category.objects.filter(post_categories__isnull=False).distinct().values_list('slug', flat=True))
+    if not (posts and albums and categories):
+        raise ValueError('Нет данных для замеров: сначала запустите generate_dataset')
+    # Голос ставится и снимается тем же запросом по очереди, так что данные не меняются
+    vote_targets = {}
+
+    def vote(name, objects):
+        def request(rng):
+            pending = vote_targets.pop(name, None)
+            pk = pending if pending is not None else rng.choice(objects)[0]
+            if pending is None:
+                vote_targets[name] = pk
+            return 'post', reverse(name, args=[pk])
+        return request
+
+    return [
+        Scenario('main_page', lambda rng: ('get', reverse('news:post_list'))),
+        Scenario('main_page_anonymous', lambda rng: ('get', reverse('news:post_list')), anonymous=True),
+        Scenario('category', lambda rng: ('get', reverse('news:category_post_list', args=[rng.choice(categories)]))),
+        Scenario('post_detail', lambda rng: ('get', reverse('news:post_detail', args=[rng.choice(posts)[1]]))),
+        Scenario('album_detail', lambda rng: ('get', reverse('news:album_detail', args=[rng.choice(albums)[1]]))),
+        Scenario('vote_post', vote('news:post_like', posts)),
+        Scenario('vote_album', vote('news:album_like', albums)),
+    ]
+
+
+def percentile(values, percent):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not values:
+        return 0
+    return values[max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))]
+
+
+def _latency(latencies):
+    latencies = sorted(latencies)
+    return dict({f'p{percent}': round(percentile(latencies, percent), 3) for percent in PERCENTILES},
+                mean=round(statistics.fmean(latencies), 3), max=round(latencies[-1], 3))
+
+
+def _measure(client, scenario, rng, requests, warmup):
+    latencies, queries, sql_times, errors = [], [], [], 0
+    started = time.perf_counter()
+    for number in range(warmup + requests):
+        method, url = scenario.request(rng)
+        recorder = Recorder()
+        request_started = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = getattr(client, method)(url)
+        elapsed = time.perf_counter() - request_started
+        if number < warmup:
+            started = time.perf_counter()
+            continue
+        if response.status_code >= 400:
+            errors += 1
+        latencies.append(elapsed * 1000)
+        queries.append(recorder.queries)
+        sql_times.append(recorder.sql_time * 1000)
+    total = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput_rps': round(requests / total, 2) if total else 0,
+        'latency_ms': _latency(latencies),
+        'queries': {'mean': round(statistics.fmean(queries), 2), 'max': max(queries)},
+        'sql_ms_mean': round(statistics.fmean(sql_times), 3),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=settings.BASE_DIR, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _bench_user():
+    user = User.objects.filter(username__startswith=f'{PREFIX}-user-').order_by('pk').first()
+    return user or User.objects.order_by('pk').first()
+
+
+def _bench_settings():
+    # DEBUG выключен, как в продакшене: иначе каждый запрос пишется в connection.queries
+    return override_settings(DEBUG=False, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'])
+
+
+def _meta(**extra):
+    return dict({
+        'created': timezone.now().isoformat(),
+        'commit': _git_commit(),
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'dataset': dataset_counts(),
+    }, **extra)
+
+
+def run(requests=200, warmup=20, scenarios=None, seed=42, progress=None):
+    """Прогоняет сценарии и возвращает отчет (словарь для JSON)"""
+    rng = random.Random(seed)
+    user = _bench_user()
+    results = {}
+    with _bench_settings():
+        for scenario in _scenarios():
+            if scenarios and scenario.name not in scenarios:
+                continue
+            client = Client()
+            if not scenario.anonymous:
+                client.force_login(user)
+            view_counter.flush()
+            results[scenario.name] = _measure(client, scenario, rng, requests, warmup)
+            if progress:
+                progress(scenario.name, results[scenario.name])
+    return {
+        'meta': _meta(requests=requests, warmup=warmup, seed=seed),
+        'scenarios': results,
+    }
+
+
+# Нагрузка на обработчики WSGI и ASGI
+
+SERVER_MODES = ('wsgi', 'asgi')
+# Голоса не входят: одновременные голоса одного пользователя за один объект
+# меняли бы данные между прогонами
+SERVER_SCENARIOS = ('main_page', 'post_detail', 'album_detail')
+
+
+def _serve_wsgi(urls, cookies, concurrency):
+    local = threading.local()
+
+    def fetch(url):
+        if not hasattr(local, 'client'):
+            local.client = Client()
+            local.client.cookies.update(cookies)
+        started = time.perf_counter()
+        response = local.client.get(url)
+        return (time.perf_counter() - started) * 1000, response.status_code
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        return list(executor.map(fetch, urls))
+
+
+async def _serve_asgi(urls, cookies, concurrency):
+    pending = iter(urls)
+    results = []
+
+    async def worker():
+        client = AsyncClient()
+        client.cookies.update(cookies)
+        for url in pending:
+            started = time.perf_counter()
+            response = await client.get(url)
+            results.append(((time.perf_counter() - started) * 1000, response.status_code))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+def serve(mode, concurrency=32, requests=400, warmup=None, scenarios=None, seed=42, progress=None):
+    """
+    Прогоняет сценарии через обработчик mode ('wsgi' или 'asgi') с concurrency
+    одновременными запросами авторизованного пользователя и возвращает отчет.
+    Режим asgi требует NEWS_ASYNC_VIEWS (асинхронных view в urls), wsgi - наоборот.
+    """
+    if mode not in SERVER_MODES:
+        raise ValueError(f'Неизвестный режим {mode}: ожидается один из {", ".join(SERVER_MODES)}')
+    async_views = getattr(settings, 'NEWS_ASYNC_VIEWS', False)
+    if async_views != (mode == 'asgi'):
+        raise ValueError(f'Режим {mode} запускается с NEWS_ASYNC_VIEWS={int(mode == "asgi")}')
+    warmup = concurrency if warmup is None else warmup
+    rng = random.Random(seed)
+    client = Client()
+    client.force_login(_bench_user())
+    cookies = client.cookies
+
+    def fire(urls):
+        if mode == 'wsgi':
+            return _serve_wsgi(urls, cookies, concurrency)
+        return asyncio.run(_serve_asgi(urls, cookies, concurrency))
+
+    results = {}
+    with _bench_settings():
+        for scenario in _scenarios():
+            if scenario.name not in (scenarios or SERVER_SCENARIOS):
+                continue
+            urls = [scenario.request(rng)[1] for _ in range(warmup + requests)]
+            view_counter.flush()
+            fire(urls[:warmup])
+            started = time.perf_counter()
+            responses = fire(urls[warmup:])
+            total = time.perf_counter() - started
+            results[scenario.name] = {
+                'requests': requests,
+                'errors': sum(status >= 400 for _, status in responses),
+                'throughput_rps': round(requests / total, 2) if total else 0,
+                'latency_ms': _latency([latency for latency, _ in responses]),
+            }
+            if progress:
+                progress(scenario.name, results[scenario.name])
+    return {
+        'meta': _meta(mode=mode, concurrency=concurrency, requests=requests, warmup=warmup, seed=seed,
+                      async_views=async_views,
+                      parallel_queries=getattr(settings, 'ASYNC_PARALLEL_QUERIES', True)),
+        'scenarios': results,
+    }
+
+
+# Сравнение отчетов
+
+def compare(base, head, threshold=0.1):
+    """
+    Сравнивает отчеты по сценариям. Возвращает (строки, регрессии): строка -
+    (сценарий, метрика, было, стало, изменение в долях). Регрессия - рост p50
+    или p95 больше чем на threshold или рост числа запросов.
+    """
+    rows, regressions = [], []
+    for name, head_result in head['scenarios'].items():
+        base_result = base['scenarios'].get(name)
+        if base_result is None:
+            continue
+        metrics = [(f'latency {key}', base_result['latency_ms'][key], head_result['latency_ms'][key])
+                   for key in ('p50', 'p95', 'p99')]
+        metrics += [('queries max', base_result['queries']['max'], head_result['queries']['max']),
+                    ('throughput', base_result['throughput_rps'], head_result['throughput_rps'])]
+        for metric, before, after in metrics:
+            change = (after - before) / before if before else 0
+            rows.append((name, metric, before, after, change))
+            if metric in ('latency p50', 'latency p95') and change > threshold:
+                regressions.append((name, metric, before, after, change))
+            elif metric == 'queries max' and after > before:
+                regressions.append((name, metric, before, after, change))
+    return rows, regressions
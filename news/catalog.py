@@ -0,0 +1,314 @@
+"""
+Потоковый импорт и экспорт музыкального каталога: стили, лейблы, группы, альбомы.
+
+Форматы:
+- JSON Lines - по записи на строку, поле "model" (style/label/band/album),
+  в одном файле могут идти записи всех моделей;
+- CSV - одна модель на файл, стили группы перечисляются через "|".
+
+Объекты ссылаются друг на друга по естественным ключам: стиль, группа и
+альбом - по слагу, лейбл - по названию. Ключи разрешаются через словари
+в памяти (ключ -> pk), записи сохраняются пачками через bulk_create /
+bulk_update, так что память не растет с размером файла, а сигналы
+save() не срабатывают - кэши и поисковый индекс обновляются после импорта.
+"""
+import csv
+import json
+import time
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_duration
+from django.utils.duration import duration_string
+
+from news.models import Album, Band, MusicLabel, MusicStyle
+from news.slugs import unique_slugs
+
+MODELS = {
+    'style': MusicStyle,
+    'label': MusicLabel,
+    'band': Band,
+    'album': Album,
+}
+# Поля записи каждой модели; порядок моделей - порядок зависимостей
+FIELDS = {
+    'style': ('slug', 'name', 'description'),
+    'label': ('name', 'description'),
+    'band': ('slug', 'name', 'description', 'country', 'image', 'styles'),
+    'album': ('slug', 'name', 'description', 'duration', 'release_date', 'band', 'label', 'cover'),
+}
+STYLE_SEPARATOR = '|'
+UPDATE_BATCH_SIZE = 100
+
+
+class CatalogError(ValueError):
+    pass
+
+
+# Экспорт
+
+def _chunks(queryset, size):
+    """Объекты queryset пачками по size, по возрастанию pk (без OFFSET)"""
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1]['pk']
+
+
+def export_records(models=None, chunk_size=2000):
+    """Записи каталога в порядке зависимостей, без загрузки таблиц целиком"""
+    for name in MODELS:
+        if models and name not in models:
+            continue
+        if name == 'style':
+            rows = MusicStyle.objects.values('pk', 'slug', 'name', 'description')
+        elif name == 'label':
+            rows = MusicLabel.objects.values('pk', 'name', 'description')
+        elif name == 'band':
+            rows = Band.objects.values('pk', 'slug', 'name', 'description', 'country', 'image')
+        else:
+            rows = Album.objects.values('pk', 'slug', 'name', 'description', 'duration', 'release_date',
+                                        'cover', band_slug=F('band__slug'), label_name=F('label__name'))
+        for chunk in _chunks(rows, chunk_size):
+            if name == 'band':
+                # Стили пачки групп - одним запросом к промежуточной таблице
+                styles = {}
+                for band_id, slug in Band.styles.through.objects.filter(
+                        band_id__in=[row['pk'] for row in chunk]).values_list('band_id', 'musicstyle__slug'):
+                    styles.setdefault(band_id, []).append(slug)
+            for row in chunk:
+                if name == 'band':
+                    row['styles'] = sorted(styles.get(row['pk'], []))
+                elif name == 'album':
+                    row['band'], row['label'] = row.pop('band_slug'), row.pop('label_name')
+                    row['duration'] = duration_string(row['duration']) if row['duration'] else ''
+                    row['release_date'] = row['release_date'].isoformat() if row['release_date'] else ''
+                record = {'model': name}
+                record.update((field, row[field]) for field in FIELDS[name])
+                yield record
+
+
+def write_jsonl(records, stream):
+    count = 0
+    for record in records:
+        stream.write(json.dumps(record, ensure_ascii=False))
+        stream.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(records, stream, model):
+    writer = csv.DictWriter(stream, FIELDS[model], extrasaction='ignore')
+    writer.writeheader()
+    count = 0
+    for record in records:
+        if model == 'band':
+            record = dict(record, styles=STYLE_SEPARATOR.join(record['styles']))
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+# Импорт
+
+def read_jsonl(stream, model=None):
+    """(номер строки, модель, запись) из JSON Lines"""
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            yield number, None, CatalogError(f'некорректный JSON: {error}')
+            continue
+        yield number, record.pop('model', model), record
+
+
+def read_csv(stream, model):
+    for number, row in enumerate(csv.DictReader(stream), 2):
+        if model == 'band':
+            row['styles'] = [slug for slug in (row.get('styles') or '').split(STYLE_SEPARATOR) if slug]
+        yield number, model, row
+
+
+class CatalogImporter:
+    """
+    Сохраняет записи пачками. Ссылки на стили, лейблы и группы разрешаются
+    по словарям ключ -> pk, которые загружаются один раз и пополняются
+    созданными объектами.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.pending = {name: [] for name in MODELS}
+        self.created = dict.fromkeys(MODELS, 0)
+        self.updated = dict.fromkeys(MODELS, 0)
+        self.errors = []
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.styles = dict(MusicStyle.objects.values_list('slug', 'pk'))
+        self.labels = {}
+        for name, pk in MusicLabel.objects.order_by('-pk').values_list('name', 'pk'):
+            self.labels[name] = pk  # при одинаковых названиях побеждает первый лейбл
+        self.bands = {slug: (pk, name) for slug, pk, name in Band.objects.values_list('slug', 'pk', 'name')}
+        self.taken_slugs = {}
+
+    @property
+    def rows_per_second(self):
+        elapsed = time.perf_counter() - self.started
+        return self.rows / elapsed if elapsed else 0
+
+    def add(self, number, model, record):
+        self.rows += 1
+        if isinstance(record, Exception):
+            self.errors.append((number, str(record)))
+            return
+        if model not in MODELS:
+            self.errors.append((number, f'неизвестная модель {model!r}'))
+            return
+        if not record.get('name'):
+            self.errors.append((number, 'не указано название'))
+            return
+        # Записи, на которые может ссылаться эта, должны быть уже сохранены
+        for upstream in MODELS:
+            if upstream == model:
+                break
+            if self.pending[upstream]:
+                self.flush(upstream)
+        self.pending[model].append((number, record))
+        if len(self.pending[model]) >= self.batch_size:
+            self.flush(model)
+
+    def finish(self):
+        for model in MODELS:
+            if self.pending[model]:
+                self.flush(model)
+
+    def flush(self, model):
+        batch, self.pending[model] = self.pending[model], []
+        # Повтор ключа внутри пачки: побеждает последняя запись, как при построчном сохранении
+        key = 'name' if model == 'label' else 'slug'
+        last = {record[key]: index for index, (_, record) in enumerate(batch) if record.get(key)}
+        batch = [item for index, item in enumerate(batch) if not item[1].get(key) or last[item[1][key]] == index]
+        with transaction.atomic():
+            getattr(self, f'_save_{model}s')(batch)
+
+    def _upsert(self, model_name, key, objects, fields):
+        """
+        bulk_create новых и bulk_update изменившихся объектов (по ключу key).
+        Объекты, совпадающие с сохраненными, не обновляются: повторный импорт
+        того же файла не пишет в базу.
+        """
+        model = MODELS[model_name]
+        attnames = [model._meta.get_field(field).attname for field in fields]
+        existing = {}
+        for row in (model.objects.filter(**{f'{key}__in': [getattr(obj, key) for obj in objects]})
+                    .order_by('-pk').values_list(key, 'pk', *attnames)):
+            existing[row[0]] = row[1:]  # при повторе ключа побеждает первый объект
+        new, changed = [], []
+        for obj in objects:
+            row = existing.get(getattr(obj, key))
+            if row is None:
+                new.append(obj)
+                continue
+            obj.pk = row[0]
+            if tuple(getattr(obj, attname) for attname in attnames) != row[1:]:
+                changed.append(obj)
+        if changed and hasattr(model, 'updated'):
+            # bulk_update не трогает auto_now, а по updated считаются ETag страниц
+            now = timezone.now()
+            for obj in changed:
+                obj.updated = now
+            fields = [*fields, 'updated']
+        model.objects.bulk_create(new)
+        # bulk_update строит CASE по всем объектам пачки - небольшие пачки собираются быстрее
+        model.objects.bulk_update(changed, fields, batch_size=UPDATE_BATCH_SIZE)
+        self.created[model_name] += len(new)
+        self.updated[model_name] += len(changed)
+        # bulk_create не везде возвращает pk - перечитываем ключи созданных объектов
+        return dict(model.objects.filter(**{f'{key}__in': [getattr(obj, key) for obj in new]})
+                    .values_list(key, 'pk')) if new else {}
+
+    def _slugs(self, model_name, batch, source):
+        """Записи без слага получают уникальный слаг из source(record)"""
+        missing = [record for _, record in batch if not record.get('slug')]
+        if not missing:
+            return
+        # Занятые слаги модели читаются один раз на весь импорт, а не на каждую пачку
+        if model_name not in self.taken_slugs:
+            self.taken_slugs[model_name] = set(MODELS[model_name].objects.values_list('slug', flat=True).iterator())
+        taken = self.taken_slugs[model_name]
+        taken.update(record['slug'] for _, record in batch if record.get('slug'))
+        slugs = unique_slugs(MODELS[model_name], [source(record) for record in missing], taken=taken)
+        for record, slug in zip(missing, slugs):
+            record['slug'] = slug
+
+    def _save_styles(self, batch):
+        self._slugs('style', batch, lambda record: record['name'])
+        styles = [MusicStyle(slug=r['slug'], name=r['name'], description=r.get('description', ''))
+                  for _, r in batch]
+        self.styles.update(self._upsert('style', 'slug', styles, ['name', 'description']))
+
+    def _save_labels(self, batch):
+        labels = [MusicLabel(name=r['name'], description=r.get('description', '')) for _, r in batch]
+        self.labels.update(self._upsert('label', 'name', labels, ['description']))
+
+    def _save_bands(self, batch):
+        self._slugs('band', batch, lambda record: record['name'])
+        bands, band_styles = [], {}
+        for number, record in batch:
+            unknown = [slug for slug in record.get('styles') or [] if slug not in self.styles]
+            if unknown:
+                self.errors.append((number, f'неизвестные стили: {", ".join(unknown)}'))
+                continue
+            bands.append(Band(slug=record['slug'], name=record['name'], description=record.get('description', ''),
+                              country=record.get('country', ''), image=record.get('image', '')))
+            band_styles[record['slug']] = {self.styles[slug] for slug in record.get('styles') or []}
+        fields = ['name', 'description', 'country', 'image']
+        created = self._upsert('band', 'slug', bands, fields)
+        for band in bands:
+            band.pk = band.pk or created[band.slug]
+            self.bands[band.slug] = (band.pk, band.name)
+
+        # Стили пачки заменяются целиком: удалить старые связи и вставить новые
+        through = Band.styles.through
+        through.objects.filter(band_id__in=[band.pk for band in bands]).delete()
+        through.objects.bulk_create([
+            through(band_id=band.pk, musicstyle_id=style_id)
+            for band in bands for style_id in band_styles[band.slug]
+        ])
+
+    def _save_albums(self, batch):
+        valid = []
+        for number, record in batch:
+            if record.get('band') not in self.bands:
+                self.errors.append((number, f'неизвестная группа {record.get("band")!r}'))
+            elif record.get('label') not in self.labels:
+                self.errors.append((number, f'неизвестный лейбл {record.get("label")!r}'))
+            else:
+                valid.append((number, record))
+        # Слаг альбома строится из названия группы - берем его из словаря, а не из self.band
+        self._slugs('album', valid, lambda record: f'{record["name"]}-{self.bands[record["band"]][1]}')
+        albums = []
+        for number, record in valid:
+            try:
+                duration = parse_duration(record.get('duration') or '0')
+                release_date = parse_date(record.get('release_date') or '')
+            except ValueError as error:
+                self.errors.append((number, str(error)))
+                continue
+            if duration is None or release_date is None:
+                self.errors.append((number, 'некорректная длительность или дата релиза'))
+                continue
+            albums.append(Album(
+                slug=record['slug'], name=record['name'], description=record.get('description', ''),
+                duration=duration, release_date=release_date, cover=record.get('cover', ''),
+                band_id=self.bands[record['band']][0], label_id=self.labels[record['label']],
+            ))
+        self._upsert('album', 'slug', albums,
+                     ['name', 'description', 'duration', 'release_date', 'cover', 'band', 'label'])
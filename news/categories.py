@@ -0,0 +1,79 @@
+"""
+Карта категорий в памяти процесса: слаг -> (id, название, слаг).
+
+Категории меняются редко, а нужны почти каждой странице (маршрут списка
+категории, меню), поэтому они читаются из базы один раз и дальше берутся
+из памяти. При сохранении или удалении категории сигнал меняет
+поколение карты в общем кэше: остальные процессы видят новое поколение и
+перечитывают категории при следующем обращении.
+"""
+import threading
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from news.models import Category
+
+GENERATION_KEY = 'category-map-generation'
+
+_lock = threading.Lock()
+# (поколение, {слаг: CategoryEntry}) или None, пока карта не загружена
+_map = None
+
+
+class CategoryEntry(namedtuple('CategoryEntry', 'pk name slug')):
+    """Категория из карты; в шаблонах выводится названием"""
+
+    def __str__(self):
+        return self.name
+
+
+def _new_generation():
+    return uuid.uuid4().hex
+
+
+def _generation():
+    # Случайное значение, а не счетчик: если кэш потерял ключ, новое поколение
+    # не совпадет ни с одной загруженной картой
+    return cache.get_or_set(GENERATION_KEY, _new_generation, None)
+
+
+def get_map():
+    """Категории по слагам в порядке названий"""
+    global _map
+    generation = _generation()
+    current = _map
+    if current is None or current[0] != generation:
+        with _lock:
+            entries = {slug: CategoryEntry(pk, name, slug)
+                       for pk, name, slug in Category.objects.order_by('name').values_list('pk', 'name', 'slug')}
+            current = _map = (generation, entries)
+    return current[1]
+
+
+def get_by_slug(slug):
+    """Категория по слагу или None"""
+    return get_map().get(slug)
+
+
+def get_by_name(name):
+    """Категория по названию или None (для старых адресов /category/<название>)"""
+    return next((entry for entry in get_map().values() if entry.name == name), None)
+
+
+def all_categories():
+    return list(get_map().values())
+
+
+def main_category():
+    """Категория кнопки "Смотреть все" на главной (MAIN_CATEGORY_NAME) или None"""
+    return get_by_name(getattr(settings, 'MAIN_CATEGORY_NAME', 'Новости'))
+
+
+def invalidate():
+    """Сбрасывает карту в этом процессе и в остальных"""
+    global _map
+    _map = None
+    cache.set(GENERATION_KEY, _new_generation(), None)
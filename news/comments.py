@@ -0,0 +1,43 @@
+"""
+Дерево комментариев новости.
+
+Все комментарии новости загружаются одним запросом (счетчики голосов уже
+денормализованы в строке), голоса текущего пользователя - вторым, а дерево
+произвольной глубины собирается в памяти.
+"""
+from news.models import Comment
+from news.votes import get_vote_state
+
+
+def build_comment_tree(post, user):
+    """
+    Возвращает (корневые комментарии, общее число комментариев).
+    У каждого комментария заполнены replies (ответы по порядку) и depth
+    (уровень вложенности); голоса пользователя загружаются в его VoteState.
+    """
+    queryset = Comment.objects.filter(post=post)
+    comments = list(queryset.order_by('created', 'pk'))
+    # Подзапрос вместо списка id: у популярной новости тысячи комментариев
+    get_vote_state(user).preload(comments, pk_queryset=queryset.values('pk'))
+    by_id = {}
+    for comment in comments:
+        comment.replies = []
+        by_id[comment.pk] = comment
+
+    roots = []
+    for comment in comments:
+        parent = by_id.get(comment.parent_id)
+        if parent is None:
+            # Родитель удален (SET_NULL) или это комментарий верхнего уровня
+            roots.append(comment)
+        else:
+            parent.replies.append(comment)
+
+    # Глубину проставляем обходом от корней: порядок created не гарантирует,
+    # что родитель обработан раньше ответа
+    stack = [(comment, 0) for comment in roots]
+    while stack:
+        comment, depth = stack.pop()
+        comment.depth = depth
+        stack.extend((reply, depth + 1) for reply in comment.replies)
+    return roots, len(comments)
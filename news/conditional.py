@@ -0,0 +1,136 @@
+"""
+Условные GET-запросы (ETag / Last-Modified) для страниц новости и альбома.
+
+Валидаторы страницы считаются одним легким запросом без рендеринга:
+время изменения объекта, счетчики голосов, число и последние правки
+комментариев (отзывов), соседние и похожие записи и пользователь, для
+которого страница собрана.
+Если клиент или кэш перед сайтом прислал совпадающий ETag, отвечаем 304.
+Last-Modified не отдается: голоса и удаление комментариев не меняют ни
+одной даты, и запрос только с If-Modified-Since получал бы устаревшие 304.
+"""
+import hashlib
+from functools import partial
+
+from django.conf import settings
+from django.db.models import Count, F, Max, OuterRef, Subquery, Sum
+from django.http import Http404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+from news import asyncdb
+from news.models import Post, Album, Band, RelatedPost
+
+# Меняется при выкладке шаблонов, чтобы старые ETag не подтверждали старую разметку
+PAGE_ETAG_VERSION = getattr(settings, 'PAGE_ETAG_VERSION', '1')
+
+
+class PageValidators:
+
+    def __init__(self, pk, parts, user):
+        self.pk = pk
+        # Страница показывает голоса пользователя и форму с его данными
+        user_key = user.pk if user.is_authenticated else 'anon'
+        digest = hashlib.md5(repr((PAGE_ETAG_VERSION, user_key) + tuple(parts)).encode()).hexdigest()
+        self.etag = quote_etag(digest)
+        self.private = user.is_authenticated
+
+
+def _post_row(slug):
+    neighbours = Post.published.values('pk')
+    # Контрольная сумма списка похожих новостей: меняется при его пересчете
+    related = RelatedPost.objects.filter(post=OuterRef('pk')).order_by().values('post').annotate(
+        checksum=Sum(F('related_id') * F('position'))).values('checksum')
+    row = Post.published.filter(slug=slug).annotate(
+        comments_total=Count('comment'),
+        last_comment_id=Max('comment__id'),
+        last_comment_edit=Max('comment__updated'),
+        comment_likes=Sum('comment__like_count'),
+        comment_dislikes=Sum('comment__dislike_count'),
+        previous_id=Subquery(neighbours.filter(created__lt=OuterRef('created')).order_by('-created')[:1]),
+        next_id=Subquery(neighbours.filter(created__gt=OuterRef('created')).order_by('created')[:1]),
+        related_checksum=Subquery(related),
+    ).values_list(
+        'pk', 'updated', 'like_count', 'dislike_count', 'comments_total', 'last_comment_id', 'last_comment_edit',
+        'comment_likes', 'comment_dislikes', 'previous_id', 'next_id', 'related_checksum',
+    ).order_by().first()
+    if row is None:
+        raise Http404
+    return row
+
+
+def _post_page(row, user):
+    return PageValidators(row[0], row, user)
+
+
+def post_validators(slug, user):
+    """Валидаторы страницы новости; Http404, если ее нет"""
+    return _post_page(_post_row(slug), user)
+
+
+async def post_validators_async(request, slug):
+    """post_validators для асинхронной view: строка валидаторов и пользователь загружаются одновременно"""
+    row, _ = await asyncdb.gather(partial(_post_row, slug), partial(asyncdb.resolve_user, request))
+    return _post_page(row, request.user)
+
+
+def _album_row(slug):
+    # Стили группы на странице альбома: их смена не меняет band.updated
+    styles = Band.styles.through.objects.filter(band=OuterRef('band')).order_by().values('band').annotate(
+        checksum=Sum('musicstyle_id')).values('checksum')
+    row = Album.objects.filter(slug=slug).annotate(
+        reviews_total=Count('review'),
+        last_review_id=Max('review__id'),
+        styles_checksum=Subquery(styles),
+    ).values_list(
+        'pk', 'updated', 'band__updated', 'band__name', 'band__country', 'label_id', 'label__name',
+        'styles_checksum', 'like_count', 'dislike_count', 'reviews_total', 'last_review_id',
+    ).order_by().first()
+    if row is None:
+        raise Http404
+    return row
+
+
+def _album_page(row, user):
+    return PageValidators(row[0], row, user)
+
+
+def album_validators(slug, user):
+    """Валидаторы страницы альбома; Http404, если его нет"""
+    return _album_page(_album_row(slug), user)
+
+
+async def album_validators_async(request, slug):
+    """album_validators для асинхронной view"""
+    row, _ = await asyncdb.gather(partial(_album_row, slug), partial(asyncdb.resolve_user, request))
+    return _album_page(row, request.user)
+
+
+def conditional_response(request, validators, render):
+    """
+    304 Not Modified, если ETag совпал с заголовками запроса,
+    иначе ответ render() с проставленным ETag.
+    """
+    response = get_conditional_response(request, etag=validators.etag)
+    if response is None:
+        response = render()
+    return _with_validators(request, validators, response)
+
+
+async def conditional_response_async(request, validators, render):
+    """conditional_response для асинхронной view: render - корутинная функция"""
+    response = get_conditional_response(request, etag=validators.etag)
+    if response is None:
+        response = await render()
+    return _with_validators(request, validators, response)
+
+
+def _with_validators(request, validators, response):
+    if request.method in ('GET', 'HEAD'):
+        response.setdefault('ETag', validators.etag)
+    # Хранить можно, но перед показом - перепроверять; страницы пользователей - только в браузере
+    if validators.private:
+        patch_cache_control(response, no_cache=True, private=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
@@ -0,0 +1,141 @@
+"""
+Буферизованный счетчик просмотров новостей.
+
+Просмотры копятся в памяти процесса и периодически сбрасываются в базу:
+по одному ``UPDATE ... SET views = views + n`` на каждое различное n,
+вместо записи строки на каждый просмотр. Пишет только фоновый поток раз в
+VIEW_COUNTER_FLUSH_INTERVAL секунд (0 - без потока, только явный flush(),
+например в тестах), так что запрос читателя никогда не платит за чужие
+просмотры; при завершении процесса буфер сбрасывается через atexit.
+Размер буфера и отставание счетчиков видны в /metrics/ (news.metrics).
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from news import leaderboards
+from news.models import Post
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter:
+    """Потокобезопасный буфер просмотров: pk новости -> число просмотров"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._first_pending = None
+        self._flusher = None
+        self.flushed_views = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'VIEW_COUNTER_FLUSH_INTERVAL', 10)
+
+    def hit(self, pk):
+        """Учитывает просмотр; в базу его запишет фоновый поток"""
+        with self._lock:
+            self._pending[pk] += 1
+            if self._first_pending is None:
+                self._first_pending = time.monotonic()
+        if self._flusher is None:
+            self._start_flusher()
+
+    def pending(self, pk):
+        """
+        Просмотры новости, еще не записанные в базу. Читается после строки
+        новости: если поток успел записать буфер между ними, страница покажет
+        на эти просмотры меньше, но никогда не посчитает их дважды.
+        """
+        with self._lock:
+            return self._pending.get(pk, 0)
+
+    def flush(self):
+        """Записывает накопленные просмотры в базу, возвращает их количество"""
+        with self._lock:
+            batch, self._pending = self._pending, Counter()
+            first_pending, self._first_pending = self._first_pending, None
+        if not batch:
+            return 0
+
+        by_amount = defaultdict(list)
+        for pk, amount in batch.items():
+            by_amount[amount].append(pk)
+        try:
+            with transaction.atomic():
+                for amount, pks in by_amount.items():
+                    Post.objects.filter(pk__in=pks).update(views=F('views') + amount)
+        except Exception:
+            # Не теряем просмотры: возвращаем их в буфер до следующей попытки
+            with self._lock:
+                self._pending.update(batch)
+                # Отставание считается от самого старого из вернувшихся просмотров
+                self._first_pending = first_pending
+                self.failed_flushes += 1
+            logger.exception('Не удалось записать просмотры новостей')
+            return 0
+
+        total = sum(batch.values())
+        self.flushed_views += total
+        self.flushes += 1
+        try:
+            for post in Post.objects.filter(pk__in=batch).only('pk', 'views', 'rating', 'publish', 'status'):
+                leaderboards.update_post(post)
+        except Exception:
+            # Просмотры уже записаны: рейтинги догонит следующая пересборка
+            logger.exception('Не удалось обновить рейтинги после записи просмотров')
+        logger.debug('Записано %s просмотров для %s новостей', total, len(batch))
+        return total
+
+    def stats(self):
+        """Метрики буфера: отставание записанных счетчиков от реальных"""
+        with self._lock:
+            # Возраст самого старого незаписанного просмотра
+            lag = time.monotonic() - self._first_pending if self._first_pending is not None else 0.0
+            return {
+                'pending_views': sum(self._pending.values()),
+                'pending_posts': len(self._pending),
+                'lag_seconds': lag,
+                'flushed_views': self.flushed_views,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+            }
+
+    def _start_flusher(self):
+        """Фоновый поток, сбрасывающий буфер, даже если новых просмотров нет"""
+        with self._lock:
+            if self._flusher is not None or self.flush_interval <= 0:
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name='view-counter-flush', daemon=True)
+        self._flusher.start()
+
+    def _run_flusher(self):
+        try:
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception:
+                    # Поток не должен умирать: иначе буфер растет до конца процесса
+                    with self._lock:
+                        self.failed_flushes += 1
+                    logger.exception('Ошибка фонового сброса просмотров')
+                finally:
+                    connection.close()
+        finally:
+            # Если поток все же завершился, следующий hit() запустит новый
+            with self._lock:
+                self._flusher = None
+
+
+view_counter = ViewCounter()
+atexit.register(view_counter.flush)
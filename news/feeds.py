@@ -0,0 +1,203 @@
+"""
+Загрузка новостей из внешних RSS/Atom-лент (FeedSource).
+
+Ленты опрашиваются параллельно через asyncio: сетевые запросы (requests) и
+разбор (feedparser) выполняются в пуле потоков, одновременно - не больше
+FEED_CONCURRENCY лент. Запросы условные (If-None-Match / If-Modified-Since),
+так что неизменившаяся лента отвечает 304 без тела. Новые записи отсеиваются
+по хэшу GUID и ссылки (FeedEntry) и сохраняются черновиками Post через
+bulk_create - их проверяет и публикует редактор в админке.
+
+Адреса лент - только http и https. Если другой процесс успел сохранить те
+же записи (IntegrityError), пакет ленты откатывается, а ее ETag не
+запоминается, так что следующий опрос разберет ленту заново.
+"""
+import asyncio
+import hashlib
+import time
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from urllib.parse import urlsplit
+
+import feedparser
+import requests
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.html import escape
+
+from news import richtext
+from news.models import Post, FeedSource, FeedEntry
+from news.slugs import assign_slugs
+
+FEED_CONCURRENCY = getattr(settings, 'FEED_CONCURRENCY', 8)
+FEED_TIMEOUT = getattr(settings, 'FEED_TIMEOUT', 15)
+FEED_USER_AGENT = getattr(settings, 'FEED_USER_AGENT', 'MetalNews feed reader')
+FEED_SCHEMES = ('http', 'https')
+
+
+class FetchResult:
+    """Ответ ленты: status 304 - не изменилась, entries - разобранные записи"""
+
+    def __init__(self, source, status=None, etag='', last_modified='', entries=(), error=''):
+        self.source = source
+        self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
+        self.entries = entries
+        self.error = error
+
+
+def _download(url, etag, last_modified):
+    if urlsplit(url).scheme.lower() not in FEED_SCHEMES:
+        raise requests.exceptions.InvalidSchema(f'Лента должна быть по http или https: {url}')
+    headers = {'User-Agent': FEED_USER_AGENT}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    response = requests.get(url, headers=headers, timeout=FEED_TIMEOUT)
+    if response.status_code != 304:
+        response.raise_for_status()
+    return (response.status_code, response.headers.get('ETag', ''),
+            response.headers.get('Last-Modified', ''), response.content)
+
+
+def _fetch(source):
+    try:
+        status, etag, last_modified, content = _download(source.url, source.etag, source.last_modified)
+    except (OSError, requests.RequestException) as error:
+        return FetchResult(source, error=f'{type(error).__name__}: {error}')
+    if status == 304:
+        return FetchResult(source, status, source.etag, source.last_modified)
+    parsed = feedparser.parse(content)
+    if parsed.bozo and not parsed.entries:
+        return FetchResult(source, status, error=f'Не удалось разобрать ленту: {parsed.bozo_exception}')
+    return FetchResult(source, status, etag, last_modified, parsed.entries)
+
+
+async def fetch_all(sources, concurrency=None):
+    """Скачивает и разбирает ленты параллельно, не больше concurrency одновременно"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency or FEED_CONCURRENCY)
+    with ThreadPoolExecutor(max_workers=concurrency or FEED_CONCURRENCY) as executor:
+
+        async def fetch(source):
+            async with semaphore:
+                return await loop.run_in_executor(executor, _fetch, source)
+
+        return await asyncio.gather(*(fetch(source) for source in sources))
+
+
+def _hash(value):
+    return hashlib.sha1(value.encode()).hexdigest() if value else ''
+
+
+def _published(entry):
+    parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+    if not parsed:
+        return timezone.now()
+    return datetime.fromtimestamp(timegm(parsed), dt_timezone.utc)
+
+
+def _content(entry):
+    if entry.get('content'):
+        html = entry.content[0].value
+    else:
+        html = entry.get('summary', '')
+    link = entry.get('link')
+    if link:
+        html += f'<p><a href="{escape(link)}" rel="nofollow">Источник</a></p>'
+    return html
+
+
+def save_entries(source, entries):
+    """Создает черновики для еще не виденных записей ленты; возвращает их число"""
+    candidates = {}
+    batch_links = set()
+    for entry in entries:
+        link = entry.get('link', '')
+        guid_hash, link_hash = _hash(entry.get('id') or link or entry.get('title', '')), _hash(link)
+        # Повторы внутри одной ленты - и по GUID, и по ссылке под другим GUID
+        if not guid_hash or guid_hash in candidates or link_hash in batch_links:
+            continue
+        candidates[guid_hash] = (entry, link_hash)
+        if link_hash:
+            batch_links.add(link_hash)
+    if not candidates:
+        return 0
+
+    link_hashes = {link_hash for _, link_hash in candidates.values() if link_hash}
+    seen = FeedEntry.objects.filter(guid_hash__in=list(candidates)).values_list('guid_hash', flat=True)
+    seen_links = set(FeedEntry.objects.filter(link_hash__in=link_hashes).values_list('link_hash', flat=True))
+    for guid_hash in seen:
+        candidates.pop(guid_hash)
+    new = [(guid_hash, entry, link_hash) for guid_hash, (entry, link_hash) in candidates.items()
+           if not link_hash or link_hash not in seen_links]
+    if not new:
+        return 0
+
+    with transaction.atomic():
+        posts = assign_slugs([
+            Post(title=entry.get('title', '')[:200], content=_content(entry), author_id=source.author_id,
+                 status='draft', publish=_published(entry))
+            for _, entry, _ in new
+        ], lambda post: post.title)
+        # bulk_create не вызывает save(), поэтому HTML лент очищается здесь
+        for post in posts:
+            richtext.prepare(post)
+        Post.objects.bulk_create(posts)
+        # bulk_create не везде возвращает первичные ключи, поэтому читаем их по слагам
+        post_ids = dict(Post.objects.filter(slug__in=[post.slug for post in posts]).values_list('slug', 'pk'))
+        FeedEntry.objects.bulk_create([
+            FeedEntry(source=source, guid_hash=guid_hash, link_hash=link_hash, post_id=post_ids[post.slug])
+            for (guid_hash, _, link_hash), post in zip(new, posts)
+        ])
+        if source.category_id:
+            through = Post.category.through
+            through.objects.bulk_create([
+                through(post_id=post_ids[post.slug], category_id=source.category_id) for post in posts
+            ])
+    return len(posts)
+
+
+def ingest(sources=None, concurrency=None):
+    """
+    Опрашивает ленты (по умолчанию - все активные) и сохраняет новые записи.
+    Возвращает {имя ленты: число новых черновиков или текст ошибки}.
+    """
+    if sources is None:
+        sources = FeedSource.objects.filter(active=True).order_by('pk')
+    sources = list(sources)
+    results = asyncio.run(fetch_all(sources, concurrency))
+
+    report = {}
+    checked = timezone.now()
+    for result in results:
+        source = result.source
+        source.checked = checked
+        source.error = result.error
+        if result.error:
+            report[source.name] = result.error
+            continue
+        try:
+            report[source.name] = save_entries(source, result.entries) if result.status != 304 else 0
+        except IntegrityError as error:
+            # Записи одновременно сохранил другой процесс: старый ETag оставляет
+            # ленту непрочитанной до следующего опроса
+            source.error = report[source.name] = f'{type(error).__name__}: {error}'
+            continue
+        source.etag, source.last_modified = result.etag, result.last_modified
+    FeedSource.objects.bulk_update(sources, ['etag', 'last_modified', 'checked', 'error'])
+    return report
+
+
+def run_forever(interval, sources=None, concurrency=None, report=None):
+    """Опрос лент раз в interval секунд (для отдельного процесса-воркера)"""
+    while True:
+        started = time.monotonic()
+        result = ingest(sources.all() if sources is not None else None, concurrency)
+        if report is not None:
+            report(result)
+        time.sleep(max(0, interval - (time.monotonic() - started)))
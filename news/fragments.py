@@ -0,0 +1,68 @@
+"""
+Кэш HTML-фрагментов (сайдбар, карусель альбомов).
+
+Ключ фрагмента включает его "поколение": при изменении данных сигналы
+заменяют поколение новым, и все старые ключи фрагмента перестают читаться
+без перебора и удаления отдельных записей кэша.
+"""
+import hashlib
+import threading
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import translation
+
+FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 10 * 60)
+
+_stats_lock = threading.Lock()
+_stats = Counter()
+
+
+def _generation_key(name):
+    return f'fragment-generation:{name}'
+
+
+def _new_generation():
+    # Случайное, а не счетчик с 1: если поколение вытеснили из кэша, новое не
+    # совпадет со старыми и сохранившиеся фрагменты не прочитаются
+    return uuid.uuid4().hex
+
+
+def _fragment_key(name, vary_on):
+    generation = cache.get_or_set(_generation_key(name), _new_generation, None)
+    vary = hashlib.md5(':'.join(str(value) for value in vary_on).encode()).hexdigest()
+    return f'fragment:{name}:{generation}:{translation.get_language()}:{vary}'
+
+
+def _count(name, outcome):
+    with _stats_lock:
+        _stats[(name, outcome)] += 1
+
+
+def get_or_render(name, vary_on, render):
+    """Возвращает фрагмент из кэша или рендерит и кэширует его"""
+    key = _fragment_key(name, vary_on)
+    content = cache.get(key)
+    if content is not None:
+        _count(name, 'hit')
+        return content
+    _count(name, 'miss')
+    content = render()
+    cache.set(key, content, FRAGMENT_CACHE_TIMEOUT)
+    return content
+
+
+def invalidate(*names):
+    """Сбрасывает все варианты фрагментов (для всех категорий и языков)"""
+    cache.set_many({_generation_key(name): _new_generation() for name in names}, None)
+
+
+def stats():
+    """Счетчики попаданий/промахов: {фрагмент: {'hit': n, 'miss': m}}"""
+    with _stats_lock:
+        result = {}
+        for (name, outcome), value in _stats.items():
+            result.setdefault(name, {'hit': 0, 'miss': 0})[outcome] = value
+        return result
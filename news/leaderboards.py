@@ -0,0 +1,192 @@
+"""
+Предрассчитанные рейтинги популярных новостей ("Лучшее за" в сайдбаре).
+
+Вместо четырёх агрегирующих запросов на каждую страницу рейтинги хранятся
+в таблице PopularPost: полностью пересчитываются командой
+``rebuild_leaderboards`` и инкрементально обновляются при просмотрах и
+голосах. Чтобы из окон "день/неделя/месяц" выпадали старые новости, запрос,
+заметивший устаревшие рейтинги, запускает пересчет в фоновом потоке и сам
+отдает прежние (LEADERBOARD_MAX_AGE = 0 - без пересчета в веб-процессе,
+только ``rebuild_leaderboards --loop``).
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from news.models import Post, PopularPost
+
+# Период -> глубина окна в днях (None - за все время)
+PERIODS = {
+    'day': 1,
+    'week': 7,
+    'month': 30,
+    'years': None,
+}
+
+LEADERBOARD_SIZE = getattr(settings, 'LEADERBOARD_SIZE', 3)
+
+logger = logging.getLogger(__name__)
+
+_last_refresh_check = 0.0
+_refresh_lock = threading.Lock()
+
+
+def max_age():
+    """Как часто (в секундах) пересчитывать рейтинги целиком; 0 - только командой"""
+    return getattr(settings, 'LEADERBOARD_MAX_AGE', 15 * 60)
+
+
+def _window(period, now=None):
+    days = PERIODS[period]
+    if days is None:
+        return None
+    now = now or timezone.now()
+    return now - timezone.timedelta(days=days), now
+
+
+def live_queryset(period):
+    """Эталонный запрос рейтинга за период, по которому строится таблица"""
+    qs = Post.published.all()
+    window = _window(period)
+    if window:
+        qs = qs.filter(publish__range=window)
+    return qs.order_by('-views', '-rating', '-pk')
+
+
+def _sort_key(entry):
+    return -entry['views'], -entry['rating'], -entry['post_id']
+
+
+def _write(period, entries, computed):
+    PopularPost.objects.filter(period=period).delete()
+    PopularPost.objects.bulk_create([
+        PopularPost(period=period, position=position, post_id=entry['post_id'],
+                    views=entry['views'], rating=entry['rating'], computed=computed)
+        for position, entry in enumerate(entries, start=1)
+    ])
+
+
+def rebuild(periods=None):
+    """Полный пересчет рейтингов по эталонному запросу"""
+    computed = timezone.now()
+    for period in periods or PERIODS:
+        entries = [
+            {'post_id': post.pk, 'views': post.views, 'rating': post.rating}
+            for post in live_queryset(period).only('pk', 'views', 'rating')[:LEADERBOARD_SIZE]
+        ]
+        with transaction.atomic():
+            _write(period, entries, computed)
+
+
+def refresh_if_stale():
+    """
+    Запускает пересчет в фоновом потоке, если последний пересчет старше
+    LEADERBOARD_MAX_AGE. Возраст проверяется не чаще раза в LEADERBOARD_MAX_AGE
+    секунд. Возвращает True, если пересчет запущен.
+    """
+    global _last_refresh_check
+    age = max_age()
+    if age <= 0 or time.monotonic() - _last_refresh_check < age:
+        return False
+    _last_refresh_check = time.monotonic()
+    oldest = PopularPost.objects.order_by('computed').values_list('computed', flat=True).first()
+    if oldest is not None and timezone.now() - oldest <= timezone.timedelta(seconds=age):
+        return False
+    return _start_refresh()
+
+
+def _start_refresh():
+    # Один пересчет на процесс: остальные запросы не ждут и не запускают свой
+    if not _refresh_lock.acquire(blocking=False):
+        return False
+    threading.Thread(target=_run_refresh, name='leaderboards-refresh', daemon=True).start()
+    return True
+
+
+def _run_refresh():
+    try:
+        rebuild()
+    except Exception:
+        logger.exception('Не удалось пересчитать рейтинги популярных новостей')
+    finally:
+        connection.close()
+        _refresh_lock.release()
+
+
+def run_forever(interval, periods=None, report=None):
+    """Полный пересчет раз в interval секунд (для отдельного процесса-воркера)"""
+    while True:
+        started = time.monotonic()
+        rebuild(periods)
+        if report is not None:
+            report()
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+def update_post(post):
+    """
+    Инкрементально обновляет рейтинги после просмотра или голоса за новость.
+    Пересчитывает только те периоды, в окно которых попадает новость.
+    """
+    if post.status != 'published':
+        # Черновик в рейтинг не попадает, а снятая с публикации новость
+        # уходит из него: такие периоды пересчитываются без нее
+        periods = list(PopularPost.objects.filter(post_id=post.pk).values_list('period', flat=True))
+        if periods:
+            rebuild(periods)
+        return
+    candidate = {'post_id': post.pk, 'views': post.views, 'rating': post.rating}
+    now = timezone.now()
+    for period in PERIODS:
+        window = _window(period, now)
+        if window and not window[0] <= post.publish <= window[1]:
+            continue
+        stored = list(PopularPost.objects.filter(period=period).values('post_id', 'views', 'rating', 'computed'))
+        if not stored:
+            # Рейтинг за период еще не строился - строим целиком
+            rebuild([period])
+            continue
+        # Время полного пересчета сохраняем, чтобы refresh_if_stale видел его возраст
+        computed = min(entry['computed'] for entry in stored)
+        entries = [entry for entry in stored if entry['post_id'] != post.pk]
+        if len(entries) >= LEADERBOARD_SIZE and _sort_key(candidate) > _sort_key(entries[-1]):
+            continue
+        entries = sorted(entries + [candidate], key=_sort_key)[:LEADERBOARD_SIZE]
+        if [_sort_key(entry) for entry in entries] == [_sort_key(entry) for entry in stored]:
+            continue
+        try:
+            with transaction.atomic():
+                _write(period, entries, computed)
+        except IntegrityError:
+            # Параллельное обновление того же периода - его поправит
+            # следующее событие или плановый пересчет
+            pass
+
+
+def get_leaderboard(period):
+    """Новости рейтинга за период в порядке позиций"""
+    return Post.published.without_body().filter(leaderboard__period=period).order_by('leaderboard__position')
+
+
+def get_leaderboards():
+    """Контекст сайдбара: popular_day, popular_week, popular_month, popular_years"""
+    refresh_if_stale()
+    return {f'popular_{period}': get_leaderboard(period) for period in PERIODS}
+
+
+def check():
+    """
+    Сверяет сохраненные рейтинги с эталонным запросом.
+    Возвращает словарь период -> (сохраненные id, ожидаемые id) для расхождений.
+    """
+    mismatches = {}
+    for period in PERIODS:
+        stored = list(PopularPost.objects.filter(period=period).values_list('post_id', flat=True))
+        expected = list(live_queryset(period).values_list('pk', flat=True)[:LEADERBOARD_SIZE])
+        if stored != expected:
+            mismatches[period] = (stored, expected)
+    return mismatches
@@ -0,0 +1,43 @@
+import statistics
+import time
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext
+
+from news.comments import build_comment_tree
+from news.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Замеряет сборку и рендер дерева комментариев новости'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slug', help='Новость (по умолчанию - с наибольшим числом комментариев)')
+        parser.add_argument('--user', help='Имя пользователя, чьи голоса подгружаются')
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        if options['slug']:
+            post = Post.objects.filter(slug=options['slug']).first()
+        else:
+            post = Post.objects.annotate(total=Count('comment')).order_by('-total').first()
+        if post is None:
+            raise CommandError('Новость не найдена')
+        user = User.objects.get(username=options['user']) if options['user'] else AnonymousUser()
+
+        timings = []
+        for _ in range(options['repeat']):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                comments, count = build_comment_tree(post, user)
+                for comment in comments:
+                    render_to_string('includes/comment.html', {'comment': comment})
+                timings.append(time.perf_counter() - started)
+
+        self.stdout.write(f'{post.slug}: комментариев {count}, запросов {len(queries)}')
+        self.stdout.write(f'медиана {statistics.median(timings) * 1000:.1f} мс, '
+                          f'максимум {max(timings) * 1000:.1f} мс')
@@ -0,0 +1,28 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from news import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает два отчета bench_views; завершается с ошибкой при регрессии'
+
+    def add_arguments(self, parser):
+        parser.add_argument('base', help='Отчет до изменений')
+        parser.add_argument('head', help='Отчет после изменений')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Допустимый рост задержки в долях (0.1 - 10%%)')
+
+    def handle(self, *args, **options):
+        reports = []
+        for path in (options['base'], options['head']):
+            with open(path, encoding='utf-8') as file:
+                reports.append(json.load(file))
+        rows, regressions = benchmarks.compare(*reports, threshold=options['threshold'])
+        for name, metric, before, after, change in rows:
+            self.stdout.write(f'{name:<20} {metric:<12} {before:>10} -> {after:>10}  {change:+.1%}')
+        if regressions:
+            raise CommandError('регрессии: ' + ', '.join(f'{name} {metric} {change:+.1%}'
+                                                        for name, metric, before, after, change in regressions))
+        self.stdout.write('регрессий нет')
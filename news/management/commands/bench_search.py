@@ -0,0 +1,53 @@
+import random
+import statistics
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from news import search
+from news.models import Post, SearchEntry
+
+WORDS = (
+    'doom death black thrash heavy metal album tour riff guitar drummer vocalist release festival '
+    'группа альбом тур концерт гитарист барабанщик вокалист релиз фестиваль музыка новость клип '
+    'сингл лейбл сцена звук запись студия'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Замеряет задержку полнотекстового поиска на сгенерированном корпусе (данные откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=10000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        content_type = ContentType.objects.get_for_model(Post)
+
+        def text(words):
+            return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+        with transaction.atomic():
+            # Синтетические документы не ссылаются на реальные объекты и удаляются откатом
+            start_id = 10 ** 9
+            entries = [SearchEntry(content_type=content_type, object_id=start_id + number,
+                                   title=text(6), body=text(300))
+                       for number in range(options['documents'])]
+            SearchEntry.objects.bulk_create(entries, batch_size=1000)
+
+            timings = []
+            for _ in range(options['queries']):
+                query = text(rng.randint(1, 3))
+                started = time.perf_counter()
+                search.ranked_ids(query, 20)
+                timings.append((time.perf_counter() - started) * 1000)
+            transaction.set_rollback(True)
+
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(f'документов {options["documents"]}, запросов {options["queries"]}')
+        self.stdout.write(f'p50 {statistics.median(timings):.2f} мс, p95 {p95:.2f} мс, максимум {timings[-1]:.2f} мс')
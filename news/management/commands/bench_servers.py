@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from news import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает пропускную способность и задержку страниц под WSGI и ASGI (асинхронные view) '
+            'при одновременных запросах; каждый режим - в отдельном процессе')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', action='append', choices=benchmarks.SERVER_MODES,
+                            help='Только указанные режимы (по умолчанию - оба)')
+        parser.add_argument('--concurrency', type=int, default=32, help='Одновременных запросов')
+        parser.add_argument('--requests', type=int, default=400, help='Запросов на сценарий')
+        parser.add_argument('--scenario', action='append', help='Только указанные сценарии (можно повторять)')
+        parser.add_argument('--output', help='Файл для отчета (по умолчанию - только таблица)')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--worker', action='store_true', help='Внутренний: один режим, отчет - JSON в stdout')
+
+    def handle(self, *args, **options):
+        modes = options['mode'] or benchmarks.SERVER_MODES
+        if options['worker']:
+            try:
+                report = benchmarks.serve(modes[0], concurrency=options['concurrency'], requests=options['requests'],
+                                          scenarios=options['scenario'], seed=options['seed'])
+            except ValueError as error:
+                raise CommandError(error)
+            self.stdout.write(json.dumps(report, ensure_ascii=False))
+            return
+
+        reports = {mode: self.run_worker(mode, options) for mode in modes}
+        for mode, report in reports.items():
+            for name, result in report['scenarios'].items():
+                latency = result['latency_ms']
+                self.stdout.write(
+                    f'{mode:<5} {name:<14} {result["throughput_rps"]:>8.1f} rps  p50 {latency["p50"]:>8.2f}  '
+                    f'p95 {latency["p95"]:>8.2f}  p99 {latency["p99"]:>8.2f} мс  ошибок {result["errors"]}')
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(reports, file, ensure_ascii=False, indent=2, sort_keys=True)
+                file.write('\n')
+            self.stdout.write(f'отчет записан в {options["output"]}')
+
+    def run_worker(self, mode, options):
+        # Набор view выбирается при импорте urls, поэтому режим - отдельный процесс
+        command = [sys.executable, sys.argv[0], 'bench_servers', '--worker', '--mode', mode,
+                   '--concurrency', str(options['concurrency']), '--requests', str(options['requests']),
+                   '--seed', str(options['seed'])]
+        for scenario in options['scenario'] or ():
+            command += ['--scenario', scenario]
+        environment = dict(os.environ, NEWS_ASYNC_VIEWS='1' if mode == 'asgi' else '0')
+        process = subprocess.run(command, env=environment, capture_output=True, text=True)
+        if process.returncode:
+            raise CommandError(f'{mode}: {process.stderr.strip()}')
+        return json.loads(process.stdout)
@@ -0,0 +1,57 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.template.defaultfilters import slugify as django_slugify
+
+from news.models import Post
+from news.slugs import alphabet, assign_slugs, slugify, unique_slugs
+
+WORDS = (
+    'Doom Death Black Thrash Heavy Metal album tour riff guitar drummer vocalist release festival '
+    'Группа альбом тур концерт гитарист барабанщик вокалист релиз фестиваль музыка новость клип '
+    'сингл лейбл сцена звук запись студия Щелкунчик Ёлка Mötley Crüe'
+).split()
+
+
+def legacy_slugify(s):
+    # Посимвольная транслитерация, как было до таблицы str.translate
+    return django_slugify(''.join(alphabet.get(w, w) for w in s.lower()))
+
+
+class Command(BaseCommand):
+    help = 'Замеряет транслитерацию и подбор уникальных слагов на пачке заголовков (данные откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--titles', type=int, default=100000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def measure(self, name, func, count):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{name}: {elapsed:.2f} с ({count / elapsed:,.0f} заголовков/с)')
+        return result
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        count = options['titles']
+        # Небольшой словарь дает много одинаковых заголовков - проверяем и подбор суффиксов
+        titles = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))) for _ in range(count)]
+
+        legacy = self.measure('посимвольная транслитерация', lambda: [legacy_slugify(t) for t in titles], count)
+        current = self.measure('str.translate', lambda: [slugify(t) for t in titles], count)
+        if legacy != current:
+            self.stderr.write('Результаты транслитерации расходятся!')
+
+        slugs = self.measure('уникальные слаги (один запрос)', lambda: unique_slugs(Post, titles), count)
+        self.stdout.write(f'различных основ {len(set(current))}, слагов {len(set(slugs))} из {count}')
+
+        with transaction.atomic():
+            author = User.objects.create(username=f'bench-slugs-{time.time_ns()}')
+            posts = [Post(title=title[:200], content='', author=author) for title in titles]
+            self.measure('assign_slugs + bulk_create', lambda: Post.objects.bulk_create(
+                assign_slugs(posts, lambda post: post.title), batch_size=1000), count)
+            transaction.set_rollback(True)
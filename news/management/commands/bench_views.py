@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from news import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Замеряет задержку, пропускную способность и число запросов основных страниц; отчет - JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Запросов на сценарий')
+        parser.add_argument('--warmup', type=int, default=20, help='Незамеряемых запросов перед сценарием')
+        parser.add_argument('--scenario', action='append', help='Только указанные сценарии (можно повторять)')
+        parser.add_argument('--output', help='Файл для отчета (по умолчанию - только таблица)')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        def progress(name, result):
+            latency = result['latency_ms']
+            self.stdout.write(
+                f'{name:<20} {result["throughput_rps"]:>8.1f} rps  p50 {latency["p50"]:>7.2f}  '
+                f'p95 {latency["p95"]:>7.2f}  p99 {latency["p99"]:>7.2f} мс  '
+                f'запросов {result["queries"]["max"]:>3}  ошибок {result["errors"]}')
+
+        try:
+            report = benchmarks.run(requests=options['requests'], warmup=options['warmup'],
+                                    scenarios=options['scenario'], seed=options['seed'], progress=progress)
+        except ValueError as error:
+            raise CommandError(error)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(report, file, ensure_ascii=False, indent=2, sort_keys=True)
+                file.write('\n')
+            self.stdout.write(f'отчет записан в {options["output"]}')
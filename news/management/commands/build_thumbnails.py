@@ -0,0 +1,44 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from news import thumbnails
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+class Command(BaseCommand):
+    help = 'Создает недостающие уменьшенные копии изображений новостей, альбомов и групп'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Число процессов (по умолчанию - по числу ядер)')
+        parser.add_argument('--force', action='store_true', help='Пересоздать существующие варианты')
+        parser.add_argument('--media', action='store_true',
+                            help='Обойти весь каталог MEDIA_ROOT, а не только файлы из базы')
+
+    def media_names(self):
+        root = str(settings.MEDIA_ROOT)
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames[:] = [name for name in dirnames if name != 'thumbs']
+            for filename in filenames:
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.relpath(os.path.join(directory, filename), root).replace(os.sep, '/')
+
+    def handle(self, *args, **options):
+        names = sorted(self.media_names()) if options['media'] else thumbnails.stored_names()
+        started = time.perf_counter()
+        created = failed = 0
+        for name, count, error in thumbnails.generate_many(names, options['workers'], options['force']):
+            created += count
+            if error:
+                failed += 1
+                self.stderr.write(f'{name}: {error}')
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Изображений: {len(names)}, создано файлов: {created}, '
+                          f'{elapsed:.1f} с ({len(names) / elapsed if elapsed else 0:.1f} изобр./с)')
+        if failed:
+            raise CommandError(f'Не удалось обработать изображений: {failed}')
+        self.stdout.write(self.style.SUCCESS('Готово'))
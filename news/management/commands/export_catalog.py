@@ -0,0 +1,38 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from news import catalog
+
+
+class Command(BaseCommand):
+    help = 'Выгружает каталог (стили, лейблы, группы, альбомы) в JSON Lines или CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл для записи или "-" для stdout')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help='По умолчанию - по расширению файла')
+        parser.add_argument('--model', action='append', choices=list(catalog.MODELS),
+                            help='Выгрузить только эту модель (можно повторять; для CSV - ровно одна)')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        models = options['model']
+        if file_format == 'csv' and (not models or len(models) != 1):
+            raise CommandError('Для CSV укажите одну модель: --model band')
+
+        started = time.perf_counter()
+        records = catalog.export_records(models, options['chunk_size'])
+        stream = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        try:
+            if file_format == 'csv':
+                count = catalog.write_csv(records, stream, models[0])
+            else:
+                count = catalog.write_jsonl(records, stream)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        elapsed = time.perf_counter() - started
+        self.stderr.write(f'Записей: {count}, {elapsed:.1f} с ({count / elapsed if elapsed else 0:,.0f} строк/с)')
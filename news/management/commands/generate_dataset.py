@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from news import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Заполняет базу синтетическими данными для замеров (bench_views); --clear удаляет их'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=5000)
+        parser.add_argument('--comments', type=int, default=20, help='Среднее число комментариев на новость')
+        parser.add_argument('--bands', type=int, default=500)
+        parser.add_argument('--albums', type=int, default=3000)
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--votes', type=int, default=1000000)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--clear', action='store_true', help='Удалить сгенерированные данные')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['clear']:
+            benchmarks.clear()
+            self.stdout.write(f'данные удалены за {time.perf_counter() - started:.1f} с')
+            return
+        counts = benchmarks.generate(
+            posts=options['posts'], comments=options['comments'], bands=options['bands'],
+            albums=options['albums'], users=options['users'], votes=options['votes'], seed=options['seed'],
+            progress=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(', '.join(f'{name} {count}' for name, count in counts.items()))
+        self.stdout.write(f'готово за {time.perf_counter() - started:.1f} с')
@@ -0,0 +1,60 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from news import catalog, fragments, pagecache, ratings, search
+
+
+class Command(BaseCommand):
+    help = 'Загружает каталог (стили, лейблы, группы, альбомы) из JSON Lines или CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл или "-" для stdin')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help='По умолчанию - по расширению файла')
+        parser.add_argument('--model', choices=list(catalog.MODELS),
+                            help='Модель записей CSV (и JSON Lines без поля "model")')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--no-reindex', action='store_true',
+                            help='Не перестраивать поисковый индекс после импорта')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        if file_format == 'csv' and not options['model']:
+            raise CommandError('Для CSV укажите модель: --model band')
+
+        importer = catalog.CatalogImporter(options['batch_size'])
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+        try:
+            if file_format == 'csv':
+                rows = catalog.read_csv(stream, options['model'])
+            else:
+                rows = catalog.read_jsonl(stream, options['model'])
+            for number, model, record in rows:
+                importer.add(number, model, record)
+                if importer.rows % 100000 == 0:
+                    self.stderr.write(f'... {importer.rows} строк, {importer.rows_per_second:,.0f} строк/с')
+            importer.finish()
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for number, message in importer.errors[:50]:
+            self.stderr.write(f'строка {number}: {message}')
+        for model in catalog.MODELS:
+            if importer.created[model] or importer.updated[model]:
+                self.stdout.write(f'{model}: создано {importer.created[model]}, обновлено {importer.updated[model]}')
+        self.stdout.write(f'Строк: {importer.rows}, ошибок: {len(importer.errors)}, '
+                          f'{importer.rows_per_second:,.0f} строк/с')
+
+        # bulk-операции не отправляют сигналы - пересчитываем статистику,
+        # сбрасываем кэши и индекс сами
+        if importer.created['album'] or importer.updated['album']:
+            ratings.rebuild()
+        fragments.invalidate('albums')
+        pagecache.purge('lists')
+        if not options['no_reindex']:
+            search.rebuild()
+        if importer.errors:
+            raise CommandError(f'Строк с ошибками: {len(importer.errors)}')
+        self.stdout.write(self.style.SUCCESS('Готово'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from news import feeds
+from news.models import FeedSource
+
+
+class Command(BaseCommand):
+    help = 'Забирает новые записи из RSS/Atom-лент и сохраняет их черновиками новостей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', type=int, action='append',
+                            help='id ленты (можно повторять); по умолчанию - все активные')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Сколько лент скачивать одновременно')
+        parser.add_argument('--loop', type=int, default=None, metavar='SECONDS',
+                            help='Не завершаться, а опрашивать ленты с заданным интервалом')
+
+    def report(self, result):
+        for name, value in result.items():
+            if isinstance(value, int):
+                self.stdout.write(f'{name}: новых черновиков {value}')
+            else:
+                self.stderr.write(f'{name}: {value}')
+
+    def handle(self, *args, **options):
+        sources = None
+        if options['source']:
+            sources = FeedSource.objects.filter(pk__in=options['source'])
+        if options['loop']:
+            feeds.run_forever(options['loop'], sources, options['concurrency'], self.report)
+        self.report(feeds.ingest(sources, options['concurrency']))
+        self.stdout.write(self.style.SUCCESS('Готово'))
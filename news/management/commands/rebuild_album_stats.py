@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from news import fragments, pagecache, ratings
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает статистику альбомов и групп (рейтинг, голоса, отзывы) с нуля'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--check', action='store_true',
+                            help='Только сверить статистику с голосами и отзывами')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            mismatches = ratings.check()
+            for pk, stored, expected in mismatches[:50]:
+                self.stderr.write(f'альбом {pk}: сохранено {stored}, ожидается {expected}')
+            if mismatches:
+                raise CommandError(f'Статистика расходится у {len(mismatches)} альбомов')
+            self.stdout.write(self.style.SUCCESS('Статистика совпадает с голосами и отзывами'))
+            return
+
+        count = ratings.rebuild(options['batch_size'])
+        fragments.invalidate('albums')
+        pagecache.purge('lists')
+        self.stdout.write(self.style.SUCCESS(f'Статистика пересчитана: альбомов {count}'))
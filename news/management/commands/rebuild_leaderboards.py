@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from news import leaderboards
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает рейтинги популярных новостей с нуля'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', action='append', choices=list(leaderboards.PERIODS),
+                            help='Пересчитать только указанный период (можно повторять)')
+        parser.add_argument('--check', action='store_true',
+                            help='Только сверить сохраненные рейтинги с живым запросом')
+        parser.add_argument('--loop', type=int, default=None, metavar='SECONDS',
+                            help='Не завершаться, а пересчитывать рейтинги с заданным интервалом')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            mismatches = leaderboards.check()
+            for period, (stored, expected) in mismatches.items():
+                self.stderr.write(f'{period}: сохранено {stored}, ожидается {expected}')
+            if mismatches:
+                raise CommandError('Рейтинги расходятся с живым запросом')
+            self.stdout.write(self.style.SUCCESS('Рейтинги совпадают с живым запросом'))
+            return
+
+        if options['loop']:
+            leaderboards.run_forever(options['loop'], options['period'],
+                                     lambda: self.stdout.write('Рейтинги пересчитаны'))
+        leaderboards.rebuild(options['period'])
+        self.stdout.write(self.style.SUCCESS('Рейтинги пересчитаны'))
@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from news import related
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает похожие новости (по общим тегам и категориям) с нуля'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        count = related.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Похожие новости пересчитаны: новостей {count} за {time.perf_counter() - started:.1f} с'))
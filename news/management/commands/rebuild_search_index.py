@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from news import search
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает полнотекстовый индекс новостей, альбомов и групп'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        total = search.rebuild(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Проиндексировано документов: {total}'))
@@ -0,0 +1,29 @@
+import sqlite3
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from news import routers
+
+
+class Command(BaseCommand):
+    help = ('Копирует основную базу SQLite в реплики из DATABASE_REPLICAS - для проверки чтения '
+            'с реплик на одной машине (METALNEWS_LOCAL_REPLICA=1)')
+
+    def handle(self, *args, **options):
+        aliases = routers.replicas()
+        if not aliases:
+            raise CommandError('DATABASE_REPLICAS пуст - реплик нет')
+        source = connections[DEFAULT_DB_ALIAS]
+        for alias in [DEFAULT_DB_ALIAS, *aliases]:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f'{alias}: не SQLite - реплики PostgreSQL догоняет потоковая репликация')
+        source.ensure_connection()
+        for alias in aliases:
+            connections[alias].close()
+            target = sqlite3.connect(str(connections[alias].settings_dict['NAME']))
+            try:
+                source.connection.backup(target)
+            finally:
+                target.close()
+            self.stdout.write(self.style.SUCCESS(f'{alias}: скопирована из {DEFAULT_DB_ALIAS}'))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from news.votes import VOTABLE_MODELS, sync_vote_counters
+
+
+class Command(BaseCommand):
+    help = 'Заполняет/чинит денормализованные счетчики голосов по таблице LikeDislike'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append',
+                            choices=[model._meta.model_name for model in VOTABLE_MODELS],
+                            help='Обработать только указанную модель (можно повторять)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--check', action='store_true',
+                            help='Только найти расхождения, ничего не записывая')
+
+    def handle(self, *args, **options):
+        total = 0
+        for model in VOTABLE_MODELS:
+            if options['model'] and model._meta.model_name not in options['model']:
+                continue
+            fixed = sync_vote_counters(model, options['batch_size'], dry_run=options['check'])
+            total += fixed
+            self.stdout.write(f'{model._meta.verbose_name_plural}: расхождений {fixed}')
+        if options['check'] and total:
+            raise CommandError(f'Счетчики голосов расходятся у {total} объектов')
+        self.stdout.write(self.style.SUCCESS('Готово'))
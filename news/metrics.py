@@ -0,0 +1,283 @@
+"""
+Метрики запросов: число и время SQL, время рендеринга шаблонов и повторяющиеся
+запросы - по имени URL (news:post_list, news:post_detail, ...).
+
+metrics_middleware замеряет долю METRICS_SAMPLE_RATE запросов (0 - выключено,
+тогда middleware убирает себя из цепочки и ничего не стоит; 1 - каждый
+запрос) под WSGI и ASGI. Значения копятся в гистограммах в памяти процесса
+и отдаются в текстовом формате Prometheus по адресу /metrics/ - только
+сотрудникам, сборщику с токеном METRICS_TOKEN или адресам из
+METRICS_ALLOWED_IPS (can_read).
+
+Замеры запроса (Recorder) лежат в contextvar, который asgiref передает и в
+потоки sync_to_async - в том числе в пул news.asyncdb. SQL считает обертка
+execute_wrapper, которую получает каждое соединение с базой при открытии
+(connection_created), так что учитываются запросы из любого потока
+запроса. Время шаблонов считает бэкенд TimedTemplates (TEMPLATES в
+настройках) по верхнеуровневым render (вложенные include не считаются
+дважды). По тому же адресу отдаются размер и отставание буфера
+просмотров (news.counters).
+"""
+import asyncio
+import bisect
+import contextvars
+import hmac
+import random
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates, Template
+from django.utils.decorators import sync_and_async_middleware
+
+from news.counters import view_counter
+
+METRICS_SAMPLE_RATE = getattr(settings, 'METRICS_SAMPLE_RATE', 0)
+# Сколько самых частых повторяющихся запросов хранить на каждое имя URL
+METRICS_TOP_QUERIES = getattr(settings, 'METRICS_TOP_QUERIES', 5)
+METRICS_SQL_LABEL_LENGTH = 200
+
+# Имя метрики -> (описание, границы корзин гистограммы)
+HISTOGRAMS = {
+    'news_request_duration_seconds': (
+        'Время обработки запроса', (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)),
+    'news_request_sql_queries': (
+        'Число SQL-запросов на запрос', (1, 2, 5, 10, 20, 50, 100, 200, 500)),
+    'news_request_sql_seconds': (
+        'Суммарное время SQL на запрос', (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)),
+    'news_request_template_seconds': (
+        'Время рендеринга шаблонов на запрос', (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)),
+}
+
+# Буфер просмотров (news.counters): (метрика, тип, описание, ключ ViewCounter.stats)
+VIEW_COUNTER_METRICS = (
+    ('news_view_counter_pending_views', 'gauge', 'Просмотры, еще не записанные в базу', 'pending_views'),
+    ('news_view_counter_pending_posts', 'gauge', 'Новости с незаписанными просмотрами', 'pending_posts'),
+    ('news_view_counter_lag_seconds', 'gauge', 'Возраст самого старого незаписанного просмотра', 'lag_seconds'),
+    ('news_view_counter_flushed_views_total', 'counter', 'Записанные в базу просмотры', 'flushed_views'),
+    ('news_view_counter_flushes_total', 'counter', 'Записи буфера просмотров в базу', 'flushes'),
+    ('news_view_counter_failed_flushes_total', 'counter', 'Неудачные записи буфера просмотров', 'failed_flushes'),
+)
+
+_current = contextvars.ContextVar('news_metrics_recorder', default=None)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Гистограммы и повторяющиеся запросы по именам URL"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {name: {} for name in HISTOGRAMS}
+            self.duplicates = {}
+            self.sampled = 0
+
+    def record(self, view, recorder, duration):
+        values = {
+            'news_request_duration_seconds': duration,
+            'news_request_sql_queries': recorder.queries,
+            'news_request_sql_seconds': recorder.sql_time,
+            'news_request_template_seconds': recorder.template_time,
+        }
+        repeated = Counter({sql: count - 1 for sql, count in recorder.statements.items() if count > 1})
+        with self._lock:
+            self.sampled += 1
+            for name, value in values.items():
+                series = self.histograms[name]
+                if view not in series:
+                    series[view] = Histogram(HISTOGRAMS[name][1])
+                series[view].observe(value)
+            if repeated:
+                self.duplicates.setdefault(view, Counter()).update(repeated)
+
+    def top_duplicates(self, view, limit=METRICS_TOP_QUERIES):
+        with self._lock:
+            return self.duplicates.get(view, Counter()).most_common(limit)
+
+    def export(self):
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+        with self._lock:
+            for name, (description, buckets) in HISTOGRAMS.items():
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+                for view, histogram in sorted(self.histograms[name].items()):
+                    label = f'view="{_escape(view)}"'
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{label}}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{label}}} {histogram.count}')
+            lines += ['# HELP news_sql_duplicates_total Повторы одинаковых SQL-запросов в одном запросе',
+                      '# TYPE news_sql_duplicates_total counter']
+            for view, counter in sorted(self.duplicates.items()):
+                for sql, count in counter.most_common(METRICS_TOP_QUERIES):
+                    lines.append(f'news_sql_duplicates_total{{view="{_escape(view)}",'
+                                 f'sql="{_escape(sql[:METRICS_SQL_LABEL_LENGTH])}"}} {count}')
+            lines += ['# HELP news_requests_sampled_total Замеренные запросы',
+                      '# TYPE news_requests_sampled_total counter',
+                      f'news_requests_sampled_total {self.sampled}']
+        counter = view_counter.stats()
+        for name, kind, description, value in VIEW_COUNTER_METRICS:
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}', f'{name} {_format(counter[value])}']
+        return '\n'.join(lines) + '\n'
+
+
+def _format(value):
+    return f'{value:.3f}' if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+def can_read(request):
+    """Доступ к /metrics/: сотрудники, сборщик с токеном METRICS_TOKEN, адреса из METRICS_ALLOWED_IPS"""
+    if request.user.is_staff:
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', '').encode(),
+                                     f'Bearer {token}'.encode()):
+        return True
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ())
+
+
+class Recorder:
+    """Замеры одного запроса; SQL может идти из нескольких потоков сразу"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.sql_time += elapsed
+                self.queries += 1
+                # Параметры в sql не подставлены - одинаковые запросы с разными значениями совпадают
+                self.statements[sql] += 1
+
+
+def _record_query(execute, sql, params, many, context):
+    recorder = _current.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def _instrument(connection):
+    # В начало списка: execute_wrapper() снимает свою обертку с конца
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _record_query)
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    _instrument(connection)
+
+
+class TimedTemplate(Template):
+    """Шаблон бэкенда, время рендеринга которого попадает в замеры запроса"""
+
+    def render(self, context=None, request=None):
+        recorder = _current.get()
+        if recorder is None:
+            return super().render(context, request)
+        recorder.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            recorder.template_depth -= 1
+            if not recorder.template_depth:
+                recorder.template_time += time.perf_counter() - started
+
+
+class TimedTemplates(DjangoTemplates):
+    """Бэкенд шаблонов Django, замеряющий время рендеринга для /metrics/"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+def _begin():
+    recorder = Recorder()
+    return recorder, _current.set(recorder), time.perf_counter()
+
+
+def _finish(request, recorder, started):
+    match = request.resolver_match
+    registry.record(match.view_name if match else 'unresolved', recorder, time.perf_counter() - started)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Замеряет долю запросов (METRICS_SAMPLE_RATE) и пишет их в registry"""
+    sample_rate = getattr(settings, 'METRICS_SAMPLE_RATE', METRICS_SAMPLE_RATE)
+    if sample_rate <= 0:
+        raise MiddlewareNotUsed
+    connection_created.connect(_instrument_connection, dispatch_uid='news.metrics')
+    # Соединения, открытые до загрузки middleware (проверки при старте)
+    for connection in connections.all():
+        _instrument(connection)
+
+    def sampled():
+        return sample_rate >= 1 or random.random() < sample_rate
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            if not sampled():
+                return await get_response(request)
+            recorder, token, started = _begin()
+            try:
+                response = await get_response(request)
+            finally:
+                _current.reset(token)
+            _finish(request, recorder, started)
+            return response
+    else:
+        def middleware(request):
+            if not sampled():
+                return get_response(request)
+            recorder, token, started = _begin()
+            try:
+                response = get_response(request)
+            finally:
+                _current.reset(token)
+            _finish(request, recorder, started)
+            return response
+    return middleware
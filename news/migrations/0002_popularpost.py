@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-18 10:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularPost',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'День'), ('week', 'Неделя'), ('month', 'Месяц'), ('years', 'Все время')], max_length=10, verbose_name='Период')),
+                ('position', models.PositiveSmallIntegerField(verbose_name='Позиция')),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('rating', models.IntegerField(default=0)),
+                ('computed', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Пересчитан')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard', to='news.post', verbose_name='Новость')),
+            ],
+            options={
+                'verbose_name': 'Популярная новость',
+                'verbose_name_plural': 'Популярные новости',
+                'ordering': ('period', 'position'),
+                'unique_together': {('period', 'post')},
+            },
+        ),
+    ]
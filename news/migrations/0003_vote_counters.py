@@ -0,0 +1,91 @@
+# Generated by Django 3.2 on 2026-10-18 10:11
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_vote_counters(apps, schema_editor):
+    LikeDislike = apps.get_model('news', 'LikeDislike')
+    for model_name in ('post', 'comment', 'album', 'band'):
+        model = apps.get_model('news', model_name)
+        rows = LikeDislike.objects.filter(
+            content_type__app_label='news', content_type__model=model_name
+        ).values('object_id').annotate(
+            likes=Count('pk', filter=Q(vote__gt=0)),
+            dislikes=Count('pk', filter=Q(vote__lt=0)),
+            total=Sum('vote'),
+        ).order_by()
+        for row in rows:
+            model.objects.filter(pk=row['object_id']).update(
+                like_count=row['likes'], dislike_count=row['dislikes'], rating=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0002_popularpost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='dislike_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки'),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки'),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='rating',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='band',
+            name='dislike_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки'),
+        ),
+        migrations.AddField(
+            model_name='band',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки'),
+        ),
+        migrations.AddField(
+            model_name='band',
+            name='rating',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='dislike_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='rating',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='dislike_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Дизлайки'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Лайки'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='rating',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.RunPython(backfill_vote_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-18 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0003_vote_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-publish', '-id'], name='news_post_publish_id_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2 on 2026-10-18 10:17
+
+from django.db import migrations, models
+from django.db.models import Count, F, Max
+
+
+def remove_duplicate_votes(apps, schema_editor):
+    """Оставляет последний голос пользователя за объект и поправляет счетчики"""
+    LikeDislike = apps.get_model('news', 'LikeDislike')
+    duplicates = LikeDislike.objects.values('user', 'content_type', 'object_id').annotate(
+        total=Count('pk'), last=Max('pk')).filter(total__gt=1).order_by()
+    for group in duplicates:
+        extra = LikeDislike.objects.filter(
+            user=group['user'], content_type=group['content_type'], object_id=group['object_id'],
+        ).exclude(pk=group['last']).select_related('content_type')
+        for vote in extra:
+            if vote.content_type.app_label == 'news':
+                model = apps.get_model('news', vote.content_type.model)
+                counter = 'like_count' if vote.vote > 0 else 'dislike_count'
+                model.objects.filter(pk=vote.object_id).update(
+                    **{counter: F(counter) - 1, 'rating': F('rating') - vote.vote})
+            vote.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0004_post_publish_id_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_votes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='likedislike',
+            constraint=models.UniqueConstraint(fields=('user', 'content_type', 'object_id'), name='news_likedislike_unique_vote'),
+        ),
+    ]
@@ -0,0 +1,106 @@
+# Generated by Django 3.2 on 2026-10-18 10:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Полнотекстовый индекс поддерживается триггерами в самой базе:
+# в PostgreSQL - колонка tsvector (русская + английская конфигурации) с GIN-индексом,
+# в SQLite - FTS5-таблица поверх news_searchentry.
+POSTGRESQL_FORWARD = [
+    'ALTER TABLE news_searchentry ADD COLUMN search_vector tsvector',
+    'CREATE INDEX news_searchentry_vector_idx ON news_searchentry USING GIN (search_vector)',
+    """
+    CREATE FUNCTION news_searchentry_vector() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('russian', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector('russian', coalesce(NEW.body, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(NEW.body, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER news_searchentry_vector_update BEFORE INSERT OR UPDATE OF title, body
+    ON news_searchentry FOR EACH ROW EXECUTE PROCEDURE news_searchentry_vector()
+    """,
+]
+POSTGRESQL_BACKWARD = [
+    'DROP TRIGGER IF EXISTS news_searchentry_vector_update ON news_searchentry',
+    'DROP FUNCTION IF EXISTS news_searchentry_vector()',
+]
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE news_searchentry_fts USING fts5(
+        title, body, content='news_searchentry', content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER news_searchentry_fts_insert AFTER INSERT ON news_searchentry BEGIN
+        INSERT INTO news_searchentry_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END
+    """,
+    """
+    CREATE TRIGGER news_searchentry_fts_delete AFTER DELETE ON news_searchentry BEGIN
+        INSERT INTO news_searchentry_fts(news_searchentry_fts, rowid, title, body)
+        VALUES ('delete', old.id, old.title, old.body);
+    END
+    """,
+    """
+    CREATE TRIGGER news_searchentry_fts_update AFTER UPDATE ON news_searchentry BEGIN
+        INSERT INTO news_searchentry_fts(news_searchentry_fts, rowid, title, body)
+        VALUES ('delete', old.id, old.title, old.body);
+        INSERT INTO news_searchentry_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+    END
+    """,
+]
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS news_searchentry_fts_insert',
+    'DROP TRIGGER IF EXISTS news_searchentry_fts_delete',
+    'DROP TRIGGER IF EXISTS news_searchentry_fts_update',
+    'DROP TABLE IF EXISTS news_searchentry_fts',
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def create_fulltext_index(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRESQL_FORWARD, 'sqlite': SQLITE_FORWARD})
+
+
+def drop_fulltext_index(apps, schema_editor):
+    _run(schema_editor, {'postgresql': POSTGRESQL_BACKWARD, 'sqlite': SQLITE_BACKWARD})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('news', '0005_likedislike_unique_vote'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('title', models.CharField(max_length=400, verbose_name='Заголовок')),
+                ('body', models.TextField(blank=True, verbose_name='Текст без разметки')),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'verbose_name': 'Поисковый документ',
+                'verbose_name_plural': 'Поисковый индекс',
+                'unique_together': {('content_type', 'object_id')},
+            },
+        ),
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-18 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0006_searchentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, verbose_name='Обновлено'),
+        ),
+        migrations.AddField(
+            model_name='band',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, verbose_name='Обновлено'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.2 on 2026-10-18 10:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('news', '0007_album_band_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedSource',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='Название')),
+                ('url', models.CharField(max_length=500, unique=True, verbose_name='Адрес ленты')),
+                ('active', models.BooleanField(default=True, verbose_name='Опрашивать')),
+                ('etag', models.CharField(blank=True, editable=False, max_length=200)),
+                ('last_modified', models.CharField(blank=True, editable=False, max_length=100)),
+                ('checked', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Проверена')),
+                ('error', models.TextField(blank=True, editable=False, verbose_name='Ошибка')),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Автор новостей')),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='news.category', verbose_name='Категория новостей')),
+            ],
+            options={
+                'verbose_name': 'Лента новостей',
+                'verbose_name_plural': 'Ленты новостей',
+            },
+        ),
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('guid_hash', models.CharField(max_length=40, unique=True)),
+                ('link_hash', models.CharField(blank=True, db_index=True, max_length=40)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('post', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='news.post', verbose_name='Новость')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='news.feedsource', verbose_name='Лента')),
+            ],
+            options={
+                'verbose_name': 'Запись ленты',
+                'verbose_name_plural': 'Записи лент',
+            },
+        ),
+    ]
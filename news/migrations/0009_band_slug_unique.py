@@ -0,0 +1,39 @@
+# Generated by Django 3.2 on 2026-10-18 10:31
+
+from django.db import migrations, models
+
+
+def deduplicate_band_slugs(apps, schema_editor):
+    """Повторяющимся (и пустым) слагам групп добавляет суффиксы -2, -3, ..."""
+    Band = apps.get_model('news', 'Band')
+    taken = set()
+    duplicates = []
+    for band in Band.objects.order_by('pk').only('pk', 'slug'):
+        if band.slug and band.slug not in taken:
+            taken.add(band.slug)
+        else:
+            duplicates.append(band)
+    for band in duplicates:
+        base = (band.slug or f'band-{band.pk}')[:190]
+        slug, number = base, 1
+        while slug in taken:
+            number += 1
+            slug = f'{base}-{number}'
+        taken.add(slug)
+        Band.objects.filter(pk=band.pk).update(slug=slug)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0008_feeds'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_band_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='band',
+            name='slug',
+            field=models.SlugField(blank=True, max_length=200, unique=True),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 3.2 on 2026-10-18 10:52
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def fill_stats(apps, schema_editor):
+    """Статистика существующих альбомов и групп (то же, что news.ratings.rebuild)"""
+    Album = apps.get_model('news', 'Album')
+    Review = apps.get_model('news', 'Review')
+    AlbumStats = apps.get_model('news', 'AlbumStats')
+    BandStats = apps.get_model('news', 'BandStats')
+    reviews = {
+        row['album_id']: (row['review_count'], row['last_review'])
+        for row in Review.objects.values('album_id').annotate(
+            review_count=Count('pk'), last_review=Max('created')).order_by()
+    }
+    AlbumStats.objects.bulk_create([
+        AlbumStats(album_id=pk, band_id=band_id, like_count=likes, dislike_count=dislikes, rating=rating,
+                   review_count=reviews.get(pk, (0, None))[0], last_review=reviews.get(pk, (0, None))[1])
+        for pk, band_id, likes, dislikes, rating in Album.objects.values_list(
+            'pk', 'band_id', 'like_count', 'dislike_count', 'rating').iterator()
+    ], batch_size=2000)
+    BandStats.objects.bulk_create([
+        BandStats(band_id=row['band_id'], album_count=row['album_count'], rating=row['total_rating'],
+                  review_count=row['total_reviews'], last_review=row['last_review'])
+        for row in AlbumStats.objects.values('band_id').annotate(
+            album_count=Count('pk'), total_rating=Sum('rating'),
+            total_reviews=Sum('review_count'), last_review=Max('last_review')).order_by()
+    ], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0009_band_slug_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='Дата'),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='AlbumStats',
+            fields=[
+                ('album', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='news.album', verbose_name='Альбом')),
+                ('like_count', models.PositiveIntegerField(default=0, verbose_name='Лайки')),
+                ('dislike_count', models.PositiveIntegerField(default=0, verbose_name='Дизлайки')),
+                ('rating', models.IntegerField(default=0, verbose_name='Рейтинг')),
+                ('review_count', models.PositiveIntegerField(default=0, verbose_name='Отзывы')),
+                ('last_review', models.DateTimeField(blank=True, null=True, verbose_name='Последний отзыв')),
+                ('band', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='album_stats', to='news.band', verbose_name='Группа')),
+            ],
+            options={
+                'verbose_name': 'Статистика альбома',
+                'verbose_name_plural': 'Статистика альбомов',
+            },
+        ),
+        migrations.CreateModel(
+            name='BandStats',
+            fields=[
+                ('band', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='news.band', verbose_name='Группа')),
+                ('album_count', models.PositiveIntegerField(default=0, verbose_name='Альбомы')),
+                ('rating', models.IntegerField(default=0, verbose_name='Рейтинг альбомов')),
+                ('review_count', models.PositiveIntegerField(default=0, verbose_name='Отзывы')),
+                ('last_review', models.DateTimeField(blank=True, null=True, verbose_name='Последний отзыв')),
+            ],
+            options={
+                'verbose_name': 'Статистика группы',
+                'verbose_name_plural': 'Статистика групп',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='albumstats',
+            index=models.Index(fields=['-rating', '-review_count', '-album'], name='news_albumstats_top'),
+        ),
+        migrations.AddIndex(
+            model_name='bandstats',
+            index=models.Index(fields=['-rating', '-review_count', '-band'], name='news_bandstats_top'),
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
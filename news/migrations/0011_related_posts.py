@@ -0,0 +1,30 @@
+# Generated by Django 3.2 on 2026-10-18 11:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0010_album_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedPost',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField(verbose_name='Позиция')),
+                ('score', models.FloatField(verbose_name='Сходство')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_posts', to='news.post', verbose_name='Новость')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_to', to='news.post', verbose_name='Похожая новость')),
+            ],
+            options={
+                'verbose_name': 'Похожая новость',
+                'verbose_name_plural': 'Похожие новости',
+                'ordering': ('post', 'position'),
+                'unique_together': {('post', 'position')},
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0011_related_posts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(status='published'), fields=['-publish', '-id'], name='news_post_published_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(status='published'), fields=['-views', '-rating', '-id'], name='news_post_popular_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(status='published'), fields=['created'], name='news_post_published_created'),
+        ),
+    ]
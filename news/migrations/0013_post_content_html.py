@@ -0,0 +1,39 @@
+# Generated by Django 3.2 on 2026-10-18 11:35
+
+from django.db import migrations, models
+
+from news import richtext
+
+
+def prepare_content(apps, schema_editor):
+    """Очищенный HTML и анонсы существующих новостей"""
+    Post = apps.get_model('news', 'Post')
+    batch = []
+    for post in Post.objects.order_by('pk').only('pk', 'content').iterator(chunk_size=500):
+        richtext.prepare(post)
+        batch.append(post)
+        if len(batch) >= 500:
+            Post.objects.bulk_update(batch, ['content_html', 'excerpt'])
+            batch = []
+    Post.objects.bulk_update(batch, ['content_html', 'excerpt'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0012_post_published_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='content_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='Содержание для страницы'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='excerpt',
+            field=models.CharField(blank=True, editable=False, max_length=400, verbose_name='Анонс'),
+        ),
+        migrations.RunPython(prepare_content, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-18 11:49
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0013_post_content_html'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='post',
+            name='news_post_publish_id_idx',
+        ),
+    ]
@@ -1,24 +1,17 @@
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
-from django.template.defaultfilters import slugify as django_slugify
 from taggit.managers import TaggableManager
 
-alphabet = {'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'zh', 'з': 'z', 'и': 'i',
-            'й': 'j', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
-            'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ы': 'i', 'э': 'e', 'ю': 'yu',
-            'я': 'ya'}
-
-
-def slugify(s):
-    """
-    Overriding django slugify that allows to use russian words as well.
-    """
-    return django_slugify(''.join(alphabet.get(w, w) for w in s.lower()))
+from news import richtext
+# alphabet и slugify исторически импортируются из news.models
+from news.slugs import alphabet, slugify, unique_slug
 
 
 def get_covers_upload_path(instance, filename):
@@ -75,6 +68,22 @@ class LikeDislike(models.Model):
 
     objects = LikeDislikeManager()
 
+    class Meta:
+        constraints = [
+            # Один голос пользователя за объект; на нем держится news.votes.toggle_vote
+            models.UniqueConstraint(fields=['user', 'content_type', 'object_id'], name='news_likedislike_unique_vote'),
+        ]
+
+
+class VoteCounters(models.Model):
+    """Денормализованные счетчики голосов, обновляются вместе с LikeDislike"""
+    like_count = models.PositiveIntegerField('Лайки', default=0)
+    dislike_count = models.PositiveIntegerField('Дизлайки', default=0)
+    rating = models.IntegerField('Рейтинг', default=0)
+
+    class Meta:
+        abstract = True
+
 
 class Category(models.Model):
     name = models.CharField('Название', max_length=50)
@@ -86,7 +95,7 @@ class Category(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = slugify(self.name)
+            self.slug = unique_slug(self, self.name)
         super(Category, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -116,14 +125,49 @@ class Category(models.Model):
 #         return self.title
 
 
-class Post(models.Model):
+class PostQuerySet(models.QuerySet):
+
+    def published(self):
+        return self.filter(status='published')
+
+    def without_body(self):
+        """Без тела новости: спискам хватает заголовка и анонса"""
+        return self.defer('content', 'content_html')
+
+    def for_cards(self):
+        # Все, что карточка новости показывает в списках, - без запросов на каждую карточку.
+        # Число комментариев - подзапрос, а не JOIN с GROUP BY: так список идет
+        # по индексу (publish, id) и останавливается на LIMIT без сортировки
+        comments = (Comment.objects.filter(post=OuterRef('pk')).order_by().values('post')
+                    .annotate(total=Count('pk')).values('total'))
+        return self.without_body().prefetch_related('tags').annotate(
+            comment_count=Coalesce(Subquery(comments), 0)).order_by('-publish')
+
+
+class PublishedManager(models.Manager.from_queryset(PostQuerySet)):
+    """Только опубликованные новости - для публичных страниц"""
+
+    def get_queryset(self):
+        return super().get_queryset().published()
+
+
+class Post(VoteCounters):
     """Новость на сайте"""
     STATUS_CHOICES = (
         ('draft', 'Draft'),
         ('published', 'Published'),
     )
+    # Новость открывается по /<slug>/, поэтому ее слаг не может совпадать с
+    # первым сегментом других адресов сайта (news.urls, metalnews3.urls):
+    # /search/ или /top/ перекрыли бы такую новость
+    RESERVED_SLUGS = frozenset({'admin', 'album', 'category', 'ckeditor', 'comment', 'jet', 'media', 'metrics',
+                                'post', 'search', 'static', 'top'})
     title = models.CharField('Заголовок', max_length=200, db_index=True)
     content = models.TextField(verbose_name='Содержание')
+    # Считаются из content при сохранении (news.richtext): очищенный HTML для
+    # страницы новости и текстовый анонс для карточек
+    content_html = models.TextField('Содержание для страницы', blank=True, editable=False)
+    excerpt = models.CharField('Анонс', max_length=400, blank=True, editable=False)
     image = models.ImageField(upload_to='posts/%Y%m%d/', blank=True)
     author = models.ForeignKey(User, verbose_name='Автор', on_delete=models.CASCADE,
                                related_name='blog_posts')
@@ -138,17 +182,41 @@ class Post(models.Model):
     views = models.PositiveIntegerField(default=0)
     votes = GenericRelation(LikeDislike, related_query_name='posts')
 
+    objects = PostQuerySet.as_manager()
+    published = PublishedManager()
+
     class Meta:
         ordering = ('-publish',)
+        indexes = [
+            # Частичные индексы только по опубликованным новостям: списки
+            # (ключ keyset-пагинации) и рейтинги популярных читают их по
+            # порядку, не сортируя таблицу
+            models.Index(fields=['-publish', '-id'], name='news_post_published_idx',
+                         condition=models.Q(status='published')),
+            models.Index(fields=['-views', '-rating', '-id'], name='news_post_popular_idx',
+                         condition=models.Q(status='published')),
+            # Предыдущая и следующая новости на странице новости
+            models.Index(fields=['created'], name='news_post_published_created',
+                         condition=models.Q(status='published')),
+        ]
         verbose_name = 'Новость'
         verbose_name_plural = 'Новости'
 
     def __str__(self):
         return self.title
 
+    def clean(self):
+        if self.slug in self.RESERVED_SLUGS:
+            raise ValidationError({'slug': f'Адрес /{self.slug}/ занят разделом сайта'})
+
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = slugify(str(self.title))
+            self.slug = unique_slug(self, str(self.title))
+        update_fields = kwargs.get('update_fields')
+        if 'content' not in self.get_deferred_fields() and (update_fields is None or 'content' in update_fields):
+            richtext.prepare(self)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'content_html', 'excerpt'}
         super(Post, self).save(*args, **kwargs)
 
     def get_absolute_url(self):
@@ -158,12 +226,56 @@ class Post(models.Model):
         return self.comment_set.filter(parent__isnull=True)
 
 
+class PopularPost(models.Model):
+    """Предрассчитанный рейтинг популярных новостей для сайдбара"""
+    PERIOD_CHOICES = (
+        ('day', 'День'),
+        ('week', 'Неделя'),
+        ('month', 'Месяц'),
+        ('years', 'Все время'),
+    )
+    period = models.CharField('Период', max_length=10, choices=PERIOD_CHOICES)
+    position = models.PositiveSmallIntegerField('Позиция')
+    post = models.ForeignKey(Post, verbose_name='Новость', on_delete=models.CASCADE,
+                             related_name='leaderboard')
+    views = models.PositiveIntegerField(default=0)
+    rating = models.IntegerField(default=0)
+    computed = models.DateTimeField('Пересчитан', default=timezone.now)
+
+    class Meta:
+        ordering = ('period', 'position')
+        unique_together = (('period', 'post'),)
+        verbose_name = 'Популярная новость'
+        verbose_name_plural = 'Популярные новости'
+
+    def __str__(self):
+        return f'{self.period} #{self.position} - {self.post}'
+
+
+class RelatedPost(models.Model):
+    """Предрассчитанная похожая новость (news.related): по общим тегам и категориям"""
+    post = models.ForeignKey(Post, verbose_name='Новость', on_delete=models.CASCADE, related_name='related_posts')
+    related = models.ForeignKey(Post, verbose_name='Похожая новость', on_delete=models.CASCADE,
+                                related_name='related_to')
+    position = models.PositiveSmallIntegerField('Позиция')
+    score = models.FloatField('Сходство')
+
+    class Meta:
+        ordering = ('post', 'position')
+        unique_together = (('post', 'position'),)
+        verbose_name = 'Похожая новость'
+        verbose_name_plural = 'Похожие новости'
+
+    def __str__(self):
+        return f'{self.post_id} #{self.position} - {self.related_id}'
+
+
 # class User(models.Model):
 #     """Пользователь"""
 #     pass
 
 
-class Comment(models.Model):
+class Comment(VoteCounters):
     """Комментарии к постам"""
 
     email = models.EmailField()
@@ -174,6 +286,7 @@ class Comment(models.Model):
     )
     post = models.ForeignKey(Post, verbose_name='Новость', on_delete=models.CASCADE)
     created = models.DateTimeField(auto_now_add=True, null=True)
+    updated = models.DateTimeField(auto_now=True, null=True)
     votes = GenericRelation(LikeDislike, related_query_name='comments')
 
     def __str__(self):
@@ -195,7 +308,7 @@ class MusicStyle(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = slugify(self.name)
+            self.slug = unique_slug(self, self.name)
         super(MusicStyle, self).save(*args, **kwargs)
 
     class Meta:
@@ -203,7 +316,7 @@ class MusicStyle(models.Model):
         verbose_name_plural = 'Музыкальные стили'
 
 
-class Band(models.Model):
+class Band(VoteCounters):
     """Группа/Исполнитель"""
 
     name = models.CharField('Название', max_length=200)
@@ -212,12 +325,13 @@ class Band(models.Model):
     country = models.CharField('Страна', max_length=100)
     styles = models.ManyToManyField(MusicStyle, verbose_name='Стили/Жанры',
                                     related_name='band_style')
-    slug = models.SlugField(max_length=200, blank=True)
+    slug = models.SlugField(max_length=200, blank=True, unique=True)
+    updated = models.DateTimeField('Обновлено', auto_now=True)
     votes = GenericRelation(LikeDislike, related_query_name='bands')
 
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = slugify(self.name)
+            self.slug = unique_slug(self, self.name)
         super(Band, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -241,7 +355,15 @@ class MusicLabel(models.Model):
         verbose_name_plural = 'Лейблы'
 
 
-class Album(models.Model):
+class AlbumQuerySet(models.QuerySet):
+
+    def for_cards(self):
+        # Группа, ее стили и число отзывов (из AlbumStats) для карточки альбома
+        return self.select_related('band').prefetch_related('band__styles').annotate(
+            review_count=Coalesce('stats__review_count', 0))
+
+
+class Album(VoteCounters):
     """Альбом"""
     name = models.CharField('Название', max_length=200, db_index=True)
     description = models.TextField(verbose_name='Описание')
@@ -251,12 +373,15 @@ class Album(models.Model):
     label = models.ForeignKey(MusicLabel, verbose_name='Лейбл', on_delete=models.CASCADE)
     cover = models.ImageField(verbose_name='Обложка', upload_to=get_covers_upload_path)
     slug = models.SlugField(max_length=160, unique=True, blank=True)
+    updated = models.DateTimeField('Обновлено', auto_now=True)
     votes = GenericRelation(LikeDislike, related_query_name='albums')
     tags = TaggableManager()
 
+    objects = AlbumQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = slugify(self.name + '-' + self.band.name)
+            self.slug = unique_slug(self, self.name + '-' + self.band.name)
         super(Album, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -281,6 +406,7 @@ class Review(models.Model):
         'self', verbose_name='Родитель', on_delete=models.SET_NULL, blank=True, null=True
     )
     album = models.ForeignKey(Album, verbose_name='Альбом', on_delete=models.CASCADE)
+    created = models.DateTimeField('Дата', auto_now_add=True)
 
     def __str__(self):
         return f'{self.user} - {self.album.name}'
@@ -288,3 +414,103 @@ class Review(models.Model):
     class Meta:
         verbose_name = 'Отзыв'
         verbose_name_plural = 'Отзывы'
+
+
+class AlbumStats(models.Model):
+    """
+    Материализованная статистика альбома (news.ratings): голоса и отзывы.
+    Группа продублирована, чтобы рейтинги по группе и стилю не читали альбомы.
+    """
+    album = models.OneToOneField(Album, verbose_name='Альбом', on_delete=models.CASCADE,
+                                 primary_key=True, related_name='stats')
+    band = models.ForeignKey(Band, verbose_name='Группа', on_delete=models.CASCADE, related_name='album_stats')
+    like_count = models.PositiveIntegerField('Лайки', default=0)
+    dislike_count = models.PositiveIntegerField('Дизлайки', default=0)
+    rating = models.IntegerField('Рейтинг', default=0)
+    review_count = models.PositiveIntegerField('Отзывы', default=0)
+    last_review = models.DateTimeField('Последний отзыв', null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-rating', '-review_count', '-album'], name='news_albumstats_top'),
+        ]
+        verbose_name = 'Статистика альбома'
+        verbose_name_plural = 'Статистика альбомов'
+
+    def __str__(self):
+        return f'{self.album_id}: {self.rating}'
+
+
+class BandStats(models.Model):
+    """Сумма статистики альбомов группы, для рейтинга групп (news.ratings)"""
+    band = models.OneToOneField(Band, verbose_name='Группа', on_delete=models.CASCADE,
+                                primary_key=True, related_name='stats')
+    album_count = models.PositiveIntegerField('Альбомы', default=0)
+    rating = models.IntegerField('Рейтинг альбомов', default=0)
+    review_count = models.PositiveIntegerField('Отзывы', default=0)
+    last_review = models.DateTimeField('Последний отзыв', null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-rating', '-review_count', '-band'], name='news_bandstats_top'),
+        ]
+        verbose_name = 'Статистика группы'
+        verbose_name_plural = 'Статистика групп'
+
+    def __str__(self):
+        return f'{self.band_id}: {self.rating}'
+
+
+class SearchEntry(models.Model):
+    """Документ полнотекстового поиска: новость, альбом или группа"""
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey()
+    title = models.CharField('Заголовок', max_length=400)
+    body = models.TextField('Текст без разметки', blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+        verbose_name = 'Поисковый документ'
+        verbose_name_plural = 'Поисковый индекс'
+
+    def __str__(self):
+        return self.title
+
+
+class FeedSource(models.Model):
+    """Внешняя RSS/Atom-лента, из которой забираются новости"""
+    name = models.CharField('Название', max_length=200)
+    url = models.CharField('Адрес ленты', max_length=500, unique=True)
+    author = models.ForeignKey(User, verbose_name='Автор новостей', on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, verbose_name='Категория новостей', on_delete=models.SET_NULL,
+                                 blank=True, null=True)
+    active = models.BooleanField('Опрашивать', default=True)
+    etag = models.CharField(max_length=200, blank=True, editable=False)
+    last_modified = models.CharField(max_length=100, blank=True, editable=False)
+    checked = models.DateTimeField('Проверена', blank=True, null=True, editable=False)
+    error = models.TextField('Ошибка', blank=True, editable=False)
+
+    class Meta:
+        verbose_name = 'Лента новостей'
+        verbose_name_plural = 'Ленты новостей'
+
+    def __str__(self):
+        return self.name
+
+
+class FeedEntry(models.Model):
+    """Запись ленты, уже превращенная в черновик новости (для отсева повторов)"""
+    source = models.ForeignKey(FeedSource, verbose_name='Лента', on_delete=models.CASCADE)
+    guid_hash = models.CharField(max_length=40, unique=True)
+    link_hash = models.CharField(max_length=40, db_index=True, blank=True)
+    post = models.ForeignKey(Post, verbose_name='Новость', on_delete=models.SET_NULL, blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи лент'
+
+    def __str__(self):
+        return f'{self.source} - {self.guid_hash}'
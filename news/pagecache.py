@@ -0,0 +1,216 @@
+"""
+Кэш целых страниц для анонимных читателей.
+
+Страница кэшируется по пути с параметрами пагинации и языку и относится к
+группам ('lists', 'posts', 'post:<slug>'); сигналы сбрасывают группы при
+публикации и изменении новостей, новых комментариях и голосах. Как и у
+фрагментов, сброс - это увеличение поколения группы, а не удаление записей.
+
+Устаревшая запись (истек срок или сменилось поколение) еще PAGE_CACHE_STALE
+секунд отдается остальным читателям, пока один запрос пересобирает страницу,
+так что истечение кэша не приводит к лавине одинаковых запросов к базе.
+
+CSRF-токены форм в закэшированный HTML не попадают: при отдаче страницы
+на их место подставляется токен текущего посетителя.
+"""
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+from functools import partial, wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template.response import SimpleTemplateResponse
+from django.utils import translation
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+from news import asyncdb, routers
+
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60)
+PAGE_CACHE_STALE = getattr(settings, 'PAGE_CACHE_STALE', 5 * 60)
+# Сколько ждать пересборки страницы другим запросом, прежде чем пересобрать самим
+PAGE_CACHE_LOCK_TIMEOUT = 30
+# Параметры запроса, по которым различаются страницы; с другими страница не кэшируется
+CACHED_QUERY_PARAMS = {'after', 'before'}
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control')
+
+_CSRF_INPUT_RE = re.compile(r'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+_CSRF_PLACEHOLDER = '\x00csrf\x00'
+
+_stats_lock = threading.Lock()
+_stats = Counter()
+
+
+def _generation_key(group):
+    return f'page-generation:{group}'
+
+
+def _generations(groups):
+    keys = [_generation_key(group) for group in groups]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            # Начальное поколение - текущее время: если ключ вытеснили из кэша,
+            # новое значение не совпадет ни с одним из старых
+            cache.add(key, int(time.time() * 1000), None)
+            found[key] = cache.get(key)
+    return tuple(found[key] for key in keys)
+
+
+def purge(*groups):
+    """Сбрасывает закэшированные страницы групп"""
+    for group in groups:
+        try:
+            cache.incr(_generation_key(group))
+        except ValueError:
+            pass
+
+
+def _page_key(request):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'page:{translation.get_language()}:{path}'
+
+
+def _cacheable_request(request):
+    # Недавно записавший посетитель читает с основной базы - и мимо кэша, чтобы увидеть свою запись
+    return (request.method in ('GET', 'HEAD') and not request.user.is_authenticated
+            and set(request.GET) <= CACHED_QUERY_PARAMS and not routers.is_pinned(request))
+
+
+def _make_entry(request, response, generations):
+    """Запись кэша из ответа или None, если ответ кэшировать нельзя"""
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return None
+    if isinstance(response, SimpleTemplateResponse):
+        response.render()
+    content = response.content.decode(response.charset)
+    if request.META.get('CSRF_COOKIE_USED'):
+        content, forms = _CSRF_INPUT_RE.subn(rf'\g<1>{_CSRF_PLACEHOLDER}\g<2>', content)
+        if not forms:
+            # Токен использован не в форме (например, в скрипте) - подставить его не сможем
+            return None
+    return {
+        'content': content,
+        'headers': {name: response[name] for name in CACHED_HEADERS if response.has_header(name)},
+        'meta': getattr(response, 'page_cache_meta', None),
+        'generations': generations,
+        'expires': time.time() + PAGE_CACHE_TIMEOUT,
+    }
+
+
+def _serve(request, entry, outcome):
+    content = entry['content']
+    if _CSRF_PLACEHOLDER in content:
+        content = content.replace(_CSRF_PLACEHOLDER, get_token(request))
+    response = HttpResponse(content)
+    for name, value in entry['headers'].items():
+        response[name] = value
+    response['X-Page-Cache'] = outcome
+    return get_conditional_response(
+        request, etag=response.get('ETag'),
+        last_modified=parse_http_date_safe(response.get('Last-Modified', '')), response=response,
+    )
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def _lookup(request, groups, kwargs, on_hit):
+    """
+    Ответ из кэша или (None, состояние промаха для _store и _release);
+    (None, None) - страницу кэшировать нельзя.
+    """
+    if not _cacheable_request(request):
+        _count('bypass')
+        return None, None
+
+    key = _page_key(request)
+    generations = _generations([group.format(**kwargs) for group in groups])
+    entry = cache.get(key)
+    if entry is not None:
+        fresh = entry['generations'] == generations and entry['expires'] > time.time()
+        # Устаревшую запись пересобирает только один запрос, остальные отдают ее как есть
+        if fresh or not cache.add(f'{key}:lock', 1, PAGE_CACHE_LOCK_TIMEOUT):
+            outcome = 'hit' if fresh else 'stale'
+            _count(outcome)
+            if on_hit is not None:
+                on_hit(request, entry['meta'])
+            return _serve(request, entry, outcome), None
+        locked = True
+    else:
+        locked = False
+    _count('miss')
+    return None, (key, generations, locked)
+
+
+def _store(request, response, state):
+    key, generations, locked = state
+    entry = _make_entry(request, response, generations)
+    if entry is not None:
+        cache.set(key, entry, PAGE_CACHE_TIMEOUT + PAGE_CACHE_STALE)
+    response['X-Page-Cache'] = 'miss'
+
+
+def _release(state):
+    key, generations, locked = state
+    if locked:
+        cache.delete(f'{key}:lock')
+
+
+def cache_anonymous(*groups, on_hit=None):
+    """
+    Кэширует страницы view для анонимных читателей.
+
+    groups - имена групп для сброса, в них подставляются аргументы URL:
+    cache_anonymous('posts', 'post:{slug}')(post_detail). on_hit(request, meta)
+    вызывается, когда страница отдана из кэша без вызова view; meta - значение
+    атрибута page_cache_meta ответа view (например, pk новости для счетчика).
+    Подходит и для асинхронных view: тогда работа с кэшем и сессией идет в
+    пуле потоков (news.asyncdb).
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                cached, state = await asyncdb.run(partial(_lookup, request, groups, kwargs, on_hit))
+                if cached is not None:
+                    return cached
+                if state is None:
+                    return await view(request, *args, **kwargs)
+                try:
+                    response = await view(request, *args, **kwargs)
+                    await asyncdb.run(partial(_store, request, response, state))
+                finally:
+                    await asyncdb.run(partial(_release, state))
+                return response
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            cached, state = _lookup(request, groups, kwargs, on_hit)
+            if cached is not None:
+                return cached
+            if state is None:
+                return view(request, *args, **kwargs)
+            try:
+                response = view(request, *args, **kwargs)
+                _store(request, response, state)
+            finally:
+                _release(state)
+            return response
+        return wrapper
+    return decorator
+
+
+def stats():
+    """Счетчики отдачи страниц: hit, stale, miss, bypass"""
+    with _stats_lock:
+        return dict(_stats)
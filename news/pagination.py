@@ -0,0 +1,111 @@
+"""
+Keyset-пагинация списков новостей по (publish, id).
+
+Вместо OFFSET и COUNT(*) страница выбирается условием "строго после/до
+курсора", поэтому стоимость любой страницы - O(размер страницы), а ссылки
+на глубокие страницы не "съезжают" при появлении новых новостей.
+"""
+import base64
+import binascii
+
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(obj):
+    raw = f'{obj.publish.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        publish, pk = raw.rsplit('|', 1)
+        publish = parse_datetime(publish)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        publish = None
+    if publish is None:
+        raise Http404('Неверный курсор страницы')
+    return publish, pk
+
+
+class KeysetPage:
+    """Страница keyset-пагинации, совместимая по интерфейсу с Page для шаблонов"""
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self._has_next and self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self._has_previous and self.object_list else None
+
+
+class KeysetPaginator:
+    """Пагинация queryset новостей от новых к старым по курсору (publish, id)"""
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def page(self, after=None, before=None):
+        if before:
+            publish, pk = decode_cursor(before)
+            queryset = self.queryset.filter(
+                Q(publish__gte=publish), Q(publish__gt=publish) | Q(pk__gt=pk)
+            ).order_by('publish', 'pk')
+        else:
+            queryset = self.queryset.order_by('-publish', '-pk')
+            if after:
+                publish, pk = decode_cursor(after)
+                # Условие на publish вынесено из OR, чтобы база начала чтение индекса с курсора
+                queryset = queryset.filter(Q(publish__lte=publish), Q(publish__lt=publish) | Q(pk__lt=pk))
+
+        # Лишняя строка показывает, есть ли что-то за пределами страницы
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if before:
+            rows.reverse()
+            return KeysetPage(rows, has_next=True, has_previous=has_more)
+        return KeysetPage(rows, has_next=has_more, has_previous=bool(after))
+
+
+class KeysetPaginationMixin:
+    """
+    Подменяет в ListView постраничный вывод с OFFSET/COUNT на keyset-пагинацию.
+    Номер страницы не используется: ссылки строятся по ?after=/?before= курсорам.
+    """
+    keyset_pagination = True
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super().paginate_queryset(queryset, page_size)
+        page = KeysetPaginator(queryset, page_size).page(
+            after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        return None, page, page.object_list, page.has_other_pages()
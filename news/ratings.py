@@ -0,0 +1,121 @@
+"""
+Материализованная статистика альбомов и групп (AlbumStats, BandStats).
+
+Карточки альбомов и рейтинги читают готовые строки статистики, а не
+агрегаты по LikeDislike и Review, так что "лучшие альбомы" и "лучшие группы
+стиля" выбираются по индексу на rating без сканирования голосов.
+
+Строка альбома пересчитывается целиком при голосе, отзыве или сохранении
+альбома: это пара запросов по индексам одного альбома, и ошибки не
+накапливаются, как у инкрементов. За ней пересчитывается строка группы.
+rebuild() (команда rebuild_album_stats) строит таблицы заново, например
+после импорта каталога, который не отправляет сигналы.
+"""
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Coalesce
+
+from news.models import Album, AlbumStats, Band, BandStats, Review
+
+TOP_SIZE = getattr(settings, 'TOP_ALBUMS_SIZE', 10)
+
+
+def _save(model, key, values):
+    """update_or_create, переживающий параллельное создание той же строки"""
+    try:
+        with transaction.atomic():
+            model.objects.update_or_create(defaults=values, **key)
+    except IntegrityError:
+        model.objects.filter(**key).update(**values)
+
+
+def refresh_band(band_id):
+    """Пересчитывает статистику группы по строкам статистики ее альбомов"""
+    if not Band.objects.filter(pk=band_id).exists():
+        return
+    totals = AlbumStats.objects.filter(band_id=band_id).aggregate(
+        album_count=Count('pk'),
+        rating=Coalesce(Sum('rating'), 0),
+        review_count=Coalesce(Sum('review_count'), 0),
+        last_review=Max('last_review'),
+    )
+    _save(BandStats, {'band_id': band_id}, totals)
+
+
+def refresh_album(album_id):
+    """Пересчитывает статистику альбома и его группы"""
+    album = Album.objects.filter(pk=album_id).values('band_id', 'like_count', 'dislike_count', 'rating').first()
+    if album is None:
+        # Строку альбома удалил каскад, группу пересчитывает сигнал удаления
+        return
+    previous_band_id = AlbumStats.objects.filter(pk=album_id).values_list('band_id', flat=True).first()
+    values = Review.objects.filter(album_id=album_id).aggregate(
+        review_count=Count('pk'), last_review=Max('created'))
+    values.update(album)
+    _save(AlbumStats, {'album_id': album_id}, values)
+    refresh_band(album['band_id'])
+    if previous_band_id and previous_band_id != album['band_id']:
+        refresh_band(previous_band_id)
+
+
+def rebuild(batch_size=2000):
+    """Полный пересчет статистики всех альбомов и групп; возвращает число альбомов"""
+    reviews = {
+        row['album_id']: (row['review_count'], row['last_review'])
+        for row in Review.objects.values('album_id').annotate(
+            review_count=Count('pk'), last_review=Max('created')).order_by()
+    }
+    count = 0
+    with transaction.atomic():
+        AlbumStats.objects.all().delete()
+        BandStats.objects.all().delete()
+        batch = []
+        for pk, band_id, likes, dislikes, rating in Album.objects.values_list(
+                'pk', 'band_id', 'like_count', 'dislike_count', 'rating').order_by('pk').iterator(batch_size):
+            review_count, last_review = reviews.get(pk, (0, None))
+            batch.append(AlbumStats(album_id=pk, band_id=band_id, like_count=likes, dislike_count=dislikes,
+                                    rating=rating, review_count=review_count, last_review=last_review))
+            if len(batch) >= batch_size:
+                AlbumStats.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        AlbumStats.objects.bulk_create(batch)
+        count += len(batch)
+        BandStats.objects.bulk_create([
+            BandStats(band_id=row['band_id'], album_count=row['album_count'], rating=row['total_rating'],
+                      review_count=row['total_reviews'], last_review=row['last_review'])
+            for row in AlbumStats.objects.values('band_id').annotate(
+                album_count=Count('pk'), total_rating=Sum('rating'),
+                total_reviews=Sum('review_count'), last_review=Max('last_review')).order_by().iterator()
+        ], batch_size=batch_size)
+    return count
+
+
+def top_albums(style=None, limit=TOP_SIZE):
+    """Альбомы с наибольшим рейтингом (style - слаг стиля группы)"""
+    queryset = Album.objects.for_cards().filter(stats__isnull=False)
+    if style:
+        queryset = queryset.filter(stats__band__styles__slug=style)
+    return queryset.order_by('-stats__rating', '-stats__review_count', '-stats__pk')[:limit]
+
+
+def top_bands(style=None, limit=TOP_SIZE):
+    """Группы с наибольшим суммарным рейтингом альбомов (style - слаг стиля)"""
+    queryset = Band.objects.select_related('stats').prefetch_related('styles').filter(stats__isnull=False)
+    if style:
+        queryset = queryset.filter(styles__slug=style)
+    return queryset.order_by('-stats__rating', '-stats__review_count', '-stats__pk')[:limit]
+
+
+def check():
+    """Альбомы, чья статистика расходится с голосами и отзывами: [(pk, сохранено, ожидается)]"""
+    reviews = dict(Review.objects.values('album_id').annotate(count=Count('pk'))
+                   .order_by().values_list('album_id', 'count'))
+    mismatches = []
+    for pk, rating, stored_rating, stored_reviews in Album.objects.values_list(
+            'pk', 'rating', 'stats__rating', 'stats__review_count').order_by('pk').iterator():
+        expected = (rating, reviews.get(pk, 0))
+        if (stored_rating, stored_reviews) != expected:
+            mismatches.append((pk, (stored_rating, stored_reviews), expected))
+    return mismatches
@@ -0,0 +1,235 @@
+"""
+Похожие новости по общим тегам и категориям.
+
+Новость - разреженный вектор признаков (теги и категории) с весами IDF:
+редкий тег говорит о сходстве больше, чем тег, который стоит у половины
+новостей, а категории весят меньше тегов. Сходство - косинус векторов.
+Кандидаты находятся по инвертированному индексу "признак -> новости", так
+что сравниваются только новости с общими признаками; признаки, которые есть
+больше чем у RELATED_MAX_POSTINGS новостей, кандидатов не порождают (их вес
+и так близок к нулю).
+
+Лучшие RELATED_POSTS_SIZE новостей хранятся в RelatedPost, и страница
+новости читает их одним запросом по индексу. При изменении тегов, категорий
+или статуса новости пересчитываются ее список и списки новостей, в которые
+она входит или теперь может войти (update_post). Веса IDF со временем
+дрейфуют - их выравнивает полный пересчет (rebuild, команда
+rebuild_related_posts).
+"""
+import heapq
+import math
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Count, Q, Subquery
+from taggit.models import TaggedItem
+
+from news.models import Post, RelatedPost
+
+RELATED_POSTS_SIZE = getattr(settings, 'RELATED_POSTS_SIZE', 4)
+RELATED_MAX_POSTINGS = getattr(settings, 'RELATED_MAX_POSTINGS', 500)
+# Вес категории относительно тега с той же частотой
+CATEGORY_WEIGHT = 0.5
+
+TAG, CATEGORY = 't', 'c'
+
+
+def _published():
+    return Post.published.values('pk')
+
+
+def _unpublished():
+    # Черновиков немного: "не черновик" позволяет идти по индексу tag_id,
+    # а не перебирать все опубликованные новости для каждого тега
+    return Post.objects.exclude(status='published').values('pk')
+
+
+def _tagged_items():
+    return TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Post))
+
+
+def _load_features(post_ids=None):
+    """Признаки опубликованных новостей: pk -> {(вид, id)}; post_ids=None - всех"""
+    tagged = _tagged_items().exclude(object_id__in=_unpublished())
+    categorized = Post.category.through.objects.filter(post__status='published')
+    if post_ids is not None:
+        tagged = tagged.filter(object_id__in=post_ids)
+        categorized = categorized.filter(post_id__in=post_ids)
+    features = {}
+    for post_id, tag_id in tagged.values_list('object_id', 'tag_id').iterator():
+        features.setdefault(post_id, set()).add((TAG, tag_id))
+    for post_id, category_id in categorized.values_list('post_id', 'category_id').iterator():
+        features.setdefault(post_id, set()).add((CATEGORY, category_id))
+    return features
+
+
+def _document_frequency(features):
+    """Число опубликованных новостей с каждым из признаков"""
+    tags = [value for kind, value in features if kind == TAG]
+    categories = [value for kind, value in features if kind == CATEGORY]
+    frequency = {}
+    if tags:
+        rows = (_tagged_items().filter(tag_id__in=tags).exclude(object_id__in=_unpublished())
+                .values('tag_id').annotate(total=Count('object_id')).order_by())
+        frequency.update(((TAG, row['tag_id']), row['total']) for row in rows)
+    if categories:
+        rows = (Post.category.through.objects.filter(category_id__in=categories, post__status='published')
+                .values('category_id').annotate(total=Count('post_id')).order_by())
+        frequency.update(((CATEGORY, row['category_id']), row['total']) for row in rows)
+    return frequency
+
+
+def _vector(features, frequency, total):
+    """Единичный вектор признаков с весами IDF"""
+    vector = {}
+    for feature in features:
+        weight = math.log((1 + total) / (1 + frequency.get(feature, 0))) + 1
+        vector[feature] = weight * CATEGORY_WEIGHT if feature[0] == CATEGORY else weight
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    return {feature: weight / norm for feature, weight in vector.items()}
+
+
+def _scores(post_id, vector, postings, vectors):
+    """Сходство новости с новостями, у которых есть общие признаки из postings"""
+    scores = {}
+    for feature, weight in vector.items():
+        for other_id in postings.get(feature, ()):
+            if other_id != post_id:
+                scores[other_id] = scores.get(other_id, 0) + weight * vectors[other_id][feature]
+    return scores
+
+
+def _top(post_id, vector, postings, vectors):
+    """Лучшие (сходство, pk) для новости"""
+    scores = _scores(post_id, vector, postings, vectors)
+    # Округление убирает разницу в последних битах от порядка сложения, чтобы
+    # полный и частичный пересчет одинаково упорядочивали равные сходства;
+    # при равном сходстве выше более новая (больший pk) новость
+    return heapq.nlargest(RELATED_POSTS_SIZE, ((round(score, 9), other_id) for other_id, score in scores.items()))
+
+
+def _postings(vectors, frequency):
+    postings = {}
+    for post_id, vector in vectors.items():
+        for feature in vector:
+            if frequency.get(feature, 0) <= RELATED_MAX_POSTINGS:
+                postings.setdefault(feature, []).append(post_id)
+    return postings
+
+
+def _write(lists):
+    """Заменяет списки похожих новостей: {pk: [(сходство, pk похожей)]}"""
+    with transaction.atomic():
+        RelatedPost.objects.filter(post_id__in=list(lists)).delete()
+        RelatedPost.objects.bulk_create([
+            RelatedPost(post_id=post_id, related_id=related_id, position=position, score=score)
+            for post_id, top in lists.items()
+            for position, (score, related_id) in enumerate(top, start=1)
+        ], batch_size=1000)
+
+
+def rebuild():
+    """Полный пересчет похожих новостей в памяти; возвращает число новостей"""
+    features = _load_features()
+    frequency = {}
+    for post_features in features.values():
+        for feature in post_features:
+            frequency[feature] = frequency.get(feature, 0) + 1
+    total = _published().count()
+    vectors = {post_id: _vector(post_features, frequency, total) for post_id, post_features in features.items()}
+    postings = _postings(vectors, frequency)
+    lists = {post_id: _top(post_id, vector, postings, vectors) for post_id, vector in vectors.items()}
+    with transaction.atomic():
+        # Черновики и новости без признаков тоже теряют старые списки
+        RelatedPost.objects.exclude(post_id__in=list(lists)).delete()
+        _write(lists)
+    return len(lists)
+
+
+def _compute(post_ids):
+    """Точные списки похожих новостей для post_ids (по текущим весам)"""
+    features = _load_features(post_ids)
+    own = set().union(*features.values()) if features else set()
+    frequency = _document_frequency(own)
+    # Кандидаты - новости с общими не слишком частыми признаками
+    common = [feature for feature in own if frequency.get(feature, 0) <= RELATED_MAX_POSTINGS]
+    condition = Q(pk__in=[])
+    tags = [value for kind, value in common if kind == TAG]
+    categories = [value for kind, value in common if kind == CATEGORY]
+    if tags:
+        condition |= Q(pk__in=Subquery(_tagged_items().filter(tag_id__in=tags).values('object_id')))
+    if categories:
+        condition |= Q(category__in=categories)
+    candidate_ids = set(Post.published.filter(condition).values_list('pk', flat=True))
+    candidate_features = _load_features(candidate_ids | set(features))
+    frequency.update(_document_frequency(set().union(*candidate_features.values()) - own)
+                     if candidate_features else {})
+
+    total = _published().count()
+    vectors = {post_id: _vector(post_features, frequency, total)
+               for post_id, post_features in candidate_features.items()}
+    postings = _postings(vectors, frequency)
+    lists = {post_id: _top(post_id, vectors[post_id], postings, vectors) if post_id in vectors else []
+             for post_id in post_ids}
+    _write(lists)
+    return lists, vectors, postings
+
+
+def refresh(post_ids):
+    """Пересчитывает списки похожих новостей post_ids (например, после удаления новости из них)"""
+    _compute(list(post_ids))
+
+
+def update_post(post_id):
+    """
+    Пересчитывает похожие новости после изменения тегов, категорий или статуса
+    новости: ее список, списки, где она уже стоит, и списки, куда она теперь
+    проходит по сходству.
+
+    Если сходство с новостью не уменьшилось, ее достаточно вставить в чужой
+    список на нужное место. Пересчитывать список целиком нужно, только когда
+    новость в нем стояла и ее сходство упало: тогда на освободившееся место
+    может встать новость, которой в списке не было.
+    """
+    _, vectors, postings = _compute([post_id])
+    vector = vectors.get(post_id)
+    scores = {other_id: round(score, 9)
+              for other_id, score in _scores(post_id, vector, postings, vectors).items()} if vector else {}
+    stored = {}
+    for other_id, related_id, score in (RelatedPost.objects.filter(Q(related_id=post_id) | Q(post_id__in=list(scores)))
+                                        .order_by('position').values_list('post_id', 'related_id', 'score')):
+        stored.setdefault(other_id, []).append((score, related_id))
+
+    merged, recompute = {}, []
+    for other_id in set(stored) | set(scores):
+        top = stored.get(other_id, [])
+        old_score = next((score for score, related_id in top if related_id == post_id), None)
+        score = scores.get(other_id)
+        if old_score is not None and (score is None or score < old_score):
+            recompute.append(other_id)
+        elif score is not None and (old_score is not None or len(top) < RELATED_POSTS_SIZE
+                                    or (score, post_id) > min(top)):
+            others = [item for item in top if item[1] != post_id]
+            merged[other_id] = heapq.nlargest(RELATED_POSTS_SIZE, others + [(score, post_id)])
+    if merged:
+        _write(merged)
+    if recompute:
+        _compute(sorted(recompute))
+
+
+def get_related(post):
+    """Похожие новости в порядке сходства - один запрос по индексу"""
+    return (Post.objects.filter(related_to__post=post).order_by('related_to__position')
+            .only('pk', 'slug', 'title', 'publish'))
+
+
+def get_neighbours(post):
+    """Предыдущая и следующая (по времени создания) новости одним запросом"""
+    previous = Post.published.filter(created__lt=post.created).order_by('-created').values('pk')[:1]
+    following = Post.published.filter(created__gt=post.created).order_by('created').values('pk')[:1]
+    neighbours = {}
+    for neighbour in Post.objects.filter(Q(pk=Subquery(previous)) | Q(pk=Subquery(following))).only(
+            'pk', 'slug', 'title', 'created').order_by():
+        neighbours['previous' if neighbour.created < post.created else 'next'] = neighbour
+    return neighbours.get('previous'), neighbours.get('next')
@@ -0,0 +1,238 @@
+"""
+Обработка HTML новостей из CKEditor и лент.
+
+Post.content хранит HTML как есть, а страницы показывают то, что
+prepare() посчитал при сохранении новости: content_html - очищенную
+разметку и excerpt - текстовый анонс для карточек. Так шаблоны не
+разбирают HTML на каждом рендеринге, а списки не читают тело новости
+вовсе.
+
+Очистка - по белым спискам тегов и атрибутов (html.parser из
+стандартной библиотеки):
+
+- script, style, формы и другие активные элементы удаляются вместе с
+  содержимым, обработчики on* и ссылки javascript: - из атрибутов;
+- картинки и фреймы загружаются лениво (loading="lazy");
+- встраивания CKEditor (<oembed>, div data-oembed-url) превращаются во
+  фрейм плеера для известных сервисов и в ссылку для остальных; фреймы
+  остаются только с адресов EMBED_HOSTS.
+"""
+import html
+import re
+from html.parser import HTMLParser
+from urllib.parse import parse_qs, urlsplit
+
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+
+# Сколько слов анонса показывает карточка новости
+EXCERPT_WORDS = 10
+EXCERPT_LENGTH = 400
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'cite', 'code', 'div', 'em', 'figcaption', 'figure',
+    'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'iframe', 'img', 'li', 'ol', 'p', 'pre', 's', 'small', 'span',
+    'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+}
+# Удаляются вместе с содержимым
+DROPPED_TAGS = {'script', 'style', 'object', 'embed', 'applet', 'form', 'noscript', 'template', 'svg', 'math',
+                'head', 'title'}
+VOID_TAGS = {'br', 'hr', 'img'}
+# Блоки, которые по правилам HTML закрывают открытый абзац
+BLOCK_TAGS = {'blockquote', 'div', 'figure', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'ol', 'p', 'pre', 'table', 'ul'}
+ALLOWED_ATTRIBUTES = {
+    'a': {'href', 'title', 'target', 'rel'},
+    'img': {'src', 'alt', 'title', 'width', 'height'},
+    'iframe': {'src', 'width', 'height', 'title', 'allow', 'allowfullscreen', 'frameborder'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan', 'scope'},
+}
+COMMON_ATTRIBUTES = {'class', 'style'}
+URL_ATTRIBUTES = {'href', 'src'}
+URL_SCHEMES = {'', 'http', 'https', 'mailto'}
+# Свойства style, которые ставит CKEditor (выравнивание, размеры картинок)
+STYLE_PROPERTIES = {'text-align', 'width', 'height', 'float', 'margin', 'margin-left', 'margin-right',
+                    'border-width', 'border-style'}
+EMBED_HOSTS = {'www.youtube.com', 'youtube.com', 'www.youtube-nocookie.com', 'player.vimeo.com',
+               'bandcamp.com', 'w.soundcloud.com', 'open.spotify.com'}
+
+_SPACES_RE = re.compile(r'\s+')
+_SCRIPT_RE = re.compile(r'<(script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+_TAG_START_RE = re.compile(r'<')
+_STYLE_VALUE_RE = re.compile(r'^[\w\s.%#,-]*$')
+_YOUTUBE_ID_RE = re.compile(r'^[\w-]{6,20}$')
+
+
+def html_to_text(value):
+    """Текст без разметки CKEditor, скриптов и HTML-сущностей"""
+    value = _SCRIPT_RE.sub(' ', value or '')
+    # Пробел перед каждым тегом, чтобы слова соседних блоков не склеивались
+    value = strip_tags(_TAG_START_RE.sub(' <', value))
+    return _SPACES_RE.sub(' ', html.unescape(value)).strip()
+
+
+def _safe_url(value):
+    value = (value or '').strip()
+    try:
+        parts = urlsplit(value)
+    except ValueError:
+        return None
+    return value if parts.scheme.lower() in URL_SCHEMES else None
+
+
+def _clean_style(value):
+    declarations = []
+    for declaration in value.split(';'):
+        name, _, rule = declaration.partition(':')
+        name, rule = name.strip().lower(), rule.strip()
+        if name in STYLE_PROPERTIES and rule and _STYLE_VALUE_RE.match(rule):
+            declarations.append(f'{name}: {rule}')
+    return '; '.join(declarations)
+
+
+def embed_player(url):
+    """Адрес фрейма плеера для ссылки на YouTube или Vimeo, иначе None"""
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return None
+    host = parts.netloc.lower().split(':')[0]
+    path = parts.path.strip('/').split('/')
+    video = None
+    if host in ('youtube.com', 'www.youtube.com', 'm.youtube.com'):
+        if path[0] == 'watch':
+            video = parse_qs(parts.query).get('v', [None])[0]
+        elif path[0] in ('embed', 'shorts') and len(path) > 1:
+            video = path[1]
+    elif host == 'youtu.be':
+        video = path[0]
+    if video and _YOUTUBE_ID_RE.match(video):
+        return f'https://www.youtube-nocookie.com/embed/{video}'
+    if host in ('vimeo.com', 'www.vimeo.com') and path[-1].isdigit():
+        return f'https://player.vimeo.com/video/{path[-1]}'
+    return None
+
+
+class _Sanitizer(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.open_tags = []
+        # Глубина элемента, содержимое которого пропускается, и адрес встраивания
+        self.skip_depth = 0
+        self.embed_url = None
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if self.skip_depth:
+            if tag not in VOID_TAGS:
+                self.skip_depth += 1
+            return
+        embed_url = attributes.get('url') if tag == 'oembed' else attributes.get('data-oembed-url')
+        if tag == 'oembed' or embed_url:
+            self.embed_url = embed_url or ''
+            self.skip_depth = 1
+        elif tag in DROPPED_TAGS or (tag == 'iframe' and not self._embeddable(attributes.get('src'))):
+            self.skip_depth = 1
+        elif tag in ALLOWED_TAGS:
+            if tag in BLOCK_TAGS and 'p' in self.open_tags:
+                self.handle_endtag('p')
+            self.parts.append(self._tag(tag, attributes))
+            if tag not in VOID_TAGS:
+                self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS and (self.skip_depth or tag in self.open_tags):
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.skip_depth:
+            if tag in VOID_TAGS:
+                return
+            self.skip_depth -= 1
+            if not self.skip_depth and self.embed_url is not None:
+                self.parts.append(self._embed(self.embed_url))
+                self.embed_url = None
+            return
+        if tag in self.open_tags:
+            # Незакрытые вложенные теги закрываются вместе с внешним
+            while self.open_tags:
+                opened = self.open_tags.pop()
+                self.parts.append(f'</{opened}>')
+                if opened == tag:
+                    break
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(html.escape(data, quote=False))
+        elif self.embed_url == '':
+            # <oembed>адрес</oembed> плагина embedsemantic
+            self.embed_url = data.strip()
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self.parts.append(f'</{self.open_tags.pop()}>')
+        return ''.join(self.parts)
+
+    @staticmethod
+    def _embeddable(url):
+        url = _safe_url(url)
+        return bool(url) and urlsplit(url).netloc.lower() in EMBED_HOSTS
+
+    def _tag(self, tag, attributes):
+        allowed = ALLOWED_ATTRIBUTES.get(tag, set()) | COMMON_ATTRIBUTES
+        cleaned = {}
+        for name, value in attributes.items():
+            if name not in allowed:
+                continue
+            value = value or ''
+            if name in URL_ATTRIBUTES:
+                value = _safe_url(value)
+                if not value:
+                    continue
+            elif name == 'style':
+                value = _clean_style(value)
+                if not value:
+                    continue
+            cleaned[name] = value
+        if tag in ('img', 'iframe'):
+            cleaned['loading'] = 'lazy'
+        if tag == 'img':
+            cleaned['decoding'] = 'async'
+        if tag == 'a' and cleaned.get('target') == '_blank':
+            cleaned['rel'] = 'noopener noreferrer'
+        rendered = ''.join(f' {name}="{html.escape(value)}"' if value else f' {name}'
+                           for name, value in cleaned.items())
+        return f'<{tag}{rendered}>'
+
+    @staticmethod
+    def _embed(url):
+        player = embed_player(url)
+        if player:
+            return (f'<div class="embed"><iframe src="{html.escape(player)}" width="560" height="315" '
+                    f'allow="encrypted-media; picture-in-picture" allowfullscreen loading="lazy"></iframe></div>')
+        url = _safe_url(url)
+        if not url:
+            return ''
+        return f'<p><a href="{html.escape(url)}" rel="nofollow noopener" target="_blank">{html.escape(url)}</a></p>'
+
+
+def sanitize(value):
+    """Очищенный HTML новости: только разрешенные теги и атрибуты, ленивые картинки, плееры встраиваний"""
+    parser = _Sanitizer()
+    parser.feed(value or '')
+    return parser.close()
+
+
+def excerpt(value, words=EXCERPT_WORDS):
+    """Текстовый анонс: первые words слов HTML"""
+    return Truncator(Truncator(html_to_text(value)).words(words)).chars(EXCERPT_LENGTH)
+
+
+def prepare(post):
+    """Заполняет content_html и excerpt новости по ее content"""
+    post.content_html = sanitize(post.content)
+    post.excerpt = excerpt(post.content_html)
@@ -0,0 +1,110 @@
+"""
+Чтение с реплик, запись - в основную базу.
+
+ReplicaRouter отправляет запись в default, а чтение в GET-запросах - на
+случайную реплику из DATABASE_REPLICAS (алиасы из DATABASES). Реплики
+отстают от основной базы, поэтому на основной остается все, что должно
+видеть свежие данные:
+
+- чтение вне запросов (команды, задачи) и в запросах POST и других
+  изменяющих методов;
+- чтение внутри транзакции и после записи в том же запросе;
+- запросы посетителя, который недавно что-то записал (голос, комментарий,
+  вход): после изменяющего запроса с записью ответ ставит cookie
+  REPLICA_PIN_COOKIE на REPLICA_PIN_SECONDS, и пока она есть, его чтение
+  идет на основную базу, так что он сразу видит свой голос или комментарий.
+
+Состояние запроса хранит replica_middleware в contextvar, поэтому оно
+доходит и до потоков асинхронных view (news.asyncdb). Без DATABASE_REPLICAS
+все идет в default.
+"""
+import asyncio
+import contextvars
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.decorators import sync_and_async_middleware
+
+REPLICA_PIN_COOKIE = getattr(settings, 'REPLICA_PIN_COOKIE', 'pin_primary')
+# Сколько секунд после записи посетитель читает с основной базы - с запасом
+# больше обычного отставания реплик
+REPLICA_PIN_SECONDS = getattr(settings, 'REPLICA_PIN_SECONDS', 10)
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = contextvars.ContextVar('news_replica_state', default=None)
+
+
+class RequestState:
+    """Маршрутизация в рамках одного запроса"""
+
+    def __init__(self, use_replicas):
+        self.use_replicas = use_replicas
+        self.wrote = False
+
+
+def replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+
+def is_pinned(request):
+    """Посетитель недавно что-то записал и читает с основной базы"""
+    return REPLICA_PIN_COOKIE in request.COOKIES
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        aliases = replicas()
+        if state is None or not state.use_replicas or state.wrote or not aliases:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики - копии основной базы: объекты из них можно связывать
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def _begin(request):
+    state = RequestState(use_replicas=request.method in SAFE_METHODS and not is_pinned(request))
+    return state, _state.set(state)
+
+
+def _pin(request, response, state):
+    if state.wrote and request.method not in SAFE_METHODS:
+        response.set_cookie(REPLICA_PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+    return response
+
+
+@sync_and_async_middleware
+def replica_middleware(get_response):
+    """Включает чтение с реплик для запроса и закрепляет записавшего посетителя за основной базой"""
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            state, token = _begin(request)
+            try:
+                response = await get_response(request)
+            finally:
+                _state.reset(token)
+            return _pin(request, response, state)
+    else:
+        def middleware(request):
+            state, token = _begin(request)
+            try:
+                response = get_response(request)
+            finally:
+                _state.reset(token)
+            return _pin(request, response, state)
+    return middleware
@@ -0,0 +1,113 @@
+"""
+Полнотекстовый поиск по новостям, альбомам и группам.
+
+Документы хранятся в SearchEntry (HTML из Post.content вырезается при
+индексации) и обновляются сигналами при сохранении объектов. Сам индекс
+ведут триггеры базы (см. миграцию 0006_searchentry): tsvector с GIN в
+PostgreSQL и FTS5 в SQLite; на других базах поиск деградирует до icontains.
+"""
+import re
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Q
+
+from news.models import Post, Album, Band, SearchEntry
+from news.richtext import html_to_text
+
+SEARCH_MODELS = (Post, Album, Band)
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def document_for(obj):
+    """(заголовок, текст) документа или None, если объект не должен находиться поиском"""
+    if isinstance(obj, Post):
+        if obj.status != 'published':
+            return None
+        return obj.title, html_to_text(obj.content)
+    if isinstance(obj, Album):
+        return f'{obj.band.name} - {obj.name}', obj.description
+    if isinstance(obj, Band):
+        return obj.name, obj.description
+    return None
+
+
+def index_object(obj):
+    """Добавляет, обновляет или убирает объект из индекса"""
+    content_type = ContentType.objects.get_for_model(obj)
+    document = document_for(obj)
+    if document is None:
+        remove_object(obj)
+        return
+    title, body = document
+    SearchEntry.objects.update_or_create(
+        content_type=content_type, object_id=obj.pk, defaults={'title': title[:400], 'body': body})
+
+
+def remove_object(obj):
+    SearchEntry.objects.filter(content_type=ContentType.objects.get_for_model(obj), object_id=obj.pk).delete()
+
+
+def ranked_ids(query, limit):
+    """id документов SearchEntry по убыванию релевантности"""
+    words = _WORD_RE.findall(query)
+    if not words:
+        return []
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT id FROM news_searchentry, "
+                "(SELECT plainto_tsquery('russian', %s) || plainto_tsquery('english', %s) AS query) q "
+                "WHERE search_vector @@ q.query "
+                "ORDER BY ts_rank(search_vector, q.query) DESC, id DESC LIMIT %s",
+                [query, query, limit],
+            )
+        elif connection.vendor == 'sqlite':
+            # Каждое слово - отдельная фраза FTS5 с поиском по префиксу
+            match = ' '.join('"{}"*'.format(word.replace('"', '')) for word in words)
+            cursor.execute(
+                'SELECT rowid FROM news_searchentry_fts WHERE news_searchentry_fts MATCH %s '
+                'ORDER BY bm25(news_searchentry_fts, 10.0, 1.0), rowid DESC LIMIT %s',
+                [match, limit],
+            )
+        else:
+            condition = Q()
+            for word in words:
+                condition &= Q(title__icontains=word) | Q(body__icontains=word)
+            return list(SearchEntry.objects.filter(condition).order_by('-pk').values_list('pk', flat=True)[:limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search(query, limit=20):
+    """Найденные документы SearchEntry по убыванию релевантности, с content_object"""
+    ids = ranked_ids(query, limit)
+    entries = SearchEntry.objects.filter(pk__in=ids).select_related('content_type').prefetch_related(
+        'content_object')
+    by_id = {entry.pk: entry for entry in entries}
+    return [by_id[pk] for pk in ids if pk in by_id]
+
+
+def rebuild(batch_size=500):
+    """Перестраивает индекс целиком, возвращает число документов"""
+    total = 0
+    SearchEntry.objects.all().delete()
+    for model in SEARCH_MODELS:
+        content_type = ContentType.objects.get_for_model(model)
+        queryset = model.objects.order_by('pk')
+        if model is Album:
+            queryset = queryset.select_related('band')
+        batch = []
+        for obj in queryset.iterator(chunk_size=batch_size):
+            document = document_for(obj)
+            if document is None:
+                continue
+            batch.append(SearchEntry(content_type=content_type, object_id=obj.pk,
+                                     title=document[0][:400], body=document[1]))
+            if len(batch) >= batch_size:
+                SearchEntry.objects.bulk_create(batch)
+                total += len(batch)
+                batch = []
+        SearchEntry.objects.bulk_create(batch)
+        total += len(batch)
+    return total
@@ -0,0 +1,186 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+
+from news import categories, fragments, leaderboards, pagecache, ratings, related, search, thumbnails
+from news.models import Post, Category, Comment, Album, Band, Review, RelatedPost
+
+# Голос за объект поставлен, изменен или снят (после коммита).
+# Аргументы: sender - модель объекта, pk, user, old_vote, new_vote
+vote_changed = Signal()
+
+
+# Статистика пересчитывается раньше сброса кэшей (обработчики и колбэки
+# on_commit выполняются в порядке регистрации), чтобы пересобранная
+# карусель альбомов уже видела новые значения
+
+@receiver(post_save, sender=Album)
+def refresh_album_stats(sender, instance, **kwargs):
+    transaction.on_commit(lambda: ratings.refresh_album(instance.pk))
+
+
+@receiver(post_delete, sender=Album)
+def refresh_band_stats(sender, instance, **kwargs):
+    transaction.on_commit(lambda: ratings.refresh_band(instance.band_id))
+
+
+@receiver([post_save, post_delete], sender=Review)
+def refresh_review_stats(sender, instance, **kwargs):
+    transaction.on_commit(lambda: ratings.refresh_album(instance.album_id))
+
+
+@receiver(vote_changed, sender=Album)
+def refresh_vote_stats(sender, pk, **kwargs):
+    # vote_changed отправляется уже после коммита
+    ratings.refresh_album(pk)
+
+
+def invalidate_on_commit(*names):
+    # Сбрасываем после коммита, чтобы параллельный запрос не закэшировал
+    # фрагмент по еще не закоммиченным данным
+    transaction.on_commit(lambda: fragments.invalidate(*names))
+
+
+@receiver([post_save, post_delete], sender=Post)
+@receiver([post_save, post_delete], sender=Comment)
+def invalidate_sidebar(sender, **kwargs):
+    invalidate_on_commit('sidebar')
+
+
+@receiver([post_save, post_delete], sender=Album)
+@receiver([post_save, post_delete], sender=Band)
+@receiver([post_save, post_delete], sender=Review)
+def invalidate_albums(sender, **kwargs):
+    invalidate_on_commit('albums')
+
+
+@receiver(vote_changed)
+def invalidate_votes(sender, **kwargs):
+    # vote_changed отправляется уже после коммита
+    if sender is Post:
+        fragments.invalidate('sidebar')
+    elif sender is Album:
+        fragments.invalidate('albums')
+
+
+def purge_pages_on_commit(*groups):
+    transaction.on_commit(lambda: pagecache.purge(*groups))
+
+
+@receiver([post_save, post_delete], sender=Post)
+def purge_post_pages(sender, **kwargs):
+    # Заголовок новости виден в списках и в ссылках "назад/вперед" соседних новостей
+    purge_pages_on_commit('lists', 'posts')
+
+
+@receiver([post_save, post_delete], sender=Comment)
+def purge_comment_pages(sender, instance, **kwargs):
+    # Комментарий удаляется и каскадом вместе с новостью - тогда ее страницы сбросит purge_post_pages
+    slug = Post.objects.filter(pk=instance.post_id).values_list('slug', flat=True).first()
+    purge_pages_on_commit('lists', f'post:{slug}')
+
+
+@receiver([post_save, post_delete], sender=Album)
+@receiver([post_save, post_delete], sender=Band)
+@receiver([post_save, post_delete], sender=Review)
+def purge_album_pages(sender, **kwargs):
+    # Карусель альбомов на главной
+    purge_pages_on_commit('lists')
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_categories(sender, **kwargs):
+    # Название и слаг категории видны в адресах и на страницах списков
+    def invalidate():
+        categories.invalidate()
+        pagecache.purge('lists')
+    transaction.on_commit(invalidate)
+
+
+@receiver(vote_changed)
+def purge_vote_pages(sender, pk, **kwargs):
+    # Рейтинги новостей видны в списках, голоса за комментарии - только на странице новости
+    if sender is Post:
+        slug = Post.objects.filter(pk=pk).values_list('slug', flat=True).first()
+        pagecache.purge('lists', f'post:{slug}')
+    elif sender is Comment:
+        slug = Comment.objects.filter(pk=pk).values_list('post__slug', flat=True).first()
+        pagecache.purge(f'post:{slug}')
+    elif sender is Album:
+        pagecache.purge('lists')
+
+
+@receiver(post_save, sender=Post)
+def update_post_leaderboards(sender, instance, **kwargs):
+    # Публикация добавляет новость в рейтинги, снятие с публикации - убирает
+    transaction.on_commit(lambda: leaderboards.update_post(instance))
+
+
+@receiver(vote_changed, sender=Post)
+def update_leaderboards(sender, pk, **kwargs):
+    post = Post.objects.filter(pk=pk).only('pk', 'views', 'rating', 'publish', 'status').first()
+    if post is not None:
+        leaderboards.update_post(post)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Album)
+def update_search_index(sender, instance, **kwargs):
+    search.index_object(instance)
+
+
+@receiver(post_save, sender=Band)
+def update_band_search_index(sender, instance, **kwargs):
+    search.index_object(instance)
+    # Название группы входит в заголовок документа альбома
+    for album in instance.album_set.select_related('band'):
+        search.index_object(album)
+
+
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=Album)
+@receiver(post_delete, sender=Band)
+def remove_from_search_index(sender, instance, **kwargs):
+    search.remove_object(instance)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Album)
+@receiver(post_save, sender=Band)
+def build_thumbnails(sender, instance, **kwargs):
+    # Варианты строим после коммита: ошибка ресайза не должна откатывать сохранение
+    for model, field in thumbnails.IMAGE_FIELDS:
+        if sender is model:
+            image = getattr(instance, field)
+            if image:
+                transaction.on_commit(lambda name=image.name: thumbnails.generate(name))
+
+
+@receiver(post_save, sender=Post)
+def update_related_on_save(sender, instance, **kwargs):
+    # Публикация и снятие с публикации меняют списки похожих новостей
+    transaction.on_commit(lambda: related.update_post(instance.pk))
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+@receiver(m2m_changed, sender=Post.category.through)
+def update_related_on_features(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    # Через TaggedItem теги ставятся и альбомам, а категории можно менять со стороны категории
+    if isinstance(instance, Post):
+        post_ids = [instance.pk]
+    elif reverse and sender is Post.category.through:
+        post_ids = list(pk_set or ())
+    else:
+        return
+    for post_id in post_ids:
+        transaction.on_commit(lambda post_id=post_id: related.update_post(post_id))
+
+
+@receiver(pre_delete, sender=Post)
+def update_related_on_delete(sender, instance, **kwargs):
+    # Строки удаляемой новости уйдут каскадом - списки, где она стояла, пересчитываем
+    listed_in = list(RelatedPost.objects.filter(related=instance).values_list('post_id', flat=True))
+    if listed_in:
+        transaction.on_commit(lambda: related.refresh(listed_in))
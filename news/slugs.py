@@ -0,0 +1,122 @@
+"""
+Уникальные слаги для одиночных сохранений и пакетного импорта.
+
+Занятые слаги читаются одним запросом на всю пачку, конфликты разрешаются
+в памяти суффиксами -2, -3, ... - так слаги можно проставить объектам
+заранее и сохранить их через bulk_create. Слаги из RESERVED_SLUGS модели
+считаются занятыми всегда.
+"""
+import re
+import unicodedata
+
+from django.db.models import Q
+from django.template.defaultfilters import slugify as django_slugify
+
+alphabet = {'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'zh', 'з': 'z', 'и': 'i',
+            'й': 'j', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+            'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ы': 'i', 'э': 'e', 'ю': 'yu',
+            'я': 'ya'}
+
+_slug_separators = re.compile(r'[-\s]+')
+_not_slug_chars = re.compile(r'[^\w\s-]')
+
+
+def _ascii_slug_chars(char):
+    # То же, что django slugify делает с одним символом: NFKD, отбрасывание
+    # не-ASCII, нижний регистр и удаление недопустимых символов
+    value = unicodedata.normalize('NFKD', char).encode('ascii', 'ignore').decode('ascii')
+    return _not_slug_chars.sub('', value.lower()) or None
+
+
+# Таблица для str.translate: за один проход на C транслитерирует кириллицу,
+# сводит латиницу с диакритикой к ASCII и выбрасывает недопустимые символы.
+# Символы вне таблицы (например, иероглифы) обрабатывает сам django slugify.
+_translit_table = str.maketrans({
+    **{chr(code): _ascii_slug_chars(chr(code)) for code in range(0x2500)},
+    **alphabet,
+})
+
+
+def slugify(s):
+    """
+    Overriding django slugify that allows to use russian words as well.
+    """
+    value = s.lower().translate(_translit_table)
+    if not value.isascii():
+        return django_slugify(value)
+    # После транслитерации обычно остается ASCII - тогда unicode-нормализация не нужна
+    return _slug_separators.sub('-', value).strip('-_')
+
+
+# Пачки до этого размера ищут занятые слаги точечно (слаг или слаг-N),
+# большие - читают все слаги модели: один проход по индексу дешевле
+# запроса с тысячами условий
+TARGETED_QUERY_LIMIT = 200
+
+_SUFFIX_RE = re.compile(r'^(.*)-(\d+)$')
+
+
+def _taken_slugs(model, field, bases):
+    queryset = model._default_manager.order_by()
+    if len(bases) <= TARGETED_QUERY_LIMIT:
+        condition = Q(**{f'{field}__in': bases})
+        for base in bases:
+            condition |= Q(**{f'{field}__startswith': f'{base}-'})
+        queryset = queryset.filter(condition)
+    return set(queryset.values_list(field, flat=True).iterator())
+
+
+def unique_slugs(model, values, field='slug', exclude=(), taken=None):
+    """
+    Слаги для строк values, не занятые в model и не повторяющиеся внутри пачки
+    (порядок сохраняется). exclude - слаги, которые считаются свободными
+    (например, текущий слаг сохраняемого объекта).
+
+    taken - уже загруженное множество занятых слагов модели: тогда запроса
+    нет вовсе, а новые слаги добавляются в это множество (для импорта
+    из многих пачек подряд).
+    """
+    max_length = model._meta.get_field(field).max_length
+    bases = [slugify(value)[:max_length].strip('-') or model._meta.model_name for value in values]
+    # Следующий номер для каждой основы, чтобы тысячи одинаковых заголовков
+    # не перебирали суффиксы заново
+    next_number = {}
+    if taken is None:
+        taken = _taken_slugs(model, field, set(bases)) - set(exclude)
+        for slug in taken:
+            match = _SUFFIX_RE.match(slug)
+            if match:
+                base, number = match.groups()
+                next_number[base] = max(next_number.get(base, 2), int(number) + 1)
+
+    reserved = getattr(model, 'RESERVED_SLUGS', frozenset())
+    slugs = []
+    for base in bases:
+        slug = base
+        while slug in taken or slug in reserved:
+            number = next_number.get(base, 2)
+            next_number[base] = number + 1
+            suffix = f'-{number}'
+            slug = base[:max_length - len(suffix)].rstrip('-') + suffix
+        taken.add(slug)
+        slugs.append(slug)
+    return slugs
+
+
+def unique_slug(instance, value, field='slug'):
+    """Уникальный слаг для одного сохраняемого объекта"""
+    current = getattr(instance, field)
+    return unique_slugs(type(instance), [value], field, exclude=[current] if current else ())[0]
+
+
+def assign_slugs(objects, source, field='slug'):
+    """
+    Проставляет слаги объектам без слага перед bulk_create.
+    source(obj) - строка, из которой строится слаг (например, заголовок).
+    """
+    pending = [obj for obj in objects if not getattr(obj, field)]
+    if pending:
+        slugs = unique_slugs(type(pending[0]), [source(obj) for obj in pending], field)
+        for obj, slug in zip(pending, slugs):
+            setattr(obj, field, slug)
+    return objects
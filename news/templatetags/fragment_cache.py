@@ -0,0 +1,35 @@
+from django import template
+
+from news import fragments
+
+register = template.Library()
+
+
+class CachedFragmentNode(template.Node):
+
+    def __init__(self, nodelist, name, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        name = self.name.resolve(context)
+        vary_on = [value.resolve(context) for value in self.vary_on]
+        return fragments.get_or_render(name, vary_on, lambda: self.nodelist.render(context))
+
+
+@register.tag
+def cached_fragment(parser, token):
+    """
+    {% cached_fragment 'sidebar' category %}...{% endcached_fragment %}
+
+    Кэширует содержимое блока по имени фрагмента, переменным и языку;
+    сбрасывается сигналами через news.fragments.invalidate.
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(f'{bits[0]} требует имя фрагмента')
+    nodelist = parser.parse(('endcached_fragment',))
+    parser.delete_first_token()
+    return CachedFragmentNode(nodelist, parser.compile_filter(bits[1]),
+                              [parser.compile_filter(bit) for bit in bits[2:]])
@@ -1,10 +1,17 @@
 from django import template
 
+from news.models import LikeDislike
+from news.votes import get_vote_state
+
 register = template.Library()
 
 
 @register.filter
-def user_in(objects, user):
-    if user.is_authenticated:
-        return objects.filter(user=user).exists()
-    return False
+def liked_by(obj, user):
+    """{% if post|liked_by:user %} - голоса берутся из VoteState запроса"""
+    return get_vote_state(user).vote_for(obj) == LikeDislike.LIKE
+
+
+@register.filter
+def disliked_by(obj, user):
+    return get_vote_state(user).vote_for(obj) == LikeDislike.DISLIKE
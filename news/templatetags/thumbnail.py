@@ -0,0 +1,29 @@
+from django import template
+from django.utils.html import format_html
+
+from news import thumbnails
+
+register = template.Library()
+
+
+@register.filter
+def thumbnail(image, alias):
+    """
+    {{ post.image|thumbnail:'card' }} - URL уменьшенной WebP-копии изображения
+    (размеры в news.thumbnails.THUMBNAIL_SIZES)
+    """
+    return thumbnails.url(image, alias)
+
+
+@register.simple_tag
+def picture(image, alias, alt=''):
+    """
+    {% picture post.image 'hero' alt=post.title %} - <picture> с WebP
+    и JPEG для браузеров без WebP
+    """
+    if not image:
+        return ''
+    return format_html(
+        '<picture><source srcset="{}" type="image/webp"><img src="{}" alt="{}" loading="lazy"></picture>',
+        thumbnails.url(image, alias), thumbnails.url(image, alias, 'jpg'), alt,
+    )
@@ -1,3 +1,1482 @@
-from django.test import TestCase
+import asyncio
+import csv
+import datetime
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import requests
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed, ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.db.models import Count
+from django.http import Http404, HttpResponse
+from django.template import engines
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+from PIL import Image
+
+from news import (asyncdb, benchmarks, catalog, categories, feeds, fragments, leaderboards, metrics, pagecache, ratings,
+                  related, richtext, routers, search, thumbnails, views, votes)
+from news.comments import build_comment_tree
+from news.counters import ViewCounter, view_counter
+from news.pagination import encode_cursor
+from news.slugs import assign_slugs, unique_slugs
+from news.votes import get_vote_state, sync_vote_counters, toggle_vote
+from news.models import (Post, Category, Comment, Album, AlbumStats, Band, BandStats, MusicLabel, MusicStyle,
+                         Review, LikeDislike, FeedSource, FeedEntry, PopularPost, RelatedPost)
+
+
+@override_settings(VIEW_COUNTER_FLUSH_INTERVAL=0, LEADERBOARD_MAX_AGE=0)
+class NewsTestCase(TestCase):
+    """Общие фикстуры для тестов новостей"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='reader', password='secret')
+        cls.category = Category.objects.create(name='Новости')
+        cls.label = MusicLabel.objects.create(name='Peaceville', description='')
+        cls.style = MusicStyle.objects.create(name='Doom', description='')
+
+    def setUp(self):
+        cache.clear()
+        # Просмотры теста записываются до отката его транзакции и не переходят в следующий
+        self.addCleanup(view_counter.flush)
+
+    @classmethod
+    def create_post(cls, number, **kwargs):
+        kwargs.setdefault('status', 'published')
+        kwargs.setdefault('image', 'posts/test.jpg')
+        kwargs.setdefault('content', f'<p>Текст {number}</p>')
+        post = Post.objects.create(title=f'Новость {number}', author=cls.user, **kwargs)
+        post.tags.add('doom', f'tag-{number}')
+        post.category.add(cls.category)
+        Comment.objects.create(post=post, name='Гость', email='guest@example.com', text='Коммент')
+        return post
+
+    @classmethod
+    def create_album(cls, number):
+        band = Band.objects.create(name=f'Band {number}', description='', image='band/test.jpg', country='UK')
+        band.styles.add(cls.style)
+        album = Album.objects.create(name=f'Album {number}', description='', duration=datetime.timedelta(minutes=40),
+                                     release_date=datetime.date(1995, 1, 1), band=band, label=cls.label,
+                                     cover='covers/test.jpg')
+        Review.objects.create(user=cls.user, album=album, text='Отзыв')
+        return album
+
+
+class ListQueryCountTests(NewsTestCase):
+    """Число запросов списков не должно зависеть от количества карточек"""
+
+    def fill(self, count, start=0):
+        for number in range(start, start + count):
+            self.create_post(number)
+            self.create_album(number)
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertQueriesBounded(self, url):
+        self.fill(2)
+        self.count_queries(url)  # прогрев рейтингов и ContentType
+        small = self.count_queries(url)
+        self.fill(10, start=2)
+        self.assertEqual(self.count_queries(url), small)
+
+    def test_main_page(self):
+        self.assertQueriesBounded(reverse('news:post_list'))
+
+    def test_category_page(self):
+        self.assertQueriesBounded(reverse('news:category_post_list', args=[self.category.slug]))
+
+
+class KeysetPaginationTests(NewsTestCase):
+    """Keyset-пагинация списков без COUNT и OFFSET"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.posts = [cls.create_post(number) for number in range(20)]
+
+    def titles(self, response):
+        return [post.title for post in response.context['posts']]
+
+    def test_walk_forward_and_back(self):
+        url = reverse('news:category_post_list', args=[self.category.slug])
+        expected = [post.title for post in Post.objects.order_by('-publish', '-pk')]
+
+        first = self.client.get(url)
+        self.assertEqual(self.titles(first), expected[:15])
+        self.assertFalse(first.context['page_obj'].has_previous())
+
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(url, {'after': first.context['page_obj'].next_cursor})
+        self.assertEqual(self.titles(second), expected[15:])
+        self.assertFalse(second.context['page_obj'].has_next())
+        sql = ' '.join(query['sql'].upper() for query in queries)
+        self.assertNotIn('COUNT(*)', sql)
+        self.assertNotIn('OFFSET', sql)
+
+        back = self.client.get(url, {'before': second.context['page_obj'].previous_cursor})
+        self.assertEqual(self.titles(back), expected[:15])
+
+    def test_bad_cursor(self):
+        response = self.client.get(reverse('news:post_list'), {'after': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+class FragmentCacheTests(NewsTestCase):
+    """Кэш сайдбара и карусели альбомов"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.post = cls.create_post(1)
+        cls.create_album(1)
+
+    def sidebar_stats(self):
+        return fragments.stats().get('sidebar', {'hit': 0, 'miss': 0})
+
+    def test_hit_and_invalidation(self):
+        # Анонимам страница целиком отдается из кэша страниц, минуя фрагменты
+        self.client.force_login(self.user)
+        url = reverse('news:post_list')
+        before = self.sidebar_stats()
+        self.client.get(url)
+        self.client.get(url)
+        after = self.sidebar_stats()
+        self.assertEqual(after['miss'] - before['miss'], 1)
+        self.assertEqual(after['hit'] - before['hit'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(post=self.post, name='Новый', email='new@example.com', text='Свежий коммент')
+        response = self.client.get(url)
+        self.assertContains(response, 'Свежий коммент')
+        self.assertEqual(self.sidebar_stats()['miss'] - before['miss'], 2)
+
+    def test_varies_on_category(self):
+        before = self.sidebar_stats()
+        self.client.get(reverse('news:post_list'))
+        self.client.get(reverse('news:category_post_list', args=[self.category.slug]))
+        self.assertEqual(self.sidebar_stats()['miss'] - before['miss'], 2)
+
+    def test_evicted_generation(self):
+        # Вытесненное поколение не начинается заново и не воскрешает старые фрагменты
+        fragments.get_or_render('sidebar', ['a'], lambda: 'старый')
+        fragments.invalidate('sidebar')
+        self.assertEqual(fragments.get_or_render('sidebar', ['a'], lambda: 'новый'), 'новый')
+        cache.delete(fragments._generation_key('sidebar'))
+        self.assertEqual(fragments.get_or_render('sidebar', ['a'], lambda: 'свежий'), 'свежий')
+
+
+
+class CommentTreeTests(NewsTestCase):
+    """Дерево комментариев строится за фиксированное число запросов"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.post = cls.create_post(1)
+        cls.root = Comment.objects.get(post=cls.post)
+        parent = cls.root
+        for depth in range(1, 5):
+            parent = Comment.objects.create(post=cls.post, parent=parent, name='Гость', email='guest@example.com',
+                                            text=f'Ответ уровня {depth}')
+        cls.deepest = parent
+        Comment.objects.bulk_create([
+            Comment(post=cls.post, parent=cls.root, name='Гость', email='guest@example.com', text='Ответ')
+            for _ in range(2000)
+        ])
+        cls.deepest.votes.create(user=cls.user, vote=LikeDislike.LIKE)
+
+    def test_build_tree(self):
+        ContentType.objects.get_for_model(Comment)
+        with self.assertNumQueries(2):
+            roots, count = build_comment_tree(self.post, self.user)
+        self.assertEqual(count, 2005)
+        self.assertEqual(roots, [self.root])
+        node = roots[0]
+        for depth in range(1, 5):
+            node = node.replies[0]
+            self.assertEqual(node.depth, depth)
+        self.assertEqual(node, self.deepest)
+        self.assertEqual(get_vote_state(self.user).vote_for(node), LikeDislike.LIKE)
+        self.assertEqual(len(roots[0].replies), 2001)
+
+    def test_post_detail_renders_deep_replies(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.post.get_absolute_url())
+        self.assertContains(response, 'Ответ уровня 4')
+        self.assertContains(response, '2005 Комментов')
+
+
+class VoteStateTests(NewsTestCase):
+    """Голоса пользователя грузятся одним запросом на тип объектов"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.posts = [cls.create_post(number) for number in range(3)]
+        cls.comments = list(Comment.objects.all())
+        cls.posts[0].votes.create(user=cls.user, vote=LikeDislike.LIKE)
+        cls.comments[1].votes.create(user=cls.user, vote=LikeDislike.DISLIKE)
+
+    def test_preload(self):
+        ContentType.objects.get_for_models(Post, Comment)
+        state = get_vote_state(self.user)
+        with self.assertNumQueries(2):
+            state.preload(self.posts + self.comments)
+        with self.assertNumQueries(0):
+            self.assertEqual(state.vote_for(self.posts[0]), LikeDislike.LIKE)
+            self.assertIsNone(state.vote_for(self.posts[1]))
+            self.assertEqual(state.vote_for(self.comments[1]), LikeDislike.DISLIKE)
+
+    def test_post_detail_queries_do_not_grow_with_comments(self):
+        self.client.force_login(self.user)
+        post = self.posts[0]
+        url = post.get_absolute_url()
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(url)
+        for number in range(20):
+            Comment.objects.create(post=post, name='Гость', email='guest@example.com', text=f'Коммент {number}')
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(url)
+        self.assertEqual(len(large), len(small))
+
+
+class VoteCounterTests(NewsTestCase):
+    """Денормализованные счетчики голосов следуют за таблицей LikeDislike"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.post = cls.create_post(1)
+        cls.other = User.objects.create_user(username='metalhead')
+
+    def counters(self, obj):
+        obj.refresh_from_db(fields=['like_count', 'dislike_count', 'rating'])
+        return obj.like_count, obj.dislike_count, obj.rating
+
+    def test_vote_switch_unvote(self):
+        self.assertEqual(toggle_vote(Post, self.post.pk, self.user, LikeDislike.LIKE), (True, (1, 0, 1)))
+        self.assertEqual(toggle_vote(Post, self.post.pk, self.other, LikeDislike.LIKE), (True, (2, 0, 2)))
+        self.assertEqual(toggle_vote(Post, self.post.pk, self.user, LikeDislike.DISLIKE), (True, (1, 1, 0)))
+        self.assertEqual(toggle_vote(Post, self.post.pk, self.user, LikeDislike.DISLIKE), (False, (1, 0, 1)))
+        self.assertEqual(self.counters(self.post), (1, 0, 1))
+        self.assertEqual(self.post.votes.count(), 1)
+        self.assertEqual(sync_vote_counters(Post, dry_run=True), 0)
+        with self.assertRaises(Post.DoesNotExist):
+            toggle_vote(Post, 0, self.user, LikeDislike.LIKE)
+
+    def test_concurrent_unvote(self):
+        toggle_vote(Post, self.post.pk, self.user, LikeDislike.LIKE)
+        toggle_vote(Post, self.post.pk, self.other, LikeDislike.LIKE)
+        raced = []
+
+        def concurrent_unvote(execute, sql, params, many, context):
+            # Параллельный клик того же пользователя снимает голос между чтением и DELETE
+            if sql.startswith('DELETE FROM "news_likedislike"') and not raced:
+                raced.append(sql)
+                self.post.votes.filter(user=self.user)._raw_delete('default')
+                votes.apply_vote_delta(Post, self.post.pk, votes.vote_delta(LikeDislike.LIKE, None))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(concurrent_unvote):
+            toggle_vote(Post, self.post.pk, self.user, LikeDislike.LIKE)
+        self.assertTrue(raced)
+        # Наш DELETE ничего не удалил - голос вставлен заново и посчитан один раз
+        self.assertEqual(self.counters(self.post), (2, 0, 2))
+        self.assertEqual(self.post.votes.count(), 2)
+        self.assertEqual(sync_vote_counters(Post, dry_run=True), 0)
+
+    def test_delete_outside_toggle(self):
+        comment = Comment.objects.get(post=self.post)
+        toggle_vote(Post, self.post.pk, self.user, LikeDislike.LIKE)
+        toggle_vote(Post, self.post.pk, self.other, LikeDislike.DISLIKE)
+        toggle_vote(Comment, comment.pk, self.other, LikeDislike.LIKE)
+        # Удаление в админке
+        self.post.votes.get(user=self.user).delete()
+        self.assertEqual(self.counters(self.post), (0, 1, -1))
+        # Каскадом вместе с пользователем
+        self.other.delete()
+        self.assertEqual(self.counters(self.post), (0, 0, 0))
+        self.assertEqual(self.counters(comment), (0, 0, 0))
+        for model in (Post, Comment):
+            self.assertEqual(sync_vote_counters(model, dry_run=True), 0)
+
+    def test_sync_command(self):
+        toggle_vote(Post, self.post.pk, self.user, LikeDislike.LIKE)
+        Post.objects.filter(pk=self.post.pk).update(like_count=5, rating=-2)
+        with self.assertRaises(CommandError):
+            call_command('sync_vote_counters', '--check', stdout=io.StringIO())
+        # --check ничего не записывает
+        self.assertEqual(self.counters(self.post), (5, 0, -2))
+        call_command('sync_vote_counters', '--model', 'post', stdout=io.StringIO())
+        self.assertEqual(self.counters(self.post), (1, 0, 1))
+        out = io.StringIO()
+        call_command('sync_vote_counters', '--check', stdout=out)
+        self.assertIn('расхождений 0', out.getvalue())
+
+
+class VoteConcurrencyTests(TransactionTestCase):
+    """Параллельные клики не создают дублей голосов и не сбивают счетчики"""
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('SQLite в памяти не допускает параллельных писателей')
+
+    def test_hammer_toggle(self):
+        author = User.objects.create_user(username='author')
+        users = [User.objects.create_user(username=f'voter{number}') for number in range(4)]
+        post = Post.objects.create(title='Горячая новость', content='', author=author, image='posts/test.jpg')
+        choices = [LikeDislike.LIKE, LikeDislike.DISLIKE]
+        errors = []
+
+        def hammer(user, offset):
+            try:
+                for attempt in range(25):
+                    toggle_vote(Post, post.pk, user, choices[(attempt + offset) % 2])
+            except Exception as error:  # noqa: B902 - ошибка потока должна провалить тест
+                errors.append(error)
+            finally:
+                connection.close()
+
+        # По два потока на пользователя: конфликтуют и голоса одного пользователя, и счетчики новости
+        threads = [threading.Thread(target=hammer, args=(user, offset)) for user in users for offset in (0, 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        duplicates = LikeDislike.objects.values('user').annotate(total=Count('pk')).filter(total__gt=1)
+        self.assertFalse(duplicates.exists())
+        self.assertEqual(sync_vote_counters(Post, dry_run=True), 0)
+
+
+class SearchTests(NewsTestCase):
+    """Полнотекстовый поиск обновляется при сохранении объектов"""
+
+    def test_index_on_save(self):
+        post = self.create_post(1)
+        post.title = 'Cathedral возвращается'
+        post.content = '<p>Новый <b>альбом</b></p><script>spam()</script>'
+        post.save()
+        Post.objects.create(title='Cathedral в черновике', content='', author=self.user, image='posts/test.jpg')
+        album = self.create_album(1)
+
+        response = self.client.get(reverse('news:search'), {'q': 'cathedral'})
+        self.assertEqual([entry.content_object for entry in response.context['results']], [post])
+        self.assertEqual(search.search('альбом')[0].content_object, post)
+        self.assertEqual(search.search('spam'), [])
+        self.assertEqual([entry.content_object for entry in search.search('Album 1')], [album])
+
+        post.status = 'draft'
+        post.save()
+        self.assertEqual(search.search('cathedral'), [])
+
+
+class ThumbnailTests(NewsTestCase):
+    """Уменьшенные копии изображений создаются при загрузке и по первому запросу"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        thumbnails._ready.clear()
+
+    def upload(self, size=(1600, 900)):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, 'JPEG')
+        return SimpleUploadedFile('cover.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def test_generate_on_upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            post = self.create_post(1, image=self.upload())
+        name = thumbnails.variant_name(post.image.name, 'card')
+        self.assertEqual(name, f'{post.image.name.rsplit("/", 1)[0]}/thumbs/cover-480x440.webp')
+        with post.image.storage.open(name) as variant:
+            image = Image.open(variant)
+            self.assertEqual((image.format, image.size), ('WEBP', thumbnails.THUMBNAIL_SIZES['card']))
+        self.assertEqual(thumbnails.url(post.image, 'card'), post.image.storage.url(name))
+
+    def test_lazy_generation_and_fallback(self):
+        post = self.create_post(1, image=self.upload(size=(200, 100)))
+        name = thumbnails.variant_name(post.image.name, 'hero', 'jpg')
+        self.assertFalse(post.image.storage.exists(name))
+        self.assertEqual(thumbnails.url(post.image, 'hero', 'jpg'), post.image.storage.url(name))
+        with post.image.storage.open(name) as variant:
+            # Мелкий исходник обрезается под пропорции, но не растягивается
+            self.assertEqual(Image.open(variant).size, (195, 100))
+
+        post.image = 'posts/missing.jpg'
+        self.assertEqual(thumbnails.url(post.image, 'card'), post.image.url)
+        # Неудача запоминается: следующие рендеры не открывают исходник снова
+        with mock.patch('news.thumbnails.generate') as generate:
+            self.assertEqual(thumbnails.url(post.image, 'card'), post.image.url)
+        generate.assert_not_called()
+
+
+class ConditionalGetTests(NewsTestCase):
+    """Страницы новости и альбома отвечают 304, пока не изменились"""
+
+    def assertRevalidates(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        return response['ETag']
+
+    def test_post_detail(self):
+        post = self.create_post(1)
+        url = post.get_absolute_url()
+        etag = self.assertRevalidates(url)
+        # Просмотры считаются и для ответов 304
+        view_counter.flush()
+        post.refresh_from_db()
+        self.assertEqual(post.views, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(post=post, name='Гость', email='guest@example.com', text='Еще коммент')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.assertRevalidates(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            toggle_vote(Comment, post.comment_set.first().pk, self.user, LikeDislike.LIKE)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        def edit_comment():
+            comment = post.comment_set.get(text='Еще коммент')
+            comment.text = 'Исправленный коммент'
+            comment.save()
+
+        # Голос за новость, правка и удаление комментария не меняют дат новости
+        changes = [
+            lambda: toggle_vote(Post, post.pk, self.user, LikeDislike.DISLIKE),
+            edit_comment,
+            lambda: post.comment_set.filter(text='Исправленный коммент').delete(),
+        ]
+        for change in changes:
+            etag = self.assertRevalidates(url)
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        # Без Last-Modified запрос только с If-Modified-Since не получает 304
+        response = self.client.get(url)
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT').status_code, 200)
+
+        etag = self.assertRevalidates(url)
+        self.client.force_login(self.user)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_album_detail(self):
+        album = self.create_album(1)
+        url = album.get_absolute_url()
+        etag = self.assertRevalidates(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(user=self.user, album=album, text='Второй отзыв')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # Лейбл и стили группы выводятся на странице, но не меняют дат альбома и группы
+        changes = [
+            lambda: MusicLabel.objects.filter(pk=self.label.pk).update(name='Century Media'),
+            lambda: album.band.styles.add(MusicStyle.objects.create(name='Death', description='')),
+        ]
+        for change in changes:
+            etag = self.assertRevalidates(url)
+            change()
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get(reverse('news:album_detail', args=['missing'])).status_code, 404)
+
+
+class PageCacheTests(NewsTestCase):
+    """Кэш страниц для анонимных читателей"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.post = cls.create_post(1)
+
+    def test_anonymous_hit_and_purge(self):
+        url = reverse('news:post_list')
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url)['X-Page-Cache'], 'hit')
+        self.assertEqual(self.client.get(url, {'after': 'garbage'}).status_code, 404)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.objects.create(title='Свежая новость', content='', author=self.user, status='published',
+                                image='posts/test.jpg')
+        # После сброса один запрос пересобирает страницу, пока остальные получают прежнюю
+        lock = f'{pagecache._page_key(RequestFactory().get(url))}:lock'
+        cache.add(lock, 1)
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'stale')
+        cache.delete(lock)
+        response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Свежая новость')
+
+    def test_bypass_for_logged_in_users(self):
+        self.client.force_login(self.user)
+        url = reverse('news:post_list')
+        self.client.get(url)
+        self.assertNotIn('X-Page-Cache', self.client.get(url))
+
+    def test_post_detail_csrf_and_views(self):
+        url = self.post.get_absolute_url()
+        self.client.get(url)
+        self.client.cookies.clear()
+        response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        token = response.cookies['csrftoken'].value
+        self.assertContains(response, 'name="csrfmiddlewaretoken"')
+        self.assertNotContains(response, pagecache._CSRF_PLACEHOLDER)
+        view_counter.flush()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.views, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('news:add_comment', args=[self.post.slug]), {
+                'name': 'Гость', 'email': 'guest@example.com', 'text': 'Коммент из формы',
+                'csrfmiddlewaretoken': token,
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertContains(self.client.get(url), 'Коммент из формы')
+
+
+class FeedIngestionTests(NewsTestCase):
+    """Загрузка новостей из лент; HTTP подменяется файлами из fixtures/feeds"""
+
+    def setUp(self):
+        super().setUp()
+        self.requested = []
+        patcher = mock.patch('news.feeds.requests.get', side_effect=self.fake_get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_get(self, url, headers, timeout):
+        """Ответ ленты с ETag по имени файла и 304 на совпавший If-None-Match"""
+        self.requested.append(url)
+        path = os.path.join(os.path.dirname(__file__), 'fixtures', 'feeds', url.rsplit('/', 1)[-1])
+        if not os.path.exists(path):
+            raise requests.ConnectionError(f'Нет ответа от {url}')
+        etag = f'"{os.path.basename(path)}"'
+        if headers.get('If-None-Match') == etag:
+            return mock.Mock(status_code=304, headers={'ETag': etag}, content=b'')
+        with open(path, 'rb') as feed:
+            return mock.Mock(status_code=200, headers={'ETag': etag}, content=feed.read())
+
+    def add_source(self, name, filename):
+        return FeedSource.objects.create(name=name, url=f'https://feeds.example.com/{filename}', author=self.user,
+                                         category=self.category)
+
+    def test_ingest(self):
+        rss = self.add_source('Doom News', 'metal_rss.xml')
+        atom = self.add_source('Heavy Wire', 'metal_atom.xml')
+        Post.objects.create(title='Candlemass объявили тур', content='', author=self.user)
+
+        self.assertEqual(feeds.ingest(), {'Doom News': 2, 'Heavy Wire': 1})
+        drafts = Post.objects.filter(feedentry__isnull=False)
+        self.assertEqual(set(drafts.values_list('status', flat=True)), {'draft'})
+        self.assertEqual(sorted(drafts.values_list('slug', flat=True)), [
+            'candlemass-obyavili-tur-2', 'cathedral-pereizdadut-the-carnival-bizarre',
+            'rob-zombie-slipknot-i-mudvayne-na-odnoj-stsene',
+        ])
+        self.assertEqual(drafts.filter(category=self.category).count(), 3)
+
+        rss.refresh_from_db()
+        self.assertEqual(rss.etag, '"metal_rss.xml"')
+        # Неизменившиеся ленты отвечают 304, повторный запуск ничего не создает
+        self.assertEqual(feeds.ingest(), {'Doom News': 0, 'Heavy Wire': 0})
+        atom.etag = ''
+        atom.save()
+        self.assertEqual(feeds.ingest([atom]), {'Heavy Wire': 0})
+        self.assertEqual(FeedEntry.objects.count(), 3)
+
+    def test_duplicate_links_in_batch(self):
+        source = self.add_source('Doom News', 'metal_rss.xml')
+        entries = [
+            {'id': 'doom-1', 'link': 'https://doom.example.com/news/1', 'title': 'Cathedral вернулись'},
+            {'id': 'doom-1-repost', 'link': 'https://doom.example.com/news/1', 'title': 'Cathedral вернулись'},
+            {'id': 'doom-1', 'link': 'https://doom.example.com/news/1?utm=rss', 'title': 'Повтор по GUID'},
+        ]
+        self.assertEqual(feeds.save_entries(source, entries), 1)
+        self.assertEqual(FeedEntry.objects.count(), 1)
+
+    def test_concurrent_ingest(self):
+        rss = self.add_source('Doom News', 'metal_rss.xml')
+        assign_slugs_ = feeds.assign_slugs
+
+        def race(posts, title):
+            # Другой процесс сохраняет ту же запись между проверкой повторов и вставкой
+            FeedEntry.objects.create(source=rss, guid_hash=feeds._hash('doom-news-2'))
+            return assign_slugs_(posts, title)
+
+        with mock.patch('news.feeds.assign_slugs', side_effect=race):
+            self.assertIn('IntegrityError', feeds.ingest()['Doom News'])
+        rss.refresh_from_db()
+        self.assertEqual(rss.etag, '')
+        self.assertIn('IntegrityError', rss.error)
+        self.assertFalse(Post.objects.filter(feedentry__isnull=False).exists())
+        # ETag не запомнен, поэтому следующий опрос получает ленту целиком
+        self.assertEqual(feeds.ingest(), {'Doom News': 2})
+
+    def test_broken_source(self):
+        self.add_source('Пропавшая лента', 'missing.xml')
+        self.assertIn('ConnectionError', feeds.ingest()['Пропавшая лента'])
+
+    def test_only_http(self):
+        path = os.path.join(os.path.dirname(__file__), 'fixtures', 'feeds', 'metal_rss.xml')
+        FeedSource.objects.create(name='Файл', url=f'file://{path}', author=self.user)
+        self.assertIn('InvalidSchema', feeds.ingest()['Файл'])
+        self.assertEqual(self.requested, [])
+        self.assertFalse(FeedEntry.objects.exists())
+
+
+class SlugTests(NewsTestCase):
+    """Уникальные слаги при сохранении и пакетном импорте"""
+
+    def test_save_resolves_collisions(self):
+        first = Post.objects.create(title='Новый альбом', content='', author=self.user)
+        second = Post.objects.create(title='Новый альбом', content='', author=self.user)
+        self.assertEqual((first.slug, second.slug), ('novij-albom', 'novij-albom-2'))
+        bands = [Band.objects.create(name='Cathedral', description='', image='band/test.jpg') for _ in range(2)]
+        self.assertEqual([band.slug for band in bands], ['cathedral', 'cathedral-2'])
+
+    def test_batch(self):
+        for title in ('Doom', 'Doom', 'Doom'):
+            Post.objects.create(title=title, content='', author=self.user)
+        Post.objects.filter(slug='doom-2').delete()
+        with self.assertNumQueries(1):
+            slugs = unique_slugs(Post, ['Doom', 'Ёлка!', 'doom', 'Mötley Crüe'])
+        self.assertEqual(slugs, ['doom-4', 'yolka', 'doom-5', 'motley-crue'])
+
+        posts = assign_slugs([Post(title='Ёлка', content='', author=self.user) for _ in range(3)],
+                             lambda post: post.title)
+        Post.objects.bulk_create(posts)
+        self.assertEqual([post.slug for post in posts], ['yolka', 'yolka-2', 'yolka-3'])
+
+
+    def test_reserved_slugs(self):
+        post = Post.objects.create(title='Top', content='', author=self.user, status='published',
+                                   image='posts/test.jpg')
+        self.assertEqual(post.slug, 'top-2')
+        self.assertEqual(self.client.get(post.get_absolute_url()).status_code, 200)
+        posts = assign_slugs([Post(title='Search', content='', author=self.user)], lambda post: post.title)
+        self.assertEqual(posts[0].slug, 'search-2')
+        with self.assertRaises(ValidationError):
+            Post(title='Метрики', slug='metrics').clean()
+
+        # Зарезервирован первый сегмент каждого адреса сайта, кроме самой новости
+        def first_segments(patterns):
+            for pattern in patterns:
+                route = str(pattern.pattern)
+                if not route and hasattr(pattern, 'url_patterns'):
+                    yield from first_segments(pattern.url_patterns)
+                elif not route.startswith('<'):
+                    yield route.lstrip('^').split('/')[0]
+
+        self.assertLessEqual(set(first_segments(get_resolver().url_patterns)) - {''}, Post.RESERVED_SLUGS)
+
+
+class CatalogTests(NewsTestCase):
+    """Импорт и экспорт каталога пачками"""
+
+    RECORDS = [
+        {'model': 'style', 'slug': 'sludge', 'name': 'Sludge', 'description': ''},
+        {'model': 'label', 'name': 'Relapse', 'description': 'US'},
+        {'model': 'band', 'slug': 'eyehategod', 'name': 'Eyehategod', 'description': '', 'country': 'USA',
+         'image': 'band/ehg.jpg', 'styles': ['doom', 'sludge']},
+        {'model': 'album', 'name': 'Take as Needed for Pain', 'description': '', 'duration': '00:48:10',
+         'release_date': '1993-10-26', 'band': 'eyehategod', 'label': 'Relapse', 'cover': 'covers/ehg.jpg'},
+        {'model': 'album', 'name': 'Broken', 'band': 'unknown', 'label': 'Relapse'},
+    ]
+
+    def import_lines(self, lines, **kwargs):
+        importer = catalog.CatalogImporter(**kwargs)
+        for number, model, record in catalog.read_jsonl(io.StringIO('\n'.join(lines))):
+            importer.add(number, model, record)
+        importer.finish()
+        return importer
+
+    def test_round_trip(self):
+        importer = self.import_lines([json.dumps(record) for record in self.RECORDS], batch_size=2)
+        self.assertEqual(importer.errors, [(5, "неизвестная группа 'unknown'")])
+        album = Album.objects.get(band__slug='eyehategod')
+        self.assertEqual((album.slug, album.duration), ('take-as-needed-for-pain-eyehategod',
+                                                        datetime.timedelta(minutes=48, seconds=10)))
+        self.assertEqual(set(album.band.styles.values_list('slug', flat=True)), {'doom', 'sludge'})
+
+        stream = io.StringIO()
+        catalog.write_csv(catalog.export_records(['band']), stream, 'band')
+        rows = list(csv.DictReader(io.StringIO(stream.getvalue())))
+        self.assertEqual(rows[0]['styles'], 'doom|sludge')
+
+        # Повторный импорт обновляет, а не дублирует
+        rows[0]['country'] = 'US'
+        stream = io.StringIO()
+        writer = csv.DictWriter(stream, catalog.FIELDS['band'])
+        writer.writeheader()
+        writer.writerows(rows)
+        stream.seek(0)
+        importer = catalog.CatalogImporter()
+        for number, model, record in catalog.read_csv(stream, 'band'):
+            importer.add(number, model, record)
+        importer.finish()
+        self.assertEqual((importer.created['band'], importer.updated['band']), (0, 1))
+        self.assertEqual(Band.objects.get(slug='eyehategod').country, 'US')
+
+        exported = [json.loads(line) for line in self.export_jsonl()]
+        self.assertEqual([record['model'] for record in exported], ['style', 'style', 'label', 'label', 'band', 'album'])
+
+    def export_jsonl(self):
+        stream = io.StringIO()
+        catalog.write_jsonl(catalog.export_records(), stream)
+        return stream.getvalue().splitlines()
+
+
+class AlbumStatsTests(NewsTestCase):
+    """Материализованная статистика альбомов и рейтинги по ней"""
+
+    def test_signals_and_top(self):
+        voter = User.objects.create_user(username='voter', password='secret')
+        with self.captureOnCommitCallbacks(execute=True):
+            first, second = self.create_album(1), self.create_album(2)
+            second.band.styles.set([MusicStyle.objects.create(name='Sludge', description='')])
+        with self.captureOnCommitCallbacks(execute=True):
+            toggle_vote(Album, second.pk, self.user, LikeDislike.LIKE)
+        with self.captureOnCommitCallbacks(execute=True):
+            toggle_vote(Album, second.pk, voter, LikeDislike.LIKE)
+        with self.captureOnCommitCallbacks(execute=True):
+            review = Review.objects.create(user=voter, album=second, text='Еще отзыв')
+
+        stats = AlbumStats.objects.get(album=second)
+        self.assertEqual((stats.like_count, stats.rating, stats.review_count, stats.last_review),
+                         (2, 2, 2, review.created))
+        self.assertEqual(list(ratings.top_albums()), [second, first])
+        self.assertEqual(list(ratings.top_albums('doom')), [first])
+        self.assertEqual(list(ratings.top_bands()), [second.band, first.band])
+        self.assertEqual(BandStats.objects.get(band=second.band).review_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            review.delete()
+        self.assertEqual(AlbumStats.objects.get(album=second).review_count, 1)
+        self.assertEqual(ratings.check(), [])
+
+        AlbumStats.objects.update(rating=0)
+        self.assertEqual(len(ratings.check()), 1)
+        self.assertEqual(ratings.rebuild(), 2)
+        self.assertEqual(ratings.check(), [])
+        self.assertEqual(BandStats.objects.get(band=second.band).rating, 2)
+
+        response = self.client.get(reverse('news:top_style', args=['sludge']))
+        self.assertContains(response, 'Album 2')
+        self.assertNotContains(response, 'Album 1')
+
+
+class RelatedPostTests(NewsTestCase):
+    """Похожие новости: инкрементальный пересчет совпадает с полным"""
+
+    def stored(self):
+        return list(RelatedPost.objects.order_by('post', 'position').values_list('post', 'related', 'position'))
+
+    def assertMatchesRebuild(self):
+        incremental = self.stored()
+        related.rebuild()
+        self.assertEqual(incremental, self.stored())
+
+    def test_incremental_updates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            posts = [self.create_post(number) for number in range(5)]
+            draft = self.create_post(5, status='draft')
+            for post in (posts[1], posts[2], draft):
+                post.tags.add('funeral-doom')
+        self.assertEqual(list(related.get_related(posts[1]))[0], posts[2])
+        self.assertNotIn(draft.pk, RelatedPost.objects.values_list('related', flat=True))
+        self.assertMatchesRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            posts[4].tags.add('funeral-doom', 'sludge')
+            posts[3].tags.add('sludge')
+        self.assertIn(posts[4], related.get_related(posts[1]))
+        self.assertEqual(list(related.get_related(posts[3]))[0], posts[4])
+        self.assertMatchesRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            posts[2].delete()
+        self.assertNotIn(posts[2].pk, RelatedPost.objects.values_list('related', flat=True))
+        self.assertMatchesRebuild()
+
+        response = self.client.get(posts[3].get_absolute_url())
+        self.assertEqual(response.context['related_posts'][0], posts[4])
+
+    def test_neighbours_in_one_query(self):
+        posts = [self.create_post(number) for number in range(3)]
+        with self.assertNumQueries(1):
+            self.assertEqual(related.get_neighbours(posts[1]), (posts[0], posts[2]))
+        with self.assertNumQueries(1):
+            self.assertEqual(related.get_neighbours(posts[0]), (None, posts[1]))
+
+
+class LeaderboardTests(NewsTestCase):
+    """Рейтинги популярных новостей: пересчет, инкрементальные обновления и сверка"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        now = timezone.now()
+        # Свежие новости попадают во все окна, старая - только в "за все время"
+        cls.posts = [cls.create_post(number, views=views, rating=rating, publish=now - timezone.timedelta(hours=1))
+                     for number, (views, rating) in enumerate([(30, 1), (20, 5), (20, 2), (5, 0)])]
+        cls.old = cls.create_post(9, views=100, publish=now - timezone.timedelta(days=60))
+
+    def board(self, period):
+        return list(PopularPost.objects.filter(period=period).order_by('position').values_list('post_id', flat=True))
+
+    def test_rebuild(self):
+        leaderboards.rebuild()
+        first, second, third, _ = self.posts
+        self.assertEqual(self.board('day'), [first.pk, second.pk, third.pk])
+        self.assertEqual(self.board('years'), [self.old.pk, first.pk, second.pk])
+        self.assertEqual(list(leaderboards.get_leaderboard('day')), [first, second, third])
+        self.assertEqual(leaderboards.check(), {})
+
+    def test_update_post(self):
+        leaderboards.rebuild()
+        computed = PopularPost.objects.values_list('computed', flat=True).first()
+        last = self.posts[-1]
+        Post.objects.filter(pk=last.pk).update(views=25)
+        last.refresh_from_db()
+        leaderboards.update_post(last)
+        self.assertEqual(self.board('day'), [self.posts[0].pk, last.pk, self.posts[1].pk])
+        self.assertEqual(self.board('years'), [self.old.pk, self.posts[0].pk, last.pk])
+        self.assertEqual(leaderboards.check(), {})
+        # Время полного пересчета не сдвигается, иначе refresh_if_stale не заметит устаревания
+        self.assertEqual(set(PopularPost.objects.values_list('computed', flat=True)), {computed})
+
+        # Старая новость вне окон дня/недели/месяца сверяется только с рейтингом за все время,
+        # а новость ниже рейтинга ничего не пишет - по запросу на окно
+        with self.assertNumQueries(1):
+            leaderboards.update_post(self.old)
+        with self.assertNumQueries(4):
+            leaderboards.update_post(self.posts[2])
+        self.assertEqual(leaderboards.check(), {})
+
+    def test_check_command(self):
+        leaderboards.rebuild()
+        out = io.StringIO()
+        call_command('rebuild_leaderboards', '--check', stdout=out)
+        self.assertIn('совпадают', out.getvalue())
+
+        PopularPost.objects.filter(period='week', position=1).delete()
+        with self.assertRaises(CommandError):
+            call_command('rebuild_leaderboards', '--check', stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(list(leaderboards.check()), ['week'])
+        call_command('rebuild_leaderboards', '--period', 'week', stdout=io.StringIO())
+        self.assertEqual(leaderboards.check(), {})
+
+    @override_settings(LEADERBOARD_MAX_AGE=60)
+    def test_refresh_if_stale(self):
+        with mock.patch.object(leaderboards, '_last_refresh_check', 0.0), \
+                mock.patch('news.leaderboards._start_refresh', return_value=True) as start:
+            # Страница не пересчитывает рейтинги сама, а только запускает фоновый пересчет
+            self.client.get(reverse('news:post_list'))
+            start.assert_called_once()
+            self.assertFalse(PopularPost.objects.exists())
+            # Повторная проверка - не раньше чем через LEADERBOARD_MAX_AGE
+            with self.assertNumQueries(0):
+                self.assertFalse(leaderboards.refresh_if_stale())
+
+            leaderboards._last_refresh_check = 0.0
+            leaderboards.rebuild()
+            self.assertFalse(leaderboards.refresh_if_stale())
+            leaderboards._last_refresh_check = 0.0
+            PopularPost.objects.update(computed=timezone.now() - timezone.timedelta(minutes=2))
+            self.assertTrue(leaderboards.refresh_if_stale())
+
+    def test_background_refresh(self):
+        leaderboards._refresh_lock.acquire()
+        # Соединение теста не закрываем: пересчет идет в его транзакции
+        with mock.patch('news.leaderboards.connection'):
+            leaderboards._run_refresh()
+        self.assertEqual(leaderboards.check(), {})
+        self.assertTrue(leaderboards._refresh_lock.acquire(blocking=False))
+        leaderboards._refresh_lock.release()
+
+
+class ViewCounterTests(NewsTestCase):
+    """Буфер просмотров: запись пачкой вне запросов читателей"""
+
+    def setUp(self):
+        super().setUp()
+        self.counter = ViewCounter()
+        self.posts = [self.create_post(number) for number in range(3)]
+
+    def test_buffering(self):
+        with self.assertNumQueries(0):
+            for post in self.posts[:2]:
+                self.counter.hit(post.pk)
+            self.counter.hit(self.posts[0].pk)
+        self.assertEqual(self.counter.pending(self.posts[0].pk), 2)
+        self.assertEqual(self.counter.pending(self.posts[2].pk), 0)
+        self.assertEqual(Post.objects.get(pk=self.posts[0].pk).views, 0)
+
+        # Страница считает записанные просмотры плюс еще не записанные, без двойного учета
+        url = self.posts[1].get_absolute_url()
+        self.assertEqual(self.client.get(url).context['post'].views, 1)
+        view_counter.flush()
+        cache.clear()
+        self.assertEqual(self.client.get(url).context['post'].views, 2)
+
+    def test_flush(self):
+        for pk in (self.posts[0].pk, self.posts[0].pk, self.posts[1].pk, self.posts[2].pk):
+            self.counter.hit(pk)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.counter.flush(), 4)
+        # Одно UPDATE на каждое различное число просмотров, прибавлением к текущему значению
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "news_post"')]
+        self.assertEqual(len(updates), 2)
+        self.assertTrue(all('"views" = ("news_post"."views" + ' in sql for sql in updates))
+        self.assertEqual([Post.objects.get(pk=post.pk).views for post in self.posts], [2, 1, 1])
+        self.assertEqual(self.counter.pending(self.posts[0].pk), 0)
+        self.assertEqual(self.counter.flush(), 0)
+
+    def test_failed_flush_requeues(self):
+        self.counter.hit(self.posts[0].pk)
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=DatabaseError), \
+                self.assertLogs('news.counters', 'ERROR'):
+            self.assertEqual(self.counter.flush(), 0)
+        self.assertEqual(self.counter.pending(self.posts[0].pk), 1)
+        self.assertEqual(self.counter.stats()['failed_flushes'], 1)
+        self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(Post.objects.get(pk=self.posts[0].pk).views, 1)
+
+    def test_failed_leaderboard_update(self):
+        # Ошибка рейтингов не отменяет записанные просмотры и не ломает следующие сбросы
+        self.counter.hit(self.posts[0].pk)
+        with mock.patch('news.leaderboards.update_post', side_effect=DatabaseError), \
+                self.assertLogs('news.counters', 'ERROR'):
+            self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(self.counter.pending(self.posts[0].pk), 0)
+        self.counter.hit(self.posts[0].pk)
+        self.assertEqual(self.counter.flush(), 1)
+        self.assertEqual(Post.objects.get(pk=self.posts[0].pk).views, 2)
+
+    def test_flusher_survives_errors(self):
+        # SystemExit только останавливает бесконечный цикл потока в тесте
+        self.counter._flusher = mock.Mock()
+        with mock.patch.object(self.counter, 'flush', side_effect=[DatabaseError, 1, SystemExit]) as flush, \
+                mock.patch('news.counters.time.sleep'), mock.patch('news.counters.connection.close'), \
+                self.assertLogs('news.counters', 'ERROR'), self.assertRaises(SystemExit):
+            self.counter._run_flusher()
+        self.assertEqual(flush.call_count, 3)
+        self.assertEqual(self.counter.stats()['failed_flushes'], 1)
+        self.assertIsNone(self.counter._flusher)
+
+    def test_lag(self):
+        with mock.patch('news.counters.time.monotonic', return_value=100.0):
+            self.counter.hit(self.posts[0].pk)
+        with mock.patch('news.counters.time.monotonic', return_value=107.5):
+            self.counter.hit(self.posts[1].pk)
+            stats = self.counter.stats()
+        self.assertEqual((stats['pending_views'], stats['pending_posts'], stats['lag_seconds']), (2, 2, 7.5))
+        self.counter.flush()
+        self.assertEqual(self.counter.stats()['lag_seconds'], 0)
+
+        with mock.patch('news.metrics.view_counter', self.counter):
+            self.counter.hit(self.posts[0].pk)
+            exported = metrics.registry.export()
+        self.assertIn('news_view_counter_pending_views 1\n', exported)
+        self.assertIn('news_view_counter_flushed_views_total 2\n', exported)
+        self.assertRegex(exported, r'news_view_counter_lag_seconds \d+\.\d{3}\n')
+
+
+@override_settings(METRICS_SAMPLE_RATE=1)
+class MetricsTests(NewsTestCase):
+    """Замеры SQL и шаблонов по именам URL и экспорт для Prometheus"""
+
+    def setUp(self):
+        super().setUp()
+        metrics.registry.reset()
+
+    def test_records_views(self):
+        post = self.create_post(1)
+        self.client.get(reverse('news:post_list'))
+        self.client.get(post.get_absolute_url())
+        histograms = metrics.registry.histograms
+        self.assertEqual(set(histograms['news_request_sql_queries']), {'news:post_list', 'news:post_detail'})
+        self.assertGreater(histograms['news_request_sql_queries']['news:post_list'].sum, 0)
+        self.assertGreater(histograms['news_request_template_seconds']['news:post_detail'].sum, 0)
+
+        with self.settings(METRICS_TOKEN='secret'):
+            exported = self.client.get(reverse('news:metrics'), HTTP_AUTHORIZATION='Bearer secret').content.decode()
+        self.assertIn('news_request_sql_queries_bucket{view="news:post_list",le="+Inf"} 1', exported)
+        self.assertIn('news_requests_sampled_total 2', exported)
+
+    def test_access(self):
+        url = reverse('news:metrics')
+        # По умолчанию - только сотрудники: 127.0.0.1 может быть адресом прокси перед сайтом
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='127.0.0.1').status_code, 404)
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        with self.settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+        with self.settings(METRICS_ALLOWED_IPS=('10.0.0.5',)):
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.5').status_code, 200)
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.1').status_code, 404)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_duplicate_queries(self):
+        def view(request):
+            for _ in range(3):
+                list(Post.objects.filter(pk=1))
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.resolver_match = None
+        metrics.metrics_middleware(view)(request)
+        [(sql, repeats)] = metrics.registry.top_duplicates('unresolved')
+        self.assertEqual(repeats, 2)
+        self.assertIn('news_post', sql)
+
+    @override_settings(ASYNC_PARALLEL_QUERIES=True)
+    def test_async_pool_queries(self):
+        def query():
+            # Свое соединение потока пула; таблицы не читаем - их держит транзакция теста
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+
+        async def view(request):
+            await asyncdb.gather(query, query)
+            await asyncdb.run(lambda: engines['django'].from_string('{{ value }}').render({'value': 1}))
+            return HttpResponse()
+
+        middleware = metrics.metrics_middleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        request = RequestFactory().get('/')
+        request.resolver_match = None
+        async_to_sync(middleware)(request)
+        histograms = metrics.registry.histograms
+        self.assertEqual(histograms['news_request_sql_queries']['unresolved'].sum, 2)
+        self.assertGreater(histograms['news_request_template_seconds']['unresolved'].sum, 0)
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            metrics.metrics_middleware(lambda request: None)
+
+
+class BenchmarkTests(NewsTestCase):
+    """Синтетический датасет, замеры страниц и сравнение отчетов"""
+
+    def test_generate_and_run(self):
+        counts = benchmarks.generate(posts=30, comments=3, bands=5, albums=10, users=10, votes=200)
+        self.assertEqual(counts['posts'], 30)
+        self.assertEqual(counts['votes'], 200)
+        self.assertTrue(Comment.objects.filter(parent__isnull=False).exists())
+        album = Album.objects.filter(slug__startswith='bench-album-').order_by('-rating').first()
+        self.assertEqual(album.rating, album.votes.sum_rating())
+
+        report = benchmarks.run(requests=5, warmup=1, scenarios=['main_page', 'post_detail', 'vote_post'])
+        self.assertEqual(set(report['scenarios']), {'main_page', 'post_detail', 'vote_post'})
+        for result in report['scenarios'].values():
+            self.assertEqual(result['errors'], 0)
+            self.assertGreater(result['queries']['max'], 0)
+            self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['max'])
+        self.assertEqual(report['meta']['dataset']['posts'], Post.objects.count())
+        # Без NEWS_ASYNC_VIEWS urls подключают синхронные view - режим asgi их бы не проверил
+        with self.assertRaises(ValueError):
+            benchmarks.serve('asgi')
+
+        benchmarks.clear()
+        self.assertFalse(Post.objects.filter(slug__startswith='bench-post-').exists())
+        self.assertFalse(LikeDislike.objects.exists())
+
+    def test_compare(self):
+        def report(p50, queries):
+            return {'scenarios': {'main_page': {
+                'latency_ms': {'p50': p50, 'p95': p50, 'p99': p50}, 'queries': {'max': queries},
+                'throughput_rps': 1000 / p50}}}
+
+        self.assertEqual(benchmarks.compare(report(10, 4), report(10.5, 4))[1], [])
+        [(name, metric, *_)] = benchmarks.compare(report(10, 4), report(10, 5))[1]
+        self.assertEqual((name, metric), ('main_page', 'queries max'))
+        self.assertEqual(len(benchmarks.compare(report(10, 4), report(12, 4))[1]), 2)
+
+
+class PublishedPostTests(NewsTestCase):
+    """Публичные страницы показывают только опубликованные новости и читают их по частичным индексам"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for number in range(3):
+            cls.create_post(number)
+        cls.draft = cls.create_post(3, status='draft')
+
+    def test_drafts_hidden(self):
+        for url in (reverse('news:post_list'), reverse('news:category_post_list', args=[self.category.slug])):
+            response = self.client.get(url)
+            self.assertEqual(len(response.context['posts']), 3)
+            self.assertNotContains(response, self.draft.title)
+        self.assertEqual(self.client.get(self.draft.get_absolute_url()).status_code, 404)
+        self.assertEqual(self.client.post(reverse('news:add_comment', args=[self.draft.slug]),
+                                          {'name': 'Гость', 'email': 'guest@example.com', 'text': 'Коммент'}
+                                          ).status_code, 404)
+        previous_post, next_post = related.get_neighbours(Post.objects.get(title='Новость 2'))
+        self.assertEqual((previous_post.title, next_post), ('Новость 1', None))
+
+    def test_leaderboards_skip_drafts(self):
+        leaderboards.rebuild()
+        # Голоса за черновик принимаются, но в рейтинги он не попадает
+        Post.objects.filter(pk=self.draft.pk).update(views=1000, rating=50)
+        self.draft.refresh_from_db()
+        leaderboards.update_post(self.draft)
+        self.assertFalse(PopularPost.objects.filter(post=self.draft).exists())
+        self.assertEqual(leaderboards.check(), {})
+
+        top = Post.objects.get(leaderboard__period='years', leaderboard__position=1)
+        top.status = 'draft'
+        with self.captureOnCommitCallbacks(execute=True):
+            top.save()
+        self.assertFalse(PopularPost.objects.filter(post=top).exists())
+        self.assertEqual(leaderboards.check(), {})
+
+    def plan(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # На нескольких строках планировщику дешевле прочитать таблицу целиком:
+                # запрет последовательного чтения проверяет, что запросу подходит индекс
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql)
+                return [row[0].strip().lstrip('-> ') for row in cursor.fetchall()]
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexDriven(self, sql, indexes, ordered=True):
+        """План читает новости по одному из indexes, без полного чтения таблицы и (ordered) без сортировки"""
+        plan = self.plan(sql)
+        if connection.vendor == 'postgresql':
+            used = [step for step in plan for index in indexes if f' {index} ' in f'{step} ']
+            full_scans = [step for step in plan if step.startswith('Seq Scan on news_post ')]
+            sorts = [step for step in plan if step.startswith(('Sort', 'Incremental Sort'))]
+        else:
+            used = [step for step in plan for index in indexes if f'INDEX {index} ' in f'{step} ']
+            full_scans = [step for step in plan if step.startswith('SCAN news_post') and 'INDEX' not in step]
+            sorts = [step for step in plan if 'TEMP B-TREE' in step]
+        self.assertTrue(used, plan)
+        self.assertFalse(full_scans, plan)
+        if ordered:
+            self.assertFalse(sorts, plan)
+
+    def sql(self, queryset):
+        compiled, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                return cursor.mogrify(compiled, params).decode()
+            return connection.ops.last_executed_query(cursor, compiled, params)
+
+    @skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'Планы запросов проверяются для SQLite и PostgreSQL')
+    def test_query_plans(self):
+        cursor = encode_cursor(Post.objects.get(title='Новость 1'))
+        for url in (reverse('news:post_list'), reverse('news:category_post_list', args=[self.category.slug])):
+            for params in ({}, {'after': cursor}, {'before': cursor}):
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.get(url, params)
+                [sql] = [query['sql'] for query in queries
+                         if query['sql'].startswith('SELECT') and 'ORDER BY "news_post"."publish"' in query['sql']]
+                self.assertIndexDriven(sql, ['news_post_published_idx'])
+        for period in leaderboards.PERIODS:
+            queryset = leaderboards.live_queryset(period)[:leaderboards.LEADERBOARD_SIZE]
+            # Рейтинг за все время идет по индексу популярности; окна "день/неделя/месяц"
+            # читают диапазон publish (SQLite) или индекс популярности с фильтром по
+            # дате (PostgreSQL) - в любом случае только опубликованные новости
+            if period == 'years':
+                self.assertIndexDriven(self.sql(queryset), ['news_post_popular_idx'])
+            else:
+                self.assertIndexDriven(self.sql(queryset), ['news_post_published_idx', 'news_post_popular_idx'],
+                                       ordered=False)
+        post = Post.objects.get(title='Новость 1')
+        with CaptureQueriesContext(connection) as queries:
+            related.get_neighbours(post)
+        self.assertIndexDriven(queries[0]['sql'], ['news_post_published_created'])
+
+
+class CategoryMapTests(NewsTestCase):
+    """Страницы категорий по слагу и карта категорий в памяти"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.post = cls.create_post(1)
+        cls.other = Category.objects.create(name='Релизы')
+
+    def test_routing(self):
+        response = self.client.get(reverse('news:category_post_list', args=[self.category.slug]))
+        self.assertEqual([post.pk for post in response.context['posts']], [self.post.pk])
+        self.assertEqual(len(self.client.get(reverse('news:category_post_list', args=[self.other.slug]))
+                             .context['posts']), 0)
+        self.assertEqual(self.client.get(reverse('news:category_post_list', args=['missing'])).status_code, 404)
+        self.assertRedirects(self.client.get(f'/category/{self.category.name}'),
+                             reverse('news:category_post_list', args=[self.category.slug]), status_code=301)
+        # Слаг без слэша попадает в тот же маршрут и ведет на адрес со слэшем
+        self.assertRedirects(self.client.get(f'/category/{self.other.slug}'),
+                             reverse('news:category_post_list', args=[self.other.slug]), status_code=301)
+        self.assertEqual(self.client.get('/category/missing').status_code, 404)
+
+    def test_main_category_link(self):
+        link = 'href="%s"' % reverse('news:category_post_list', args=[self.category.slug])
+        self.assertContains(self.client.get(reverse('news:post_list')), link)
+        cache.clear()
+        with self.settings(MAIN_CATEGORY_NAME='Релизы'):
+            self.assertContains(self.client.get(reverse('news:post_list')),
+                                'href="%s"' % reverse('news:category_post_list', args=[self.other.slug]))
+        cache.clear()
+        with self.settings(MAIN_CATEGORY_NAME='Нет такой'):
+            self.assertNotContains(self.client.get(reverse('news:post_list')), 'Смотреть все')
+
+    def test_loaded_once(self):
+        categories.get_map()
+        with self.assertNumQueries(0):
+            self.assertEqual(categories.get_by_slug(self.other.slug).name, 'Релизы')
+            self.assertEqual([entry.name for entry in categories.all_categories()], ['Новости', 'Релизы'])
+
+    def test_invalidation(self):
+        categories.get_map()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.name = 'Анонсы'
+            self.other.slug = 'anonsy'
+            self.other.save()
+        self.assertIsNone(categories.get_by_slug(self.other.slug.replace('anonsy', 'relizy')))
+        self.assertEqual(categories.get_by_slug('anonsy').name, 'Анонсы')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.delete()
+        self.assertIsNone(categories.get_by_slug('anonsy'))
+
+        # Другой процесс изменил категорию и сменил поколение в общем кэше
+        Category.objects.filter(pk=self.category.pk).update(name='Все новости')
+        cache.set(categories.GENERATION_KEY, 'other-process')
+        self.assertEqual(categories.get_by_slug(self.category.slug).name, 'Все новости')
+
+
+@override_settings(ASYNC_PARALLEL_QUERIES=False)
+class AsyncViewTests(NewsTestCase):
+    """Асинхронные варианты страниц отдают то же, что и синхронные"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.posts = [cls.create_post(number) for number in range(3)]
+        cls.album = cls.create_album(1)
+
+    def request(self, path, user=None, method='get', **extra):
+        request = getattr(RequestFactory(), method)(path, **extra)
+        request.user = user or AnonymousUser()
+        return request
+
+    def assertSamePage(self, sync_response, async_response):
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        csrf = re.compile(rb'name="csrfmiddlewaretoken" value="[^"]*"')
+        self.assertEqual(csrf.sub(b'', async_response.content), csrf.sub(b'', sync_response.content))
+
+    def test_pages(self):
+        post = self.posts[1]
+        pages = [
+            ('/', views.MainPage.as_view(), views.main_page_async, {}),
+            (post.get_absolute_url(), views.post_detail, views.post_detail_async, {'slug': post.slug}),
+            (self.album.get_absolute_url(), views.AlbumDetailView.as_view(), views.album_detail_async,
+             {'slug': self.album.slug}),
+        ]
+        for user in (None, self.user):
+            for path, sync_view, async_view, kwargs in pages:
+                with self.subTest(path=path, user=user):
+                    cache.clear()
+                    sync_response = sync_view(self.request(path, user), **kwargs)
+                    if hasattr(sync_response, 'render'):
+                        sync_response.render()
+                    cache.clear()
+                    self.assertSamePage(sync_response, async_to_sync(async_view)(self.request(path, user), **kwargs))
+        with self.assertRaises(Http404):
+            async_to_sync(views.post_detail_async)(self.request('/missing/'), slug='missing')
+
+    def test_fragment_invalidated_during_request(self):
+        leaderboards.rebuild()
+        async_to_sync(views.main_page_async)(self.request('/'))
+        all_categories = categories.all_categories
+
+        def invalidating():
+            # Фрагменты сбрасываются, пока страница загружает данные
+            fragments.invalidate('sidebar', 'albums')
+            return all_categories()
+
+        with mock.patch('news.categories.all_categories', invalidating):
+            response = async_to_sync(views.main_page_async)(self.request('/'))
+        self.assertContains(response, 'product__sidebar__view__item')
+        self.assertContains(response, self.album.name)
+
+    def test_main_page_gathers_queries_only(self):
+        # Холодная карта категорий загружается в потоке рендеринга, не в цикле событий
+        categories.invalidate()
+        with mock.patch('news.asyncdb.gather', wraps=asyncdb.gather) as gather:
+            response = async_to_sync(views.main_page_async)(self.request('/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(gather.call_args.args), 2)
+
+    def test_page_cache(self):
+        view = pagecache.cache_anonymous('lists')(views.main_page_async)
+        self.assertEqual(async_to_sync(view)(self.request('/'))['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(view)(self.request('/'))['X-Page-Cache'], 'hit')
+
+    def test_votes(self):
+        post = self.posts[0]
+        vote = async_to_sync(views.votes_async)
+        kwargs = {'pk': post.pk, 'model': Post, 'vote_type': LikeDislike.LIKE}
+        self.assertEqual(vote(self.request('/'), **kwargs).status_code, 302)
+        self.assertEqual(vote(self.request('/', self.user), **kwargs).status_code, 405)
+        response = vote(self.request('/', self.user, method='post'), **kwargs)
+        self.assertEqual(json.loads(response.content),
+                         {'result': True, 'like_count': 1, 'dislike_count': 0, 'sum_rating': 1})
+        with self.assertRaises(Http404):
+            vote(self.request('/', self.user, method='post'), **dict(kwargs, pk=0))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTests(SimpleTestCase):
+    """Чтение с реплик и закрепление записавшего посетителя за основной базой"""
+
+    def through_middleware(self, request, write=False):
+        router = routers.ReplicaRouter()
+        reads = []
+
+        def view(request):
+            reads.append(router.db_for_read(Post))
+            if write:
+                router.db_for_write(Comment)
+                reads.append(router.db_for_read(Post))
+            return HttpResponse()
+
+        return reads, routers.replica_middleware(view)(request)
+
+    def test_routing(self):
+        factory = RequestFactory()
+        self.assertEqual(routers.ReplicaRouter().db_for_read(Post), 'default')
+        reads, response = self.through_middleware(factory.get('/'), write=True)
+        # После записи запрос дочитывает с основной базы; GET посетителя не закрепляет
+        self.assertEqual(reads, ['replica', 'default'])
+        self.assertNotIn(routers.REPLICA_PIN_COOKIE, response.cookies)
+
+        reads, response = self.through_middleware(factory.post('/'))
+        self.assertEqual(reads, ['default'])
+        self.assertNotIn(routers.REPLICA_PIN_COOKIE, response.cookies)
+        reads, response = self.through_middleware(factory.post('/'), write=True)
+        self.assertEqual(response.cookies[routers.REPLICA_PIN_COOKIE]['max-age'], routers.REPLICA_PIN_SECONDS)
+
+        request = factory.get('/')
+        request.COOKIES[routers.REPLICA_PIN_COOKIE] = '1'
+        self.assertEqual(self.through_middleware(request)[0], ['default'])
+        self.assertEqual(routers.ReplicaRouter().db_for_read(Post), 'default')
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], VIEW_COUNTER_FLUSH_INTERVAL=0)
+class ReplicaReadYourWritesTests(TransactionTestCase):
+    """Закрепленный посетитель читает с основной базы, остальные - с реплики"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(view_counter.flush)
+        # Выбор реплики подменен: запросы идут в default, а тест считает чтения с реплики
+        patcher = mock.patch('news.routers.random.choice', return_value='default')
+        self.choice = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def replica_reads(self, url):
+        cache.clear()
+        self.choice.reset_mock()
+        response = self.client.get(url)
+        return response, self.choice.call_count
+
+    def test_commenter_reads_primary(self):
+        user = User.objects.create_user(username='reader', password='secret')
+        post = Post.objects.create(title='Только в основной', content='', author=user, status='published',
+                                   image='posts/test.jpg')
+        url = post.get_absolute_url()
+        self.assertGreater(self.replica_reads(url)[1], 0)
+
+        self.choice.reset_mock()
+        response = self.client.post(reverse('news:add_comment', args=[post.slug]), {
+            'name': 'Гость', 'email': 'guest@example.com', 'text': 'Свежий коммент'})
+        self.assertEqual(self.choice.call_count, 0)
+        self.assertIn(routers.REPLICA_PIN_COOKIE, response.cookies)
+
+        response, reads = self.replica_reads(url)
+        self.assertContains(response, 'Свежий коммент')
+        self.assertEqual(reads, 0)
+        self.client.cookies.pop(routers.REPLICA_PIN_COOKIE)
+        self.assertGreater(self.replica_reads(url)[1], 0)
+
+
+class RichTextTests(NewsTestCase):
+    """Очищенный HTML и анонс новости считаются при сохранении, списки не читают тело"""
+
+    def test_sanitize(self):
+        html = richtext.sanitize(
+            '<p onclick="steal()">Текст<script>alert(1)</script> <a href="javascript:alert(1)">ссылка</a></p>'
+            '<img src="/media/a.jpg" onerror="steal()"><iframe src="https://evil.example/"></iframe>'
+            '<figure class="media"><oembed url="https://youtu.be/dQw4w9WgXcQ"></oembed></figure>'
+            '<div data-oembed-url="https://example.com/clip"><div>встроенный плеер</div></div>')
+        self.assertEqual(html, (
+            '<p>Текст <a>ссылка</a></p><img src="/media/a.jpg" loading="lazy" decoding="async">'
+            '<figure class="media"><div class="embed"><iframe src="https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ" '
+            'width="560" height="315" allow="encrypted-media; picture-in-picture" allowfullscreen loading="lazy">'
+            '</iframe></div></figure>'
+            '<p><a href="https://example.com/clip" rel="nofollow noopener" target="_blank">https://example.com/clip</a></p>'))
+        self.assertEqual(richtext.sanitize('<p>без <b>конца<p>второй'), '<p>без <b>конца</b></p><p>второй</p>')
+
+    def test_post_pages(self):
+        post = self.create_post(1, content='<p>Раз два три четыре пять шесть семь восемь девять десять '
+                                           'одиннадцать</p><script>alert(1)</script>')
+        self.assertEqual(post.excerpt, 'Раз два три четыре пять шесть семь восемь девять десять…')
+        self.assertNotIn('script', post.content_html)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('news:post_list'))
+        self.assertContains(response, post.excerpt)
+        self.assertFalse([query['sql'] for query in queries if '"news_post"."content' in query['sql']])
+        response = self.client.get(post.get_absolute_url())
+        self.assertContains(response, '<p>Раз два')
+        self.assertNotContains(response, 'alert(1)')
+
+        Post.objects.filter(pk=post.pk).update(content='<p>Новый текст</p>')
+        post = Post.objects.get(pk=post.pk)
+        post.save(update_fields=['content'])
+        post.refresh_from_db()
+        self.assertEqual((post.content_html, post.excerpt), ('<p>Новый текст</p>', 'Новый текст'))
@@ -0,0 +1,188 @@
+"""
+Уменьшенные копии изображений (Post.image, Album.cover, Band.image).
+
+Варианты лежат рядом с оригиналом в подкаталоге thumbs/:
+covers/<группа>/<альбом>/thumbs/<имя>-<ширина>x<высота>.webp (и .jpg для
+браузеров без WebP). Создаются после сохранения объекта, при первом
+обращении из шаблона, если их еще нет, и пачкой командой build_thumbnails.
+"""
+import hashlib
+import io
+import logging
+import os
+import posixpath
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from news.models import Post, Album, Band
+
+logger = logging.getLogger(__name__)
+
+# Имя варианта -> (ширина, высота); размеры с запасом под экраны с двойной плотностью
+THUMBNAIL_SIZES = getattr(settings, 'THUMBNAIL_SIZES', {
+    'hero': (1170, 600),
+    'cover': (540, 880),
+    'card': (480, 440),
+    'sidebar': (480, 260),
+})
+THUMBNAIL_QUALITY = getattr(settings, 'THUMBNAIL_QUALITY', 80)
+# Сколько секунд после неудачи отдавать оригинал, не пытаясь снова открыть битый
+# или отсутствующий исходник на каждом рендере
+THUMBNAIL_RETRY_TIMEOUT = getattr(settings, 'THUMBNAIL_RETRY_TIMEOUT', 60)
+
+FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+
+IMAGE_FIELDS = ((Post, 'image'), (Album, 'cover'), (Band, 'image'))
+
+# Варианты, которые уже точно есть в хранилище - чтобы не проверять файл на каждом рендере
+_ready = set()
+_ready_lock = threading.Lock()
+
+
+def variant_name(name, alias, ext='webp'):
+    width, height = THUMBNAIL_SIZES[alias]
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    return posixpath.join(directory, 'thumbs', f'{stem}-{width}x{height}.{ext}')
+
+
+def _fit(image, size):
+    """Обрезает под пропорции size и уменьшает; мелкие исходники не растягиваются"""
+    width, height = size
+    factor = min(image.width / width, image.height / height, 1)
+    size = (max(1, round(width * factor)), max(1, round(height * factor)))
+    return ImageOps.fit(image, size, Image.LANCZOS)
+
+
+def _write(storage, name, data):
+    if hasattr(storage, 'path'):
+        # Локальный диск: пишем во временный файл и атомарно переименовываем,
+        # чтобы параллельный запрос не отдал недописанный вариант
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    else:
+        storage.delete(name)
+        storage.save(name, ContentFile(data))
+
+
+def generate(name, aliases=None, force=False, storage=None):
+    """
+    Создает варианты изображения name (путь в хранилище). Возвращает список
+    созданных файлов; уже существующие пропускаются, если не указан force.
+    Отсутствующий или битый исходник не считается ошибкой - возвращается [].
+    """
+    storage = storage or default_storage
+    aliases = aliases or list(THUMBNAIL_SIZES)
+    missing = [(alias, ext) for alias in aliases for ext in FORMATS
+               if force or not storage.exists(variant_name(name, alias, ext))]
+    if not missing:
+        return []
+    try:
+        with storage.open(name) as source:
+            image = Image.open(source)
+            # JPEG можно декодировать сразу в уменьшенном виде - это в разы быстрее
+            # (сторона квадратная, потому что EXIF-поворот еще впереди)
+            side = max(max(THUMBNAIL_SIZES[alias]) for alias, _ in missing)
+            image.draft('RGB', (side, side))
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except FileNotFoundError:
+        logger.debug('Нет исходного изображения %s', name)
+        return []
+    except (UnidentifiedImageError, OSError) as error:
+        logger.warning('Не удалось открыть изображение %s: %s', name, error)
+        return []
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    created = []
+    resized = {}
+    for alias, ext in missing:
+        if alias not in resized:
+            resized[alias] = _fit(image, THUMBNAIL_SIZES[alias])
+        variant = resized[alias]
+        if ext == 'jpg' and variant.mode != 'RGB':
+            variant = variant.convert('RGB')
+        buffer = io.BytesIO()
+        variant.save(buffer, FORMATS[ext], quality=THUMBNAIL_QUALITY, optimize=ext == 'jpg',
+                     progressive=ext == 'jpg', method=4)
+        target = variant_name(name, alias, ext)
+        _write(storage, target, buffer.getvalue())
+        created.append(target)
+    with _ready_lock:
+        _ready.update(created)
+    return created
+
+
+def url(image, alias, ext='webp'):
+    """
+    URL варианта изображения (FieldFile). Если варианта еще нет, он создается
+    при первом обращении; если создать не вышло - URL оригинала, и следующая
+    попытка не раньше чем через THUMBNAIL_RETRY_TIMEOUT секунд.
+    """
+    if not image:
+        return ''
+    target = variant_name(image.name, alias, ext)
+    if target not in _ready:
+        failed_key = f'thumbnail-failed:{hashlib.md5(target.encode()).hexdigest()}'
+        fallback = cache.get(failed_key)
+        if fallback is not None:
+            return fallback
+        if not image.storage.exists(target) and not generate(image.name, [alias], storage=image.storage):
+            cache.set(failed_key, image.url, THUMBNAIL_RETRY_TIMEOUT)
+            return image.url
+        with _ready_lock:
+            _ready.add(target)
+    return image.storage.url(target)
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def _generate_task(name, force):
+    try:
+        return name, len(generate(name, force=force)), None
+    except Exception as error:
+        # Ошибка одного файла попадает в отчет, а не роняет весь пул
+        return name, 0, f'{type(error).__name__}: {error}'
+
+
+def generate_many(names, workers=None, force=False):
+    """
+    Создает варианты для списка изображений в пуле процессов
+    (ресайз упирается в CPU, потоки из-за GIL не помогают).
+    Возвращает итератор (имя, создано файлов, ошибка или None).
+    """
+    names = list(names)
+    if workers == 1 or len(names) < 2:
+        return (_generate_task(name, force) for name in names)
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+
+    def results():
+        with executor:
+            chunksize = max(1, len(names) // ((workers or os.cpu_count() or 1) * 4))
+            yield from executor.map(_generate_task, names, [force] * len(names), chunksize=chunksize)
+
+    return results()
+
+
+def stored_names():
+    """Имена всех изображений из базы, без повторов"""
+    names = set()
+    for model, field in IMAGE_FIELDS:
+        names.update(model.objects.exclude(**{field: ''}).values_list(field, flat=True).order_by())
+    return sorted(names)
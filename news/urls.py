@@ -1,32 +1,42 @@
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.urls import path
+from .pagecache import cache_anonymous
 from .views import *
 
 app_name = 'news'
 
+
+def vote_path(route, model, vote_type, name):
+    if getattr(settings, 'NEWS_ASYNC_VIEWS', False):
+        return path(route, votes_async, {'model': model, 'vote_type': vote_type}, name=name)
+    return path(route, login_required(VotesView.as_view(model=model, vote_type=vote_type)), name=name)
+
+
+# Под ASGI страницы с независимыми запросами обслуживают асинхронные варианты
+if getattr(settings, 'NEWS_ASYNC_VIEWS', False):
+    main_page, post_page, album_page = main_page_async, post_detail_async, album_detail_async
+else:
+    main_page, post_page, album_page = MainPage.as_view(), post_detail, AlbumDetailView.as_view()
+
 urlpatterns = [
-    path('', MainPage.as_view(), name='post_list'),
-    path('<str:slug>/', post_detail, name='post_detail'),
-    path('album/<str:slug>/', AlbumDetailView.as_view(), name='album_detail'),
+    path('', cache_anonymous('lists')(main_page), name='post_list'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('top/', cache_anonymous('lists')(TopView.as_view()), name='top'),
+    path('top/<slug:style>/', cache_anonymous('lists')(TopView.as_view()), name='top_style'),
+    path('<str:slug>/', cache_anonymous('posts', 'post:{slug}', on_hit=count_cached_view)(post_page),
+         name='post_detail'),
+    path('album/<str:slug>/', album_page, name='album_detail'),
     path('album/review/<str:slug>/', AddReview.as_view(), name='add_review'),
     path('comment/<str:slug>/', AddComment.as_view(), name='add_comment'),
-    path('category/<str:category_name>', CategoryListView.as_view(), name='category_post_list'),
-    path('post/<int:pk>/like/',
-         login_required(VotesView.as_view(model=Post, vote_type=LikeDislike.LIKE)),
-         name='post_like'),
-    path('post/<int:pk>/dislike/',
-         login_required(VotesView.as_view(model=Post, vote_type=LikeDislike.DISLIKE)),
-         name='post_dislike'),
-    path('comment/<int:pk>/like/',
-         login_required(VotesView.as_view(model=Comment, vote_type=LikeDislike.LIKE)),
-         name='comment_like'),
-    path('comment/<int:pk>/dislike/',
-         login_required(VotesView.as_view(model=Comment, vote_type=LikeDislike.DISLIKE)),
-         name='comment_dislike'),
-    path('album/<int:pk>/like/',
-         login_required(VotesView.as_view(model=Album, vote_type=LikeDislike.LIKE)),
-         name='album_like'),
-    path('album/<int:pk>/dislike/',
-         login_required(VotesView.as_view(model=Album, vote_type=LikeDislike.DISLIKE)),
-         name='album_dislike'),
+    path('category/<slug:slug>/', cache_anonymous('lists')(CategoryListView.as_view()),
+         name='category_post_list'),
+    path('category/<str:name>', category_by_name, name='category_by_name'),
+    vote_path('post/<int:pk>/like/', Post, LikeDislike.LIKE, 'post_like'),
+    vote_path('post/<int:pk>/dislike/', Post, LikeDislike.DISLIKE, 'post_dislike'),
+    vote_path('comment/<int:pk>/like/', Comment, LikeDislike.LIKE, 'comment_like'),
+    vote_path('comment/<int:pk>/dislike/', Comment, LikeDislike.DISLIKE, 'comment_dislike'),
+    vote_path('album/<int:pk>/like/', Album, LikeDislike.LIKE, 'album_like'),
+    vote_path('album/<int:pk>/dislike/', Album, LikeDislike.DISLIKE, 'album_dislike'),
 ]
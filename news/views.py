@@ -1,76 +1,114 @@
 import json
+from functools import partial
 
-from django.core.paginator import Paginator
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.db.models import Exists, OuterRef
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed
 from django.shortcuts import render, get_object_or_404, redirect
-from django.utils import timezone
 from django.views.generic import ListView, DetailView
 from django.views.generic.base import View
-from django.contrib.contenttypes.models import ContentType
 # Create your views here.
-from news.models import Post, Category, Album, Comment, LikeDislike
+from news import asyncdb, categories, conditional, leaderboards, metrics, ratings, related, search
+from news.comments import build_comment_tree
+from news.counters import view_counter
+from news.models import Post, Album, Comment, LikeDislike, MusicStyle
+from news.pagination import KeysetPaginationMixin, KeysetPaginator
+from news.votes import get_vote_state, toggle_vote
 from .forms import CommentForm, ReviewForm
 
 
-class MainPage(ListView):
+def get_latest_comments():
+    return (Comment.objects.filter(post__status='published').select_related('post').defer('post__content', 'post__content_html')
+            .prefetch_related('post__tags').order_by('-created')[:3])
+
+
+class MainPage(KeysetPaginationMixin, ListView):
     model = Post
     template_name = 'news/post_list.html'
     paginate_by = 6
 
+    def get_queryset(self):
+        return Post.published.for_cards()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        p = Paginator(Post.objects.select_related().all(), self.paginate_by)
-        context['posts'] = p.page(context['page_obj'].number)
-        context['categories'] = Category.objects.all()
-        context['albums'] = Album.objects.all()
-        context['comments'] = Comment.objects.all().order_by('-created')[:3]
-        context['popular_day'] = Post.objects.all().filter(
-            publish__range=[timezone.now() - timezone.timedelta(days=1), timezone.now()]).annotate(
-            sum_views=Sum('views'), sum_votes=Sum('votes')).order_by('-sum_views', 'sum_votes')[:3]
-        context['popular_week'] = Post.objects.all().filter(
-            publish__range=[timezone.now() - timezone.timedelta(days=7), timezone.now()]).annotate(
-            sum_views=Sum('views'), sum_votes=Sum('votes')).order_by('-sum_views', 'sum_votes')[:3]
-        context['popular_month'] = Post.objects.all().filter(
-            publish__range=[timezone.now() - timezone.timedelta(days=30), timezone.now()]).annotate(
-            sum_views=Sum('views'), sum_votes=Sum('votes')).order_by('-sum_views', 'sum_votes')[:3]
-        context['popular_years'] = Post.objects.all().annotate(
-            sum_views=Sum('views'), sum_votes=Sum('votes')).order_by('-sum_views', 'sum_votes')[:3]
+        context['posts'] = context['page_obj']
+        # Сайдбар кэшируется по категории, у главной ее нет
+        context['category'] = None
+        context['categories'] = categories.all_categories()
+        context['main_category'] = categories.main_category()
+        context['albums'] = Album.objects.for_cards()
+        context['comments'] = get_latest_comments()
+        context.update(leaderboards.get_leaderboards())
         return context
 
 
-class CategoryListView(ListView):
+class CategoryListView(KeysetPaginationMixin, ListView):
     model = Post
     template_name = 'news/category_post_list.html'
     paginate_by = 15
 
+    def get_queryset(self):
+        # Категория берется из карты в памяти, а связь с ней проверяется по id
+        # через уникальный индекс (post_id, category_id) таблицы связей: список
+        # идет по индексу publish и останавливается на LIMIT, а не собирает и
+        # сортирует все новости категории
+        self.category = categories.get_by_slug(self.kwargs['slug'])
+        if self.category is None:
+            raise Http404
+        in_category = Post.category.through.objects.filter(post_id=OuterRef('pk'), category_id=self.category.pk)
+        return Post.published.for_cards().filter(Exists(in_category))
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        p = Paginator(Post.objects.select_related().filter(category__name=self.kwargs.get('category_name')), self.paginate_by)
-        context['posts'] = p.page(context['page_obj'].number)
-        context['comments'] = Comment.objects.all().order_by('-created')[:3]
-        context['popular_day'] = Post.objects.all().filter(
-            publish__range=[timezone.now() - timezone.timedelta(days=1), timezone.now()]).annotate(
-            sum_views=Sum('views'), sum_votes=Sum('votes')).order_by('-sum_views', 'sum_votes')[:3]
-        context['popular_week'] = Post.objects.all().filter(
-            publish__range=[timezone.now() - timezone.timedelta(days=7), timezone.now()]).annotate(
-            sum_views=Sum('views'), sum_votes=Sum('votes')).order_by('-sum_views', 'sum_votes')[:3]
-        context['popular_month'] = Post.objects.all().filter(
-            publish__range=[timezone.now() - timezone.timedelta(days=30), timezone.now()]).annotate(
-            sum_views=Sum('views'), sum_votes=Sum('votes')).order_by('-sum_views', 'sum_votes')[:3]
-        context['popular_years'] = Post.objects.all().annotate(
-            sum_views=Sum('views'), sum_votes=Sum('votes')).order_by('-sum_views', 'sum_votes')[:3]
+        context['posts'] = context['page_obj']
+        context['category'] = self.category
+        context['comments'] = get_latest_comments()
+        context.update(leaderboards.get_leaderboards())
         return context
 
 
+def category_by_name(request, name):
+    """
+    Старые адреса категорий по названию - постоянный редирект на адрес по слагу.
+    Маршрут без слэша перехватывает и /category/<слаг> - его тоже ведем на
+    адрес со слэшем, как сделал бы APPEND_SLASH.
+    """
+    category = categories.get_by_name(name) or categories.get_by_slug(name)
+    if category is None:
+        raise Http404
+    return redirect('news:category_post_list', slug=category.slug, permanent=True)
+
+
 def post_detail(request, slug):
-    post = get_object_or_404(Post, slug=slug)
-    post.views += 1
-    post.save(update_fields=['views'])
-    context = {
-        'post': post,
-    }
-    return render(request, 'news/post_detail.html', context)
+    validators = conditional.post_validators(slug, request.user)
+    # Просмотр попадает в буфер и записывается в базу пачкой - в том числе при ответе 304
+    view_counter.hit(validators.pk)
+
+    def render_page():
+        post = get_object_or_404(Post.published, slug=slug)
+        post.views += view_counter.pending(post.pk)
+        comments, comment_count = build_comment_tree(post, request.user)
+        previous_post, next_post = related.get_neighbours(post)
+        context = {
+            'post': post,
+            'comments': comments,
+            'comment_count': comment_count,
+            'previous_post': previous_post,
+            'next_post': next_post,
+            'related_posts': related.get_related(post),
+        }
+        return render(request, 'news/post_detail.html', context)
+
+    response = conditional.conditional_response(request, validators, render_page)
+    # Для кэша страниц: при отдаче из кэша просмотр засчитывается по pk
+    response.page_cache_meta = {'post': validators.pk}
+    return response
+
+
+def count_cached_view(request, meta):
+    """Просмотр новости, страница которой отдана из кэша"""
+    view_counter.hit(meta['post'])
 
 
 class AddComment(View):
@@ -78,7 +116,7 @@ class AddComment(View):
 
     def post(self, request, slug):
         form = CommentForm(request.POST)
-        post = Post.objects.get(slug=slug)
+        post = get_object_or_404(Post.published, slug=slug)
         if form.is_valid():
             form = form.save(commit=False)
             if request.POST.get('parent', None):
@@ -109,34 +147,179 @@ class VotesView(View):
     vote_type = None  # Тип комментария Like/Dislike
 
     def post(self, request, pk):
-        obj = self.model.objects.get(pk=pk)
-        # GenericForeignKey не поддерживает метод get_or_create
         try:
-            likedislike = LikeDislike.objects.get(content_type=ContentType.objects.get_for_model(obj), object_id=obj.id,
-                                                  user=request.user)
-            if likedislike.vote is not self.vote_type:
-                likedislike.vote = self.vote_type
-                likedislike.save(update_fields=['vote'])
-                result = True
-            else:
-                likedislike.delete()
-                result = False
-        except LikeDislike.DoesNotExist:
-            obj.votes.create(user=request.user, vote=self.vote_type)
-            result = True
+            result, (like_count, dislike_count, rating) = toggle_vote(
+                self.model, pk, request.user, self.vote_type)
+        except self.model.DoesNotExist:
+            raise Http404
 
         return HttpResponse(
             json.dumps({
                 "result": result,
-                "like_count": obj.votes.likes().count(),
-                "dislike_count": obj.votes.dislikes().count(),
-                "sum_rating": obj.votes.sum_rating()
+                "like_count": like_count,
+                "dislike_count": dislike_count,
+                "sum_rating": rating
             }),
             content_type="application/json"
         )
 
+def get_album_reviews(album):
+    """Отзывы верхнего уровня с авторами и общее число отзывов альбома"""
+    return list(album.get_review().select_related('user')), album.review_set.count()
+
+
 class AlbumDetailView(DetailView):
     model = Album
     template_name = 'news/album_detail.html'
     context_object_name = 'album'
 
+    def get(self, request, *args, **kwargs):
+        validators = conditional.album_validators(kwargs['slug'], request.user)
+        return conditional.conditional_response(request, validators, partial(super().get, request, *args, **kwargs))
+
+    def get_queryset(self):
+        return Album.objects.select_related('band', 'label').prefetch_related('band__styles')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['reviews'], context['review_count'] = get_album_reviews(self.object)
+        return context
+
+
+class SearchView(View):
+    """Полнотекстовый поиск по новостям, альбомам и группам"""
+    template_name = 'news/search.html'
+    limit = 30
+
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        results = search.search(query, self.limit) if query else []
+        return render(request, self.template_name, {'query': query, 'results': results})
+
+
+class TopView(View):
+    """Лучшие альбомы и группы, все или одного стиля"""
+    template_name = 'news/top.html'
+
+    def get(self, request, style=None):
+        current = get_object_or_404(MusicStyle, slug=style) if style else None
+        return render(request, self.template_name, {
+            'style': current,
+            'styles': MusicStyle.objects.order_by('name'),
+            'albums': ratings.top_albums(style),
+            'bands': ratings.top_bands(style),
+        })
+
+
+class MetricsView(View):
+    """Метрики запросов в текстовом формате Prometheus - для сборщика с токеном и сотрудников"""
+
+    def get(self, request):
+        if not metrics.can_read(request):
+            raise Http404
+        return HttpResponse(metrics.registry.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Асинхронные варианты страниц для ASGI (NEWS_ASYNC_VIEWS). Независимые
+# запросы страницы выполняются одновременно в пуле потоков (news.asyncdb),
+# рендеринг шаблона - тоже в пуле, так что цикл событий не блокируется.
+
+async def main_page_async(request):
+    """Главная страница, как MainPage"""
+    page_size = MainPage.paginate_by
+    paginator = KeysetPaginator(Post.published.for_cards(), page_size)
+    _, page_obj = await asyncdb.gather(
+        partial(asyncdb.resolve_user, request),
+        partial(paginator.page, after=request.GET.get('after'), before=request.GET.get('before')),
+    )
+    # Данные кэшированных фрагментов - ленивые запросы: они выполняются при
+    # рендеринге, только если фрагмента в этот момент нет в кэше
+    context = {
+        'page_obj': page_obj,
+        'posts': page_obj,
+        'category': None,
+        'albums': Album.objects.for_cards(),
+        'comments': get_latest_comments(),
+    }
+
+    def render_page():
+        # Категории - из карты в памяти, рейтинги - ленивые запросы, поэтому не
+        # отдельные задачи пула, а тот же поток, что и рендеринг: холодная карта
+        # категорий и проверка возраста рейтингов читают базу, из цикла событий нельзя
+        context['categories'] = categories.all_categories()
+        context['main_category'] = categories.main_category()
+        context.update(leaderboards.get_leaderboards())
+        return render(request, MainPage.template_name, context)
+
+    return await asyncdb.run(render_page)
+
+
+async def post_detail_async(request, slug):
+    """Страница новости, как post_detail"""
+    validators = await conditional.post_validators_async(request, slug)
+    view_counter.hit(validators.pk)
+
+    async def render_page():
+        post = await asyncdb.run(partial(get_object_or_404, Post.published, pk=validators.pk))
+        post.views += view_counter.pending(post.pk)
+        # Состояние голосов создается до параллельных запросов, которые его заполняют
+        vote_state = get_vote_state(request.user)
+        (comments, comment_count), (previous_post, next_post), related_posts, _ = await asyncdb.gather(
+            partial(build_comment_tree, post, request.user),
+            partial(related.get_neighbours, post),
+            lambda: list(related.get_related(post)),
+            partial(vote_state.preload, [post]),
+        )
+        context = {
+            'post': post,
+            'comments': comments,
+            'comment_count': comment_count,
+            'previous_post': previous_post,
+            'next_post': next_post,
+            'related_posts': related_posts,
+        }
+        return await asyncdb.run(partial(render, request, 'news/post_detail.html', context))
+
+    response = await conditional.conditional_response_async(request, validators, render_page)
+    response.page_cache_meta = {'post': validators.pk}
+    return response
+
+
+async def album_detail_async(request, slug):
+    """Страница альбома, как AlbumDetailView"""
+    validators = await conditional.album_validators_async(request, slug)
+
+    async def render_page():
+        album = Album(pk=validators.pk)
+        vote_state = get_vote_state(request.user)
+        album, (reviews, review_count), _ = await asyncdb.gather(
+            partial(get_object_or_404, AlbumDetailView().get_queryset(), pk=validators.pk),
+            partial(get_album_reviews, album),
+            partial(vote_state.preload, [album]),
+        )
+        context = {'album': album, 'object': album, 'reviews': reviews, 'review_count': review_count}
+        return await asyncdb.run(partial(render, request, AlbumDetailView.template_name, context))
+
+    return await conditional.conditional_response_async(request, validators, render_page)
+
+
+async def votes_async(request, pk, model, vote_type):
+    """Голос за объект, как VotesView под login_required"""
+    if not await asyncdb.run(partial(asyncdb.resolve_user, request)):
+        return redirect_to_login(request.get_full_path())
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        result, (like_count, dislike_count, rating) = await asyncdb.run(
+            partial(toggle_vote, model, pk, request.user, vote_type))
+    except model.DoesNotExist:
+        raise Http404
+    return HttpResponse(
+        json.dumps({
+            "result": result,
+            "like_count": like_count,
+            "dislike_count": dislike_count,
+            "sum_rating": rating
+        }),
+        content_type="application/json"
+    )
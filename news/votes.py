@@ -0,0 +1,197 @@
+"""
+Работа с голосами (LikeDislike) и денормализованными счетчиками
+like_count / dislike_count / rating на голосуемых моделях.
+
+toggle_vote меняет счетчики по числу строк, которые действительно
+вставил, изменил или удалил его запрос, так что параллельные клики не
+сбивают их. Остальные удаления голоса - в админке или каскадом вместе с
+пользователем - уменьшают счетчики через post_delete (release_vote).
+"""
+import sqlite3
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from news.models import Post, Comment, Album, Band, LikeDislike
+from news.signals import vote_changed
+
+VOTABLE_MODELS = (Post, Comment, Album, Band)
+
+COUNTER_FIELDS = ('like_count', 'dislike_count', 'rating')
+
+
+def vote_delta(old_vote, new_vote):
+    """Изменение счетчиков при смене голоса old_vote -> new_vote (None - голоса нет)"""
+    delta = {'like_count': 0, 'dislike_count': 0, 'rating': 0}
+    for vote, sign in ((old_vote, -1), (new_vote, 1)):
+        if vote == LikeDislike.LIKE:
+            delta['like_count'] += sign
+        elif vote == LikeDislike.DISLIKE:
+            delta['dislike_count'] += sign
+        if vote:
+            delta['rating'] += sign * vote
+    return delta
+
+
+def _can_update_returning(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35)
+
+
+def apply_vote_delta(model, pk, delta):
+    """
+    Атомарно применяет изменение счетчиков и возвращает новые значения
+    (лайки, дизлайки, рейтинг) или None, если объекта нет.
+    Где база умеет UPDATE ... RETURNING, это один запрос.
+    """
+    connection = connections[router.db_for_write(model)]
+    if _can_update_returning(connection):
+        quote = connection.ops.quote_name
+        assignments = ', '.join(f'{quote(field)} = {quote(field)} + %s' for field in COUNTER_FIELDS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {quote(model._meta.db_table)} SET {assignments} '
+                f'WHERE {quote(model._meta.pk.column)} = %s '
+                f'RETURNING {", ".join(quote(field) for field in COUNTER_FIELDS)}',
+                [delta[field] for field in COUNTER_FIELDS] + [pk],
+            )
+            return cursor.fetchone()
+    if not model.objects.filter(pk=pk).update(**{field: F(field) + value for field, value in delta.items()}):
+        return None
+    return model.objects.filter(pk=pk).values_list(*COUNTER_FIELDS).get()
+
+
+def toggle_vote(model, pk, user, vote):
+    """
+    Переключает голос пользователя за объект: нет голоса или противоположный - ставит
+    vote, такой же - снимает. Возвращает (голос стоит?, (лайки, дизлайки, рейтинг)).
+
+    Уникальность (user, content_type, object_id) гарантирует база: сначала пробуем
+    вставить голос, а при конфликте меняем или удаляем существующий - без
+    предварительного чтения, так что параллельные клики не создают дублей.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    votes = LikeDislike.objects.filter(content_type=content_type, object_id=pk, user=user)
+    with transaction.atomic():
+        for _ in range(3):
+            try:
+                with transaction.atomic():
+                    LikeDislike.objects.create(content_type=content_type, object_id=pk, user=user, vote=vote)
+                old_vote, new_vote = None, vote
+                break
+            except IntegrityError:
+                pass
+            if votes.exclude(vote=vote).update(vote=vote):
+                old_vote, new_vote = -vote, vote
+                break
+            # DELETE без Collector: post_delete отправляется для прочитанных строк, даже
+            # если параллельный запрос удалил их раньше, а здесь важно число удаленных
+            if votes.filter(vote=vote)._raw_delete(votes.db):
+                old_vote, new_vote = vote, None
+                break
+            # Голос успели удалить параллельным запросом - пробуем вставить снова
+        else:
+            raise IntegrityError('Не удалось переключить голос')
+
+        counters = apply_vote_delta(model, pk, vote_delta(old_vote, new_vote))
+        if counters is None:
+            raise model.DoesNotExist
+        transaction.on_commit(lambda: vote_changed.send(
+            sender=model, pk=pk, user=user, old_vote=old_vote, new_vote=new_vote))
+    return new_vote is not None, tuple(counters)
+
+
+@receiver(post_delete, sender=LikeDislike)
+def release_vote(sender, instance, **kwargs):
+    """Вычитает из счетчиков объекта голос, удаленный не через toggle_vote"""
+    model = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+    if model in VOTABLE_MODELS:
+        apply_vote_delta(model, instance.object_id, vote_delta(instance.vote, None))
+
+
+def count_votes(model):
+    """Фактические счетчики по таблице LikeDislike: object_id -> (лайки, дизлайки, рейтинг)"""
+    rows = LikeDislike.objects.filter(
+        content_type=ContentType.objects.get_for_model(model)
+    ).values('object_id').annotate(
+        likes=Count('pk', filter=Q(vote__gt=0)),
+        dislikes=Count('pk', filter=Q(vote__lt=0)),
+        total=Sum('vote'),
+    ).order_by()
+    return {row['object_id']: (row['likes'], row['dislikes'], row['total']) for row in rows}
+
+
+def sync_vote_counters(model, batch_size=500, dry_run=False):
+    """
+    Пересчитывает денормализованные счетчики модели по таблице LikeDislike.
+    Возвращает количество объектов с расходящимися счетчиками.
+    """
+    actual = count_votes(model)
+    stale = []
+    fixed = 0
+    for obj in model.objects.only('pk', *COUNTER_FIELDS).order_by('pk').iterator(chunk_size=batch_size):
+        counters = actual.get(obj.pk, (0, 0, 0))
+        if (obj.like_count, obj.dislike_count, obj.rating) == counters:
+            continue
+        obj.like_count, obj.dislike_count, obj.rating = counters
+        stale.append(obj)
+        fixed += 1
+        if len(stale) >= batch_size:
+            if not dry_run:
+                model.objects.bulk_update(stale, COUNTER_FIELDS)
+            stale = []
+    if stale and not dry_run:
+        model.objects.bulk_update(stale, COUNTER_FIELDS)
+    return fixed
+
+
+class VoteState:
+    """
+    Голоса текущего пользователя за объекты страницы.
+    Загружаются пачкой - одним запросом на тип объектов, а не EXISTS на каждый объект.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._votes = {}
+        self._loaded = set()
+
+    def preload(self, objects, pk_queryset=None):
+        """
+        Загружает голоса за objects. Для длинных списков одного типа можно
+        передать pk_queryset (подзапрос values('pk')) вместо перечисления id.
+        """
+        by_type = {}
+        for obj in objects:
+            content_type = ContentType.objects.get_for_model(obj)
+            if (content_type.pk, obj.pk) not in self._loaded:
+                by_type.setdefault(content_type.pk, []).append(obj.pk)
+        for content_type_id, ids in by_type.items():
+            self._loaded.update((content_type_id, pk) for pk in ids)
+            if not self.user.is_authenticated:
+                continue
+            rows = LikeDislike.objects.filter(
+                user=self.user, content_type_id=content_type_id,
+                object_id__in=ids if pk_queryset is None else pk_queryset,
+            ).values_list('object_id', 'vote')
+            self._votes.update(((content_type_id, object_id), vote) for object_id, vote in rows)
+
+    def vote_for(self, obj):
+        """Голос пользователя за объект (LikeDislike.LIKE / DISLIKE) или None"""
+        key = (ContentType.objects.get_for_model(obj).pk, obj.pk)
+        if key not in self._loaded:
+            self.preload([obj])
+        return self._votes.get(key)
+
+
+def get_vote_state(user):
+    """VoteState, привязанный к пользователю запроса (живет столько же, сколько request.user)"""
+    state = getattr(user, '_vote_state', None)
+    if state is None:
+        state = VoteState(user)
+        user._vote_state = state
+    return state